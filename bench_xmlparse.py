@@ -0,0 +1,140 @@
+"""
+Compare stanzas/sec for the xmlparse parsers on the test fixtures, and the time to
+parse a stanza with a long attribute value (where the legacy parser is quadratic).
+
+    python bench_xmlparse.py [--seconds=1]
+"""
+import time
+
+import tornado.options
+
+import xmlparse
+
+def legacy_xml2list(xml_text):
+    # the character-at-a-time parser that xml2list replaced, kept for comparison
+    tag_bounds = []
+    xml_list = []
+    START, END, SINGLE = 0,1,2
+    i=0
+    while i < len(xml_text):
+        if xml_text[i] == '<':
+            i = ii = i+1
+            while xml_text[ii] != '>': ii += 1
+            if xml_text[i] == '!': pass
+            elif xml_text[i] == '?': pass
+            elif xml_text[i] == '/':
+                tag_bounds.append((i,ii, END))
+            else:
+                if xml_text[ii-1] == '/':
+                    tag_bounds.append((i,ii-1, SINGLE))
+                else:
+                    tag_bounds.append((i,ii, START))
+            i= ii
+        i+=1
+
+    def build_xml(tag_idx, children):
+        tag = tag_bounds[tag_idx]
+        name_and_opts = xml_text[tag[0] : tag[1]].split()
+        xml_blk = xmlparse.XmlBLock(name=name_and_opts[0])
+        children.append(xml_blk)
+        if len(name_and_opts) > 1:
+            i =1
+            while i < len(name_and_opts):
+                key, val = name_and_opts[i].split('=', 1)
+                if val[0]=='"' and val[-1] == '"':
+                    val = val[1:-1]
+                elif val[0] == '"':
+                    val = val[1:]
+                    i += 1
+                    while i < len(name_and_opts):
+                        val += ' ' + name_and_opts[i]
+                        i += 1
+                        if val[-1] == '"':
+                            break
+                xml_blk.options[key] = val
+                i+=1
+        if tag[2] == SINGLE:
+            return tag_idx+1
+        tag_next = tag_bounds[tag_idx+1]
+        xml_blk.data = xml_text[tag[1]+1:tag_next[0]-1].strip()
+        tag_idx += 1
+        while 1:
+            tag_next = tag_bounds[tag_idx]
+            if tag_next[2] == END:
+                name = xml_text[tag_next[0]+1:tag_next[1]]
+                if name == xml_blk.name :
+                    return tag_idx + 1
+            else:
+                tag_idx= build_xml(tag_idx, xml_blk.children)
+                if tag_idx >= len(tag_bounds):
+                    return tag_idx
+
+    build_xml(0, xml_list)
+    return xml_list
+
+class FixtureCollector(object):
+    """Stands in for a pytest metafunc to collect the xmlparse test fixtures"""
+    def __init__(self):
+        self.function = xmlparse.test_xml_parsing
+        self.fixtures = []
+    def addcall(self, funcargs):
+        self.fixtures.append(funcargs['raw_xml'].strip())
+
+def stream_parse(stanzas, lazy=False):
+    parser = xmlparse.StreamParser(stanza_cb=lambda stanza: None, lazy=lazy)
+    parser.feed('<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">')
+    parser.feed(''.join(stanzas))
+
+def run(name, parse, stanzas, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        parse(stanzas)
+        count += len(stanzas)
+    rate = count / (time.time() - start)
+    print '%-20s %10.0f stanzas/sec' % (name, rate)
+    return rate
+
+def long_attribute_stanza(tokens):
+    # ie: a caps ext attribute listing many extensions
+    ext = ' '.join('ext%d' % i for i in range(tokens))
+    return '<presence from="a@test/r"><c xmlns="http://jabber.org/protocol/caps" node="n" ext="%s"/></presence>' % ext
+
+def time_one(name, parse, xml_text, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        parse(xml_text)
+        count += 1
+    elapsed = (time.time() - start) / count
+    print '%-20s %10.2f ms' % (name, elapsed * 1000)
+    return elapsed
+
+def main():
+    tornado.options.define("seconds", type=float, default=1.0, help="time to run each parser")
+    tornado.options.parse_command_line()
+    seconds = tornado.options.options.seconds
+
+    collector = FixtureCollector()
+    xmlparse.pytest_generate_tests(collector)
+    # the legacy parser can't handle entities or CDATA; only time it on what it parses
+    legacy_stanzas = [raw_xml for raw_xml in collector.fixtures if '<![CDATA[' not in raw_xml]
+    stanzas = collector.fixtures * 100
+
+    print '%d fixtures, %d bytes' % (len(collector.fixtures), sum(map(len, collector.fixtures)))
+    legacy = run('legacy xml2list', lambda s: [legacy_xml2list(x) for x in s], legacy_stanzas * 100, seconds)
+    current = run('xml2list', lambda s: [xmlparse.xml2list(x) for x in s], legacy_stanzas * 100, seconds)
+    run('xml2list (all)', lambda s: [xmlparse.xml2list(x) for x in s], stanzas, seconds)
+    run('StreamParser', stream_parse, stanzas, seconds)
+    run('StreamParser (lazy)', lambda s: stream_parse(s, lazy=True), stanzas, seconds)
+    print 'xml2list speedup: %0.1fx' % (current / legacy)
+
+    for tokens in 500, 5000:
+        xml_text = long_attribute_stanza(tokens)
+        print 'ext attribute with %d tokens, %d bytes' % (tokens, len(xml_text))
+        legacy = time_one('legacy xml2list', legacy_xml2list, xml_text, seconds)
+        current = time_one('xml2list', xmlparse.xml2list, xml_text, seconds)
+        print 'xml2list speedup: %0.1fx' % (legacy / current)
+
+if __name__ == "__main__":
+    main()
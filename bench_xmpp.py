@@ -0,0 +1,139 @@
+"""
+End to end benchmark of XMPPIOLoopClient against the bundled FakeXMPPServer.
+
+Reports connect time, inbound messages/sec parsed and dispatched, p50/p99 latency from
+the server writing a message to message_cb seeing it, outbound bytes/sec written, and
+the bytes that went over the wire in each direction against the process CPU time
+(to weigh --compression).
+
+    python bench_xmpp.py [--messages=20000] [--sends=20000] [--tls | --direct_tls] [--lazy] [--coalesce] [--metrics]
+        [--compression=6]
+"""
+import shutil
+import socket
+import tempfile
+import time
+
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+
+from xmpp_fakeserver import FakeXMPPServer, make_self_signed_cert
+from xmpp_ioloop import XMPPIOLoopClient
+from xmpp_metrics import ClientMetrics
+from xmpp_tls import create_context
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Benchmark(object):
+    def __init__(self, options, certfile=None, keyfile=None):
+        self.options = options
+        self.io_loop = tornado.ioloop.IOLoop.instance()
+        self.server = FakeXMPPServer(domain="bench", certfile=certfile, keyfile=keyfile,
+            direct_tls=options.direct_tls, compression=options.compression is not None, bound_cb=self.bound_cb, stanza_cb=self.server_stanza_cb)
+        sock, = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+        self.server.add_sockets([sock])
+        self.client = XMPPIOLoopClient("127.0.0.1", sock.getsockname()[1], domain="bench",
+            username="bench", password="bench", resource="bench", lazy_stanzas=options.lazy)
+        self.client.coalesce_writes = options.coalesce
+        self.client.compression_level = options.compression
+        if certfile:
+            self.client.ssl_context = create_context(cafile=certfile)
+            self.client.direct_tls = options.direct_tls
+        if options.metrics:
+            self.client.metrics = ClientMetrics()
+        self.latencies = []
+        self.sent = 0
+        self.results = {}
+
+    def run(self):
+        self.start = time.time()
+        cpu_start = time.clock()
+        self.client.connect(connect_cb=self.connect_cb, presence_cb=lambda stanza: None,
+            message_cb=self.message_cb)
+        self.io_loop.add_timeout(time.time() + self.options.timeout, self.io_loop.stop)
+        self.io_loop.start()
+        self.results['cpu'] = time.clock() - cpu_start
+        self.results['wire_in'] = self.server.bytes_sent
+        self.results['wire_out'] = self.server.bytes_received
+        return self.results
+
+    def connect_cb(self):
+        self.results['connect'] = time.time() - self.start
+
+    def bound_cb(self, connection):
+        self.inbound_start = time.time()
+        connection.replay(self.flood(connection.jid))
+
+    def flood(self, to):
+        # the send time rides along in the id; stanzas are built as the server writes them
+        body = 'x' * self.options.body_size
+        for i in xrange(self.options.messages):
+            yield '<message from="peer@bench/r" to="%s" id="%r" type="chat"><body>%s</body></message>' % (
+                to, time.time(), body)
+
+    def message_cb(self, stanza):
+        now = time.time()
+        self.latencies.append(now - float(stanza.options['id']))
+        if len(self.latencies) == self.options.messages:
+            elapsed = now - self.inbound_start
+            self.results['inbound'] = self.options.messages / elapsed
+            self.results['p50'] = percentile(self.latencies, 0.5)
+            self.results['p99'] = percentile(self.latencies, 0.99)
+            self.io_loop.add_callback(self.start_outbound)
+
+    def start_outbound(self):
+        self.outbound_start = time.time()
+        self.outbound_bytes = self.server.bytes_received
+        body = 'x' * self.options.body_size
+        for i in xrange(self.options.sends):
+            self.client.message(to="peer@bench", body=body)
+        self.client.flush()
+
+    def server_stanza_cb(self, connection, stanza):
+        self.sent += 1
+        if self.sent == self.options.sends:
+            elapsed = time.time() - self.outbound_start
+            self.results['outbound'] = (self.server.bytes_received - self.outbound_bytes) / elapsed
+            self.io_loop.stop()
+
+def main():
+    tornado.options.define("messages", type=int, default=20000, help="messages the server floods the client with")
+    tornado.options.define("sends", type=int, default=20000, help="messages the client sends")
+    tornado.options.define("body_size", type=int, default=100)
+    tornado.options.define("tls", type=bool, default=False, help="use STARTTLS (with a throwaway certificate)")
+    tornado.options.define("direct_tls", type=bool, default=False, help="use direct TLS instead of STARTTLS")
+    tornado.options.define("lazy", type=bool, default=False, help="use lazy stanzas")
+    tornado.options.define("coalesce", type=bool, default=False, help="coalesce client writes")
+    tornado.options.define("compression", type=int, default=None, help="use stream compression at this zlib level")
+    tornado.options.define("metrics", type=bool, default=False, help="collect client metrics (to see their overhead)")
+    tornado.options.define("timeout", type=float, default=60)
+    tornado.options.parse_command_line()
+    options = tornado.options.options
+
+    certdir = certfile = keyfile = None
+    if options.tls or options.direct_tls:
+        certdir = tempfile.mkdtemp()
+        certfile, keyfile = make_self_signed_cert(certdir, common_name="bench")
+    try:
+        results = Benchmark(options, certfile, keyfile).run()
+    finally:
+        if certdir:
+            shutil.rmtree(certdir)
+
+    if len(results) < 8:
+        print 'benchmark did not finish: %r' % results
+        return
+    print 'connect              %10.1f ms' % (results['connect'] * 1000)
+    print 'inbound              %10.0f messages/sec' % results['inbound']
+    print 'latency p50          %10.2f ms' % (results['p50'] * 1000)
+    print 'latency p99          %10.2f ms' % (results['p99'] * 1000)
+    print 'outbound             %10.0f bytes/sec' % results['outbound']
+    print 'wire in              %10d bytes' % results['wire_in']
+    print 'wire out             %10d bytes' % results['wire_out']
+    print 'cpu                  %10.2f sec' % results['cpu']
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import getpass
 import tornado.options
 import tornado.ioloop
 from xmpp_ioloop import XMPPIOLoopClient
+from xmpp_offload import CallbackOffload, default_executor
 
 class App(object):
     def __init__(self, options):
@@ -12,6 +13,8 @@ class App(object):
                 username=options.google_apps_account,
                 password=getpass.getpass(),
                 resource="xmpp_ioloop_example")
+        # callbacks run in a worker thread, so waiting for raw_input() doesn't block the connection
+        self.xmpp_client.offload = CallbackOffload(self.xmpp_client, default_executor(1))
 
         self.xmpp_client.connect(connect_cb=self.xmpp_connect_cb, 
                 presence_cb=self.xmpp_presence_cb, 
@@ -33,7 +36,7 @@ class App(object):
         if msg.options.get('type') == 'subscribe':
             # auto-respond to presense notification
             # you could save this in the roster, etc
-            self.xmpp_client.presence(to=msg.options["from"], type="subscribed")
+            self.xmpp_client.threadsafe.presence(to=msg.options["from"], type="subscribed")
     
     def xmpp_message_cb(self, msg):
         """
@@ -51,7 +54,7 @@ class App(object):
         
         response_txt = raw_input("Response: ")
         if response_txt.strip():
-            self.xmpp_client.message(to=from_addr, body=response_txt)
+            self.xmpp_client.threadsafe.message(to=from_addr, body=response_txt)
 
 
 if __name__ == "__main__":
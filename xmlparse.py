@@ -2,13 +2,141 @@
 # http://blenderartists.org/forum/showthread.php?89710-XML-parsing
 # with some adaptations and fixes
 
+import re
+from xml.parsers import expat
+
+# names, attribute names and some attribute values repeat in every stanza; share one
+# copy of each. The table is bounded so a peer can't grow it forever: it stops taking
+# new values at MAX_INTERNED, and expat only gets a copy of it (see StreamParser.reset)
+MAX_INTERNED = 10000
+_interned = {}
+# attributes whose values come from a small set (namespaces, types, our own jid)
+INTERNED_VALUES = frozenset(['xmlns', 'type', 'to'])
+# attribute name tuple -> (the shared tuple, positions of the values to intern)
+_key_tuples = {}
+
+def intern_value(value):
+    """The shared copy of value (a string or tuple of strings)"""
+    try:
+        return _interned[value]
+    except KeyError:
+        if len(_interned) < MAX_INTERNED:
+            _interned[value] = value
+        return value
+
+class Attributes(tuple):
+    """A compact, read only mapping of attribute name -> value for parsed elements
+    (with compact_attributes; they're dicts otherwise).
+    
+    It's a single tuple of (names, value, value, ...), where the tuple of names is
+    shared by every element with the same attributes (ie: every <message from to type
+    id>), so it's much smaller than a dict. Lookups scan the names, which is fast for
+    the handful of attributes an element has. It supports the read only dict methods,
+    compares equal to a dict with the same items, and copy() returns a dict.
+    """
+    __slots__ = ()
+    def __new__(cls, items=()):
+        if isinstance(items, (dict, Attributes)):
+            items = items.items()
+        items = list(items)
+        return tuple.__new__(cls, [intern_value(tuple(key for key, value in items))] + [value for key, value in items])
+    
+    def __reduce__(self):
+        return (Attributes, (self.items(),))
+    
+    def __getitem__(self, key):
+        try:
+            return _tuple_getitem(self, _tuple_getitem(self, 0).index(key) + 1)
+        except ValueError:
+            raise KeyError(key)
+    
+    def get(self, key, default=None):
+        keys = _tuple_getitem(self, 0)
+        if key in keys:
+            return _tuple_getitem(self, keys.index(key) + 1)
+        return default
+    
+    def __contains__(self, key):
+        return key in _tuple_getitem(self, 0)
+    has_key = __contains__
+    
+    def __iter__(self):
+        return iter(_tuple_getitem(self, 0))
+    
+    def __len__(self):
+        return _tuple_len(self) - 1
+    
+    def keys(self):
+        return list(_tuple_getitem(self, 0))
+    
+    def values(self):
+        return list(_tuple_getslice(self, 1, _tuple_len(self)))
+    
+    def items(self):
+        return zip(_tuple_getitem(self, 0), _tuple_getslice(self, 1, _tuple_len(self)))
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def copy(self):
+        return dict(self.items())
+    
+    def __eq__(self, other):
+        if isinstance(other, Attributes):
+            return dict(self.items()) == dict(other.items())
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+_tuple_getitem = tuple.__getitem__
+_tuple_getslice = tuple.__getslice__
+_tuple_len = tuple.__len__
+_new_tuple = tuple.__new__
+EMPTY_ATTRIBUTES = Attributes()
+
+def _attributes(attrs, compact=False):
+    # a dict (or with `compact`, Attributes) from a flat [name, value, name, value, ...]
+    # list (as expat gives with ordered_attributes); names and some values are interned
+    if not attrs:
+        return EMPTY_ATTRIBUTES if compact else {}
+    keys = tuple(attrs[0::2])
+    try:
+        keys, positions = _key_tuples[keys]
+    except KeyError:
+        keys = intern_value(keys)
+        positions = tuple(i for i, key in enumerate(keys) if key in INTERNED_VALUES)
+        if len(_key_tuples) < MAX_INTERNED:
+            _key_tuples[keys] = keys, positions
+    values = attrs[1::2]
+    for i in positions:
+        values[i] = intern_value(values[i])
+    if not compact:
+        return dict(zip(keys, values))
+    values.insert(0, keys)
+    return _new_tuple(Attributes, values)
+
+# elements with this many children are indexed the first time they're searched
+INDEX_MIN_CHILDREN = 32
+
 class XmlBLock(object):
-    __slots__ = 'name', 'children', 'options', 'data'
+    __slots__ = 'name', 'children', 'options', 'data', '_index'
     def __init__(self, name, data=None, children=None, options=None):
         self.name = name
         self.data = data
         self.children = children or []
-        self.options = options or {}
+        self.options = options if options is not None else {}
+        self._index = None
     
     def __eq__(self, other):
         # primarily used for testing to validate parsing
@@ -18,6 +146,8 @@ class XmlBLock(object):
             return False
         if self.options != other.options:
             return False
+        if self.data != other.data:
+            return False
         if len(self.children) != len(other.children):
             return False
         for i, child in enumerate(self.children):
@@ -26,29 +156,96 @@ class XmlBLock(object):
         return True
     
     def find(self, name=None, options=None):
-        """Return the first element that matches name && options. If option[key] == None,
+        """Return the first element that matches name && options. If options[key] == None,
         the presense of that option will be required, but it's value will not be checked.
+        options can be a dict or a list of (key, value) pairs.
         
         >> msg = xml2msg('<tag><inner><body>....</body></inner></tag>')
         >> msg.find("body").data == '...'
         """
+        if self._index is not None or len(self.children) >= INDEX_MIN_CHILDREN:
+            for obj in self.iterfind(name, options):
+                return obj
+            return None
+        if isinstance(options, dict):
+            options = options.items()
+        # a plain depth first walk; for a typical stanza that's quicker than any index
+        stack = [self]
+        while stack:
+            obj = stack.pop()
+            if (not name or obj.name == name) and (not options or obj._match_options(options)):
+                return obj
+            children = obj.children
+            if children:
+                stack.extend(reversed(children))
+    
+    def findall(self, name=None, options=None):
+        """Return a list of all elements (in document order) that match name && options"""
+        return list(self.iterfind(name, options))
+    
+    def iterfind(self, name=None, options=None):
+        """Iterate over the elements that match name && options, in document order.
         
-        found = True
-        if name and self.name != name:
-            found = False
+        Elements with INDEX_MIN_CHILDREN or more children (ie: a big roster), and
+        trees that index() was called on, are searched with an index by element name
+        and by (name, attribute), so the cost is in the number of candidates not the
+        size of the tree. The tree is assumed to be unchanged once it's indexed; call
+        `reindex()` after modifying it.
+        """
+        if not name and not options:
+            yield self
+            return
+        if isinstance(options, dict):
+            options = options.items()
+        elif options:
+            options = list(options)
+        if self._index is None and len(self.children) < INDEX_MIN_CHILDREN:
+            stack = [self]
+            while stack:
+                obj = stack.pop()
+                if (not name or obj.name == name) and (not options or obj._match_options(options)):
+                    yield obj
+                children = obj.children
+                if children:
+                    stack.extend(reversed(children))
+            return
+        if self._index is None:
+            self.index()
         if options:
-            for key, value in options:
-                if value is None:
-                    if key not in self.options:
-                        found = False
-                elif self.options.get(key) != value:
-                    found = False
-        if found:
-            return self
-        for child in self.children:
-            obj = child.find(name, options)
-            if obj:
-                return obj
+            # narrow by the first attribute's presence; check the rest on each candidate
+            candidates = self._index.get((name or None, options[0][0]), ())
+        else:
+            candidates = self._index.get(name, ())
+        for obj in candidates:
+            if options and not obj._match_options(options):
+                continue
+            yield obj
+    
+    def _match_options(self, options):
+        for key, value in options:
+            if value is None:
+                if key not in self.options:
+                    return False
+            elif self.options.get(key) != value:
+                return False
+        return True
+    
+    def index(self):
+        """Build the search index for this tree (worth it for trees searched many times)"""
+        index = {}
+        stack = [self]
+        while stack:
+            obj = stack.pop()
+            index.setdefault(obj.name, []).append(obj)
+            for key in obj.options:
+                index.setdefault((obj.name, key), []).append(obj)
+                index.setdefault((None, key), []).append(obj)
+            stack.extend(reversed(obj.children))
+        self._index = index
+    
+    def reindex(self):
+        """Drop the search index (it's rebuilt on the next find)"""
+        self._index = None
     
     def __repr__(self):
         return '<XmlBLock name:%s data:%r options:%s children:%s>' % (self.name, self.data, self.options, self.children)
@@ -56,92 +253,389 @@ class XmlBLock(object):
         children = ', '.join([x.dump() for x in self.children])
         return 'XmlBLock(name=%r, data=%r,\n\toptions=%r,\n\tchildren=[%s]\n)' % (self.name, self.data, self.options, children)
 
-def xml2msg(xml_text):
-    msgs = xml2list(xml_text)
+class LazyXmlBLock(XmlBLock):
+    """An XmlBLock for a stanza whose children and data are only parsed from the raw
+    stanza text (`raw`) the first time they are accessed. `options` are parsed up front.
+    
+    `find` and `findall` first scan the raw text for the requested element name, so
+    looking for an element that isn't there never builds the subtree.
+    """
+    __slots__ = 'raw', '_children', '_data'
+    def __init__(self, name, raw, options=None):
+        self.name = name
+        self.raw = raw
+        self.options = options if options is not None else {}
+        self._index = None
+        self._children = None
+        self._data = None
+    
+    def _materialize(self):
+        raw = self.raw
+        if not isinstance(raw, unicode):
+            raw = raw.decode('utf-8')
+        # children are parsed the way the stanza's own attributes were
+        xml_blk = xml2msg(raw, compact_attributes=isinstance(self.options, Attributes))
+        self._children = xml_blk.children
+        self._data = xml_blk.data
+    
+    def _get_children(self):
+        if self._children is None:
+            self._materialize()
+        return self._children
+    def _set_children(self, children):
+        self._children = children
+        self._index = None
+    children = property(_get_children, _set_children)
+    
+    def _get_data(self):
+        if self._children is None:
+            self._materialize()
+        return self._data
+    def _set_data(self, data):
+        if self._children is None:
+            self._materialize()
+        self._data = data
+    data = property(_get_data, _set_data)
+    
+    def contains_tag(self, name):
+        """Quick scan of the raw text for an element named `name`"""
+        raw = self.raw
+        if isinstance(name, unicode) and not isinstance(raw, unicode):
+            name = name.encode('utf-8')
+        needle = '<' + name
+        i = raw.find(needle, 1)
+        while i != -1:
+            end = i + len(needle)
+            if end < len(raw) and raw[end] in ' \t\r\n/>':
+                return True
+            i = raw.find(needle, end)
+        return False
+    
+    def find(self, name=None, options=None):
+        if self._children is None and name and name != self.name and not self.contains_tag(name):
+            return None
+        return XmlBLock.find(self, name, options)
+    
+    def iterfind(self, name=None, options=None):
+        if self._children is None and name and name != self.name and not self.contains_tag(name):
+            return iter(())
+        return XmlBLock.iterfind(self, name, options)
+
+def xml2msg(xml_text, compact_attributes=False):
+    msgs = xml2list(xml_text, compact_attributes)
     assert len(msgs) == 1
     return msgs[0]
 
-def xml2list(xml_text):
-    tag_bounds = []
+# a single regex alternation tokenizes markup; anything between two matches is text
+_TOKEN_RE = re.compile(r"""
+    <!\[CDATA\[(?P<cdata>.*?)\]\]>
+  | <!--.*?-->
+  | <[?!][^>]*>
+  | </(?P<end>[^\s>]+)\s*>
+  | <(?P<start>[^\s/>]+)(?P<attrs>(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*)\s*(?P<single>/)?>
+""", re.S | re.X)
+_ATTR_RE = re.compile(r"""([^\s=]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_ENTITY_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|lt|gt|amp|quot|apos);')
+_ENTITIES = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+def _replace_entity(match):
+    entity = match.group(1)
+    if entity[0] != '#':
+        return _ENTITIES[entity]
+    if entity[1] == 'x':
+        char = unichr(int(entity[2:], 16))
+    else:
+        char = unichr(int(entity[1:]))
+    if not isinstance(match.string, unicode):
+        return char.encode('utf-8')
+    return char
+
+def unescape(text):
+    """Replace the predefined xml entities and character references in text"""
+    if '&' not in text:
+        return text
+    return _ENTITY_RE.sub(_replace_entity, text)
+
+def _text(raw):
+    # data between tags; only text and CDATA are kept (not comments or processing instructions)
+    if '<' not in raw:
+        return unescape(raw).strip()
+    data = []
+    pos = 0
+    for match in _TOKEN_RE.finditer(raw):
+        data.append(unescape(raw[pos:match.start()]))
+        if match.group('cdata') is not None:
+            data.append(match.group('cdata'))
+        pos = match.end()
+    data.append(unescape(raw[pos:]))
+    return ''.join(data).strip()
+
+def xml2list(xml_text, compact_attributes=False):
+    """Parse xml_text into a list of XmlBLock trees (one per top level element).
+    
+    This is a single linear pass over the text; attribute values and data have entities
+    replaced, and CDATA sections are included in data verbatim. With compact_attributes
+    element options are (read only) Attributes instead of dicts.
+    """
     xml_list = []
-    # Mark all start and ends for the <> and </>
-    START, END, SINGLE = 0,1,2 # is it a start tag, end tag or a single tag.
-    i=0
-    while i < len(xml_text):
-        # tag all < and > 
-        if xml_text[i] == '<':
-            i = ii = i+1 # increase i so we can use slicing
-            while xml_text[ii] != '>': ii += 1
-            
-            if xml_text[i] == '!': pass # comment, assume <!--
-            elif xml_text[i] == '?': pass # assume <?xml
-            elif xml_text[i] == '/': # Ending
-                tag_bounds.append((i,ii, END))
-            else: # Starting
-                if xml_text[ii-1] == '/':
-                    tag_bounds.append((i,ii-1, SINGLE)) # dont include the /
-                else:
-                    tag_bounds.append((i,ii, START))
-            i= ii
-        i+=1
-        
-    def build_xml(tag_idx, children):
-        '''
-        gets all the data between here and the next index
-        '''
-        tag = tag_bounds[tag_idx] # must be the starter - tag[2] == True
-        
-        if tag[2] == END:
-            print xml_text[tag[0]:tag[1]]
-            print xml_list
-            raise "Error"
-        
-        
-        name_and_opts = xml_text[tag[0] : tag[1]].split()
-        xml_blk = XmlBLock(name=name_and_opts[0])
-        children.append(xml_blk)
-        
-        if len(name_and_opts) > 1: # Some options were set
-            i =1
-            while i < len(name_and_opts):
-                # print name_and_opts
-                key, val = name_and_opts[i].split('=', 1)
-                if val[0]=='"' and val[-1] == '"': 
-                    val = val[1:-1] # strip ""
-                elif val[0] == '"':
-                    val = val[1:]
-                    i += 1
-                    while i < len(name_and_opts):
-                        val += ' ' + name_and_opts[i]
-                        i += 1
-                        if val[-1] == '"':
-                            break
-                
-                xml_blk.options[key] = val
-                i+=1
-        
-        if tag[2] == SINGLE: # this tag has no matching end tag, return the next index.
-            return tag_idx+1
+    # open elements, and where their data starts (None once it has been set)
+    stack = []
+    for match in _TOKEN_RE.finditer(xml_text):
+        cdata, end_name, name, attrs, single = match.groups()
+        if cdata is not None:
+            continue
         
-        tag_next = tag_bounds[tag_idx+1]
-        xml_blk.data = xml_text[tag[1]+1:tag_next[0]-1].strip() # Text between now and the next tag is data
+        if name is not None:
+            attr_list = []
+            if attrs:
+                for key, double_quoted, single_quoted in _ATTR_RE.findall(attrs):
+                    attr_list.append(key)
+                    attr_list.append(unescape(double_quoted or single_quoted))
+            xml_blk = XmlBLock(name=intern_value(name), options=_attributes(attr_list, compact_attributes))
+            if stack:
+                parent = stack[-1]
+                if parent[1] is not None:
+                    # data is the text between the start tag and the first child element
+                    parent[0].data = _text(xml_text[parent[1]:match.start()])
+                    parent[1] = None
+                parent[0].children.append(xml_blk)
+            else:
+                xml_list.append(xml_blk)
+            if not single:
+                stack.append([xml_blk, match.end()])
         
-        tag_idx += 1
-        while 1:
-            tag_next = tag_bounds[tag_idx]
-            # This ends the current tag
-            if tag_next[2] == END:
-                name = xml_text[tag_next[0]+1:tag_next[1]]
-                if name == xml_blk.name :
-                    return tag_idx + 1
-                # Should only be ending the current tag
+        elif end_name is not None:
+            # close the matching element (and anything left open inside of it)
+            i = len(stack) - 1
+            while i >= 0 and stack[i][0].name != end_name:
+                i -= 1
+            if i < 0:
+                continue
+            for xml_blk, data_start in stack[i:]:
+                if data_start is not None:
+                    xml_blk.data = _text(xml_text[data_start:match.start()])
+            del stack[i:]
+    for xml_blk, data_start in stack:
+        if data_start is not None:
+            xml_blk.data = _text(xml_text[data_start:])
+    return xml_list
+
+class StreamParser(object):
+    """Incremental (push based) parser for an XMPP stream.
+    
+    Raw chunks read from the socket are passed to `feed` as they arrive. Element depth
+    is tracked across chunk boundaries, and every complete top level element of the
+    stream (ie: a stanza) is passed to `stanza_cb` as an `XmlBLock` tree; a single
+    chunk can produce any number of stanzas, and nothing is re-scanned once parsed.
+    
+    `stream_start_cb(name, options)` is called for the <stream:stream> open tag, and
+    `stream_end_cb()` when the server closes the stream.
+    
+    With `lazy=True` only the stanza element itself is parsed; stanzas are passed on as
+    a `LazyXmlBLock` which keeps the raw stanza text and parses the rest on demand.
+    
+    A stanza bigger than `max_stanza_size` bytes is discarded as it's parsed (so it
+    never takes more memory than that, plus a chunk); `oversize_cb(name, options, size)`
+    is called in its place as soon as it's over the limit.
+    
+    With `compact_attributes=True` element options are read only `Attributes`, which take
+    about half the memory of a dict; they can't be modified or passed to json.
+    """
+    def __init__(self, stanza_cb, stream_start_cb=None, stream_end_cb=None, lazy=False,
+            max_stanza_size=None, oversize_cb=None, compact_attributes=False):
+        self.stanza_cb = stanza_cb
+        self.stream_start_cb = stream_start_cb
+        self.stream_end_cb = stream_end_cb
+        self.lazy = lazy
+        self.compact_attributes = compact_attributes
+        self.max_stanza_size = max_stanza_size
+        self.oversize_cb = oversize_cb
+        self.reset()
+    
+    def reset(self):
+        """Start parsing a new stream document (ie: after STARTTLS or SASL success)"""
+        # expat interns element and attribute names in this dict, and adds every new
+        # name to it; give it a copy of the (bounded) table, which goes away with the parser
+        parser = expat.ParserCreate(intern=dict(_interned))
+        parser.buffer_text = True
+        parser.ordered_attributes = True
+        if self.lazy:
+            parser.StartElementHandler = self._lazy_start_element
+            parser.EndElementHandler = self._lazy_end_element
+            parser.CharacterDataHandler = self._lazy_character_data
+        else:
+            parser.StartElementHandler = self._start_element
+            parser.EndElementHandler = self._end_element
+            parser.CharacterDataHandler = self._character_data
+        self._parser = parser
+        self._stream_open = False
+        self._stack = []
+        self._events = []
+        # bytes fed to this parser, and whether the open stanza is over the size limit
+        self._fed = 0
+        self._discarding = False
+        # lazy mode: the raw stream text from _buffer_offset onwards, and the open stanza
+        self._buffer = []
+        self._buffer_offset = 0
+        self._depth = 0
+        self._stanza_start = None
+        self._stanza_end = 0
+        self._stanza_name = None
+        self._stanza_options = None
+        self._stanza_content = False
+    
+    def feed(self, data):
+        """Parse a chunk of the stream, dispatching any stanzas it completes"""
+        if self.lazy:
+            self._buffer.append(data)
+        self._parser.Parse(data, False)
+        self._fed += len(data)
+        if (self.max_stanza_size and self._stanza_start is not None and not self._discarding and
+                self._fed - self._stanza_start > self.max_stanza_size):
+            self._oversize(self._fed - self._stanza_start)
+        if self.lazy:
+            self._trim_buffer()
+        # dispatch after Parse returns so callbacks are free to reset() the parser
+        parser = self._parser
+        events, self._events = self._events, []
+        for callback, args in events:
+            if self._parser is not parser:
+                # a callback started a new stream (ie: STARTTLS); whatever followed in
+                # this chunk belongs to the old one, and mustn't be trusted
+                break
+            if callback:
+                callback(*args)
+    
+    def _start_element(self, name, attrs):
+        if not self._stream_open:
+            self._stream_open = True
+            self._events.append((self.stream_start_cb, (name, _attributes(attrs, self.compact_attributes))))
+            return
+        if self._discarding:
+            self._stack.append(None)
+            return
+        xml_blk = XmlBLock(name=name, options=_attributes(attrs, self.compact_attributes))
+        if self._stack:
+            self._stack[-1].children.append(xml_blk)
+        else:
+            self._stanza_start = self._parser.CurrentByteIndex
+        self._stack.append(xml_blk)
+    
+    def _end_element(self, name):
+        if not self._stack:
+            self._stream_open = False
+            self._events.append((self.stream_end_cb, ()))
+            return
+        xml_blk = self._stack.pop()
+        if self._discarding:
+            if not self._stack:
+                self._discarding = False
+                self._stanza_start = None
+            return
+        if xml_blk.data is not None:
+            xml_blk.data = xml_blk.data.strip()
+        elif xml_blk.children:
+            xml_blk.data = ''
+        if not self._stack:
+            size = self._parser.CurrentByteIndex - self._stanza_start
+            if self.max_stanza_size and size > self.max_stanza_size:
+                self._stack.append(xml_blk)
+                self._oversize(size)
+                self._stack = []
+                self._discarding = False
             else:
-                tag_idx= build_xml(tag_idx, xml_blk.children)
-                if tag_idx >= len(tag_bounds):
-                    return tag_idx # will finish
+                self._events.append((self.stanza_cb, (xml_blk,)))
+            self._stanza_start = None
     
-    build_xml(0, xml_list)
-    return xml_list
+    def _character_data(self, text):
+        if not self._stack or self._discarding:
+            return # whitespace keepalives between stanzas
+        xml_blk = self._stack[-1]
+        if not xml_blk.children:
+            # like xml2list, data is the text before the first child element
+            xml_blk.data = (xml_blk.data or '') + text
+    
+    def _lazy_start_element(self, name, attrs):
+        if not self._stream_open:
+            self._stream_open = True
+            self._events.append((self.stream_start_cb, (name, _attributes(attrs, self.compact_attributes))))
+            return
+        self._depth += 1
+        if self._depth == 1:
+            self._stanza_start = self._parser.CurrentByteIndex
+            self._stanza_name = name
+            self._stanza_options = _attributes(attrs, self.compact_attributes)
+            self._stanza_content = False
+        else:
+            self._stanza_content = True
+    
+    def _lazy_end_element(self, name):
+        if not self._depth:
+            self._stream_open = False
+            self._events.append((self.stream_end_cb, ()))
+            return
+        self._depth -= 1
+        if self._depth:
+            return
+        if self._discarding:
+            self._discarding = False
+            self._stanza_start = None
+            self._stanza_end = self._parser.CurrentByteIndex
+            return
+        buf = self._join_buffer()
+        start = self._stanza_start - self._buffer_offset
+        if self._stanza_content:
+            # the index is at the start of the </stanza> end tag
+            end = buf.index('>', self._parser.CurrentByteIndex - self._buffer_offset) + 1
+        else:
+            # either <stanza/> or <stanza></stanza>
+            match = _TOKEN_RE.match(buf, start)
+            end = match.end()
+            if not match.group('single'):
+                end = buf.index('>', end) + 1
+        raw = buf[start:end]
+        self._stanza_end = self._buffer_offset + end
+        if self.max_stanza_size and end - start > self.max_stanza_size:
+            self._oversize(end - start)
+            self._discarding = False
+        else:
+            self._events.append((self.stanza_cb, (LazyXmlBLock(name=name, raw=raw, options=self._stanza_options),)))
+        self._stanza_start = None
+    
+    def _lazy_character_data(self, text):
+        if self._depth:
+            self._stanza_content = True
+    
+    def _join_buffer(self):
+        if len(self._buffer) > 1:
+            self._buffer = [''.join(self._buffer)]
+        return self._buffer[0]
+    
+    def _oversize(self, size):
+        # drop what's been parsed of the open stanza, and skip the rest of it
+        if self.lazy:
+            name, options = self._stanza_name, self._stanza_options
+        else:
+            name, options = self._stack[0].name, self._stack[0].options
+            self._stack = [None] * len(self._stack)
+        self._discarding = True
+        self._events.append((self.oversize_cb, (name, options, size)))
+    
+    def _trim_buffer(self):
+        if self._discarding:
+            # none of the open stanza is kept
+            self._buffer_offset += len(self._join_buffer())
+            self._buffer = []
+            return
+        # keep the buffer from the start of the open stanza (or the end of the last one)
+        keep = self._stanza_start
+        if keep is None:
+            keep = self._stanza_end
+        start = keep - self._buffer_offset
+        if start:
+            buf = self._join_buffer()
+            self._buffer = [buf[start:]]
+            self._buffer_offset = keep
 
 def pytest_generate_tests(metafunc):
     if metafunc.function in [test_xml_parsing]:
@@ -176,7 +670,7 @@ def pytest_generate_tests(metafunc):
             options={},
             children=[]
         ), XmlBLock(name='c', data=None,
-            options={'node': 'http://www.apple.com/ichat/caps', 'ext': 'ice recauth rdserver maudio audio rdclient mvideo auxvideo rdmuxing avcap avavail video"', 'ver': '800'},
+            options={'node': 'http://www.apple.com/ichat/caps', 'ext': 'ice recauth rdserver maudio audio rdclient mvideo auxvideo rdmuxing avcap avavail video', 'ver': '800', 'xmlns': 'http://jabber.org/protocol/caps'},
             children=[]
         ), XmlBLock(name='x', data=None,
             options={'xmlns': 'http://jabber.org/protocol/tune'},
@@ -191,9 +685,160 @@ def pytest_generate_tests(metafunc):
         )
         metafunc.addcall(funcargs=dict(raw_xml=raw_xml, result_xml=result_xml))
         
+        # entities, a quoted '>' and CDATA containing markup
+        raw_xml = '''<message to='a@test' title="x > y" from="b&amp;c@test/r"><body>1 &lt; 2 &#x263A;</body><html><![CDATA[<p>hi</p>]]></html></message>'''
+        result_xml = XmlBLock(name='message', data='',
+            options={'to': 'a@test', 'title': 'x > y', 'from': 'b&c@test/r'},
+            children=[XmlBLock(name='body', data='1 < 2 \xe2\x98\xba',
+            options={},
+            children=[]
+        ), XmlBLock(name='html', data='<p>hi</p>',
+            options={},
+            children=[]
+        )]
+        )
+        metafunc.addcall(funcargs=dict(raw_xml=raw_xml, result_xml=result_xml))
 
 
 def test_xml_parsing(raw_xml, result_xml):
     o = xml2msg(raw_xml)
     print o.dump()
     assert o == result_xml
+
+def test_stream_parser():
+    raw_stream = ('<?xml version="1.0" encoding="UTF-8"?><stream:stream from="test" id="1A2B" version="1.0" '
+        'xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">'
+        '<message from="a@test/r" type="chat"><body><![CDATA[a </message> in the body]]></body></message>\n'
+        '<presence from="b@test/r"/><iq id="2" type="result"><bind><jid>c@test/r</jid></bind></iq>'
+        '</stream:stream>')
+    events = []
+    parser = StreamParser(stanza_cb=events.append,
+        stream_start_cb=lambda name, options: events.append((name, options['id'])),
+        stream_end_cb=lambda: events.append('end'))
+    # split across every possible chunk boundary
+    for c in raw_stream:
+        parser.feed(c)
+    assert events == [
+        ('stream:stream', '1A2B'),
+        XmlBLock(name='message', data='', options={'from': 'a@test/r', 'type': 'chat'},
+            children=[XmlBLock(name='body', data='a </message> in the body')]),
+        XmlBLock(name='presence', options={'from': 'b@test/r'}),
+        XmlBLock(name='iq', data='', options={'id': '2', 'type': 'result'},
+            children=[XmlBLock(name='bind', data='', children=[XmlBLock(name='jid', data='c@test/r')])]),
+        'end']
+    assert events[1].find('body').data == 'a </message> in the body'
+    assert events[2].data is None
+
+    # stanzas after one that restarts the stream (ie: injected after <proceed/>) are dropped
+    events = []
+    def stanza_cb(stanza):
+        events.append(stanza.name)
+        parser.reset()
+    parser = StreamParser(stanza_cb=stanza_cb)
+    parser.feed(raw_stream[:raw_stream.index('<presence')] + '<presence/>')
+    assert events == ['message']
+
+def test_max_stanza_size():
+    header = '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">'
+    big = '<iq id="1" type="result"><query>%s</query></iq>' % ''.join('<item jid="a%d@test"/>' % i for i in range(100))
+    for lazy in (False, True):
+        stanzas, oversize = [], []
+        parser = StreamParser(stanza_cb=lambda stanza: stanzas.append(stanza.options['id']), lazy=lazy,
+            max_stanza_size=200, oversize_cb=lambda name, options, size: oversize.append((name, options['id'])))
+        parser.feed(header + '<message id="a"/>')
+        # over the limit part way through (the rest is skipped), and within one chunk
+        for i in range(0, len(big), 64):
+            parser.feed(big[i:i + 64])
+        parser.feed('<message id="b"><body>hi</body></message>' + big.replace('"1"', '"2"') + '<message id="c"/>')
+        assert stanzas == ['a', 'b', 'c']
+        assert oversize == [('iq', '1'), ('iq', '2')]
+        assert not parser._stack and not ''.join(parser._buffer)
+
+def test_lazy_stream_parser():
+    raw_stanzas = ['<message from="a@test/r" type="chat"><active xmlns="http://jabber.org/protocol/chatstates"/>'
+            '<body>hi &amp; bye</body><nos:x xmlns:nos="google:nosave" value="disabled"/></message>',
+        '<presence from="b@test/r"/>',
+        '<presence from="b@test/r" a="/>"></presence>',
+        '<iq id="2" type="result"><query xmlns="jabber:iq:roster"/></iq>']
+    stanzas = []
+    parser = StreamParser(stanza_cb=stanzas.append, lazy=True)
+    raw_stream = '<stream:stream xmlns:stream="http://etherx.jabber.org/streams">' + '\n'.join(raw_stanzas)
+    for c in raw_stream:
+        parser.feed(c)
+    assert [stanza.raw for stanza in stanzas] == raw_stanzas
+    
+    message = stanzas[0]
+    assert message.options == {'from': 'a@test/r', 'type': 'chat'}
+    assert message.find('bodyx') is None
+    assert message.find('html') is None
+    assert message._children is None # not parsed yet
+    assert message.find('body').data == 'hi & bye'
+    assert message._children is not None
+    assert [child.name for child in message.children] == ['active', 'body', 'nos:x']
+    assert stanzas[1].children == [] and stanzas[1].data is None
+    assert stanzas[2].options['a'] == '/>'
+
+def test_findall():
+    items = ''.join(['<item jid="user%d@test" subscription="%s"><group>g%d</group></item>' % (i, i % 2 and 'both' or 'to', i % 3)
+        for i in range(100)])
+    roster = xml2msg('<iq id="3" type="result"><query xmlns="jabber:iq:roster">%s</query></iq>' % items)
+    assert len(roster.findall("item")) == 100
+    assert roster.find("item", [("jid", "user42@test")]).find("group").data == 'g0'
+    assert roster.find("item", {"jid": "user43@test", "subscription": "to"}) is None
+    assert [obj.options['jid'] for obj in roster.findall("item", {"subscription": "both"})][:2] == ['user1@test', 'user3@test']
+    assert len(roster.findall(options=[("subscription", None)])) == 100
+    assert roster.find("query", [("xmlns", "jabber:iq:roster")]) is roster.children[0]
+    assert roster.find("iq") is roster and roster.find() is roster
+    assert roster.findall("missing") == []
+    # small trees are walked; big ones (and index()ed ones) use the index
+    query = roster.find("query")
+    assert query.find("item", {"jid": "user7@test"}).find("group").data == 'g1'
+    assert roster._index is None and query._index is not None
+    message = xml2msg('<message><x><body>a</body></x><body>b</body></message>')
+    assert message.find("body").data == 'a' and message._index is None
+    message.index()
+    assert [body.data for body in message.findall("body")] == ['a', 'b']
+
+def test_attributes():
+    import json
+    import pickle
+    raw_xml = '<message from="a@test/r" to="me@test/bot" type="chat"><body>hi</body></message>'
+    # dicts by default
+    stanza = xml2msg(raw_xml)
+    assert type(stanza.options) is dict and json.loads(json.dumps(stanza.options)) == stanza.options
+    stanza.options['id'] = '1'
+    assert xml2msg(raw_xml.replace('a@test', 'b@test')).options['to'] is stanza.options['to']
+    assert type(xml2msg('<presence/>').options) is dict
+    
+    first = xml2msg(raw_xml, compact_attributes=True)
+    second = xml2list(raw_xml.replace('a@test', 'b@test'), compact_attributes=True)[0]
+    assert isinstance(first.options, Attributes)
+    assert first.options == {'from': 'a@test/r', 'to': 'me@test/bot', 'type': 'chat'}
+    assert first.options['to'] == 'me@test/bot' and first.options.get('id') is None
+    assert 'type' in first.options and 'id' not in first.options
+    assert sorted(first.options) == ['from', 'to', 'type'] and dict(first.options) == first.options
+    # names, and the values of `to` and `type`, are shared between stanzas
+    assert _tuple_getitem(first.options, 0) is _tuple_getitem(second.options, 0)
+    assert first.options['to'] is second.options['to']
+    assert first.options['from'] is not second.options['from']
+    assert first.name is second.name
+    
+    options = Attributes({'type': 'get'})
+    assert options == {'type': 'get'} and options != {'type': 'set'} and len(options) == 1
+    assert options.items() == [('type', 'get')] and options.copy() == {'type': 'get'}
+    assert pickle.loads(pickle.dumps(options)) == options
+    assert xml2msg('<presence/>', compact_attributes=True).options is EMPTY_ATTRIBUTES
+    try:
+        options['id']
+        assert False
+    except KeyError:
+        pass
+    
+    # a stream full of new names doesn't grow the shared table past its bound
+    stanzas = []
+    parser = StreamParser(stanza_cb=stanzas.append, lazy=True, compact_attributes=True)
+    parser.feed('<stream:stream xmlns:stream="http://etherx.jabber.org/streams">')
+    parser.feed(''.join('<x%d a%d="v"><y/></x%d>' % (i, i, i) for i in range(MAX_INTERNED + 100)))
+    assert len(stanzas) == MAX_INTERNED + 100 and len(_interned) <= MAX_INTERNED
+    # a lazy stanza's children are parsed like its own attributes were
+    assert isinstance(stanzas[0].options, Attributes) and isinstance(stanzas[0].find("y").options, Attributes)
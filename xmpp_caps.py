@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Entity capabilities (XEP-0115): contacts advertise a hash of their disco#info in
+presence (<c node=".." ver=".." hash="sha-1"/>). A CapsCache asks one contact per ver
+for its disco#info, checks the answer hashes to that ver, and remembers it (in memory,
+and in a dbm file if given a path) so every other contact with the same ver, now or
+after a restart, costs no round trip.
+
+    >> client.caps = CapsCache(client, path='/var/lib/bot/caps.db')
+    >> client.caps.supports('friend@gmail.com/Adium', 'http://jabber.org/protocol/chatstates')
+    True
+"""
+import base64
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+try:
+    import anydbm as dbm
+except ImportError:
+    import dbm
+
+from xmpp_stanza import escape
+
+NS_CAPS = "http://jabber.org/protocol/caps"
+NS_DISCO_INFO = "http://jabber.org/protocol/disco#info"
+NS_DATA = "jabber:x:data"
+
+class Capabilities(object):
+    """What an entity's disco#info said: identities as (category, type, lang, name) and
+    the set of features"""
+    __slots__ = 'identities', 'features'
+    def __init__(self, identities, features):
+        self.identities = identities
+        self.features = frozenset(features)
+
+    @classmethod
+    def from_query(cls, query):
+        identities = [(identity.options.get('category', ''), identity.options.get('type', ''),
+                identity.options.get('xml:lang', ''), identity.options.get('name', ''))
+            for identity in query.findall("identity")]
+        features = [feature.options.get('var', '') for feature in query.findall("feature")]
+        return cls(identities, features)
+
+    def supports(self, feature):
+        return feature in self.features
+
+    def __repr__(self):
+        return '<Capabilities identities:%r features:%r>' % (self.identities, sorted(self.features))
+
+def caps_ver(query, hash_name="sha-1"):
+    """The XEP-0115 verification string for a disco#info <query/>, or None if the
+    query is malformed (ie: a repeated identity or feature) or hash_name is unknown"""
+    try:
+        digest = hashlib.new(hash_name.replace('-', ''))
+    except ValueError:
+        return None
+    identities = sorted('/'.join([_utf8(value) for value in identity])
+        for identity in Capabilities.from_query(query).identities)
+    features = sorted(_utf8(feature.options.get('var', '')) for feature in query.findall("feature"))
+    if len(set(identities)) != len(identities) or len(set(features)) != len(features):
+        return None
+    forms = []
+    for form in query.findall("x", {"xmlns": NS_DATA}):
+        form_type = None
+        fields = []
+        for field in form.findall("field"):
+            values = sorted(_utf8(value.data or '') for value in field.findall("value"))
+            if field.options.get('var') == 'FORM_TYPE':
+                if form_type is not None or len(values) != 1:
+                    return None
+                form_type = values[0]
+            else:
+                fields.append((_utf8(field.options.get('var', '')), values))
+        if form_type is None:
+            # forms without a FORM_TYPE aren't part of the hash
+            continue
+        forms.append((form_type, sorted(fields)))
+    forms.sort()
+    if len(set(form_type for form_type, fields in forms)) != len(forms):
+        return None
+    s = ''.join(identity + '<' for identity in identities)
+    s += ''.join(feature + '<' for feature in features)
+    for form_type, fields in forms:
+        s += form_type + '<'
+        for var, values in fields:
+            s += var + '<' + ''.join(value + '<' for value in values)
+    digest.update(s)
+    return base64.b64encode(digest.digest())
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+class CapsCache(object):
+    """Capabilities by caps (hash, ver): the `max_entries` most recently used in
+    memory, all of them in the dbm file at `path` (if given). New entries are written
+    to the file together, `write_delay` seconds after the first of them (and on close()),
+    so discovering many vers at once doesn't hold up the IOLoop with a write for each.
+
+    Presence delivered by the client is watched for caps. The first contact seen with
+    a ver that isn't known yet is sent a disco#info query; contacts advertising the
+    same ver meanwhile wait for that answer (and are asked in turn if it fails, or
+    doesn't match the ver). Legacy caps (without a hash) can't be verified, so those
+    contacts are each asked, and their answers kept only while they're online.
+    """
+    def __init__(self, client, path=None, max_entries=1000, timeout=30, write_delay=5):
+        self.client = client
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.write_delay = write_delay
+        self.queries = 0
+        self._lru = OrderedDict()
+        self._db = dbm.open(path, 'c') if path else None
+        # dbm key -> json not written to the file yet
+        self._unwritten = {}
+        self._write_timeout = None
+        # full jid -> (hash, ver) advertised in its presence
+        self._jids = {}
+        # full jid -> Capabilities for legacy (or unverifiable) caps
+        self._unverified = {}
+        # (hash, ver) -> (full jid, node)s also advertising it, while it's being discovered
+        self._discovering = {}
+
+    def get(self, hash_name, ver):
+        """The Capabilities for `ver` (computed with `hash_name`) if it's known"""
+        if not hash_name:
+            return None
+        key = (hash_name, ver)
+        capabilities = self._lru.pop(key, None)
+        if capabilities is None and self._db is not None:
+            db_key = _db_key(hash_name, ver)
+            try:
+                data = json.loads(self._unwritten.get(db_key) or self._db[db_key])
+            except KeyError:
+                return None
+            capabilities = Capabilities([tuple(identity) for identity in data['identities']], data['features'])
+        if capabilities is not None:
+            self._remember(key, capabilities)
+        return capabilities
+
+    def _remember(self, key, capabilities):
+        self._lru[key] = capabilities
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def add(self, hash_name, ver, capabilities):
+        self._remember((hash_name, ver), capabilities)
+        if self._db is None:
+            return
+        self._unwritten[_db_key(hash_name, ver)] = json.dumps(dict(identities=capabilities.identities,
+            features=sorted(capabilities.features)))
+        if self._write_timeout is None:
+            self._write_timeout = self.client.io_loop.add_timeout(time.time() + self.write_delay, self.write)
+
+    def write(self):
+        """Write the entries added since the last write to the dbm file"""
+        if self._write_timeout is not None:
+            self.client.io_loop.remove_timeout(self._write_timeout)
+            self._write_timeout = None
+        if self._db is None or not self._unwritten:
+            return
+        unwritten, self._unwritten = self._unwritten, {}
+        for key, value in unwritten.iteritems():
+            self._db[key] = value
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+
+    def capabilities(self, jid):
+        """The Capabilities of the full jid, or None if not known (yet)"""
+        if jid in self._unverified:
+            return self._unverified[jid]
+        advertised = self._jids.get(jid)
+        return advertised and self.get(*advertised)
+
+    def supports(self, jid, feature):
+        """Whether the full jid supports feature; None if its capabilities aren't known"""
+        capabilities = self.capabilities(jid)
+        return capabilities and capabilities.supports(feature)
+
+    def update_presence(self, stanza):
+        jid = stanza.options.get('from')
+        if not jid:
+            return
+        if stanza.options.get('type') == 'unavailable':
+            self._jids.pop(jid, None)
+            self._unverified.pop(jid, None)
+            return
+        if stanza.options.get('type') is not None:
+            return
+        c = stanza.find("c", {"xmlns": NS_CAPS})
+        if not c or not c.options.get('ver') or not c.options.get('node'):
+            return
+        node, ver, hash_name = c.options['node'], c.options['ver'], c.options.get('hash')
+        if self._jids.get(jid) == (hash_name, ver):
+            return
+        self._jids[jid] = (hash_name, ver)
+        self._unverified.pop(jid, None)
+        if not hash_name:
+            self._query(jid, node, ver, None)
+        elif (hash_name, ver) in self._discovering:
+            self._discovering[hash_name, ver].append((jid, node))
+        elif self.get(hash_name, ver) is None:
+            self._discovering[hash_name, ver] = []
+            self._query(jid, node, ver, hash_name)
+
+    def _query(self, jid, node, ver, hash_name):
+        self.queries += 1
+        body = '<query xmlns="%s" node="%s"/>' % (NS_DISCO_INFO, escape(node + '#' + ver))
+        def callback(stanza):
+            self._finish_query(jid, ver, hash_name, stanza)
+        self.client.iq_request("get", body, to=jid, timeout=self.timeout, callback=callback)
+
+    def _finish_query(self, jid, ver, hash_name, stanza):
+        query = stanza and stanza.options.get('type') == 'result' and stanza.find("query", {"xmlns": NS_DISCO_INFO})
+        if hash_name is None:
+            # legacy caps
+            if query and self._jids.get(jid) == (None, ver):
+                self._unverified[jid] = Capabilities.from_query(query)
+            return
+        if query and caps_ver(query, hash_name) == ver:
+            self.add(hash_name, ver, Capabilities.from_query(query))
+            self._discovering.pop((hash_name, ver), None)
+            return
+        if query:
+            logging.warning('disco#info from %s does not match caps ver %s', jid, ver)
+            # still good for this contact, just not for the ver
+            if self._jids.get(jid) == (hash_name, ver):
+                self._unverified[jid] = Capabilities.from_query(query)
+        # ask the next contact still advertising this ver
+        waiting = self._discovering.get((hash_name, ver), [])
+        while waiting:
+            jid, node = waiting.pop(0)
+            if self._jids.get(jid) == (hash_name, ver):
+                self._query(jid, node, ver, hash_name)
+                return
+        self._discovering.pop((hash_name, ver), None)
+
+    def clear_presence(self):
+        """Forget who advertised what (ie: when the stream closes); known vers are kept"""
+        self._jids.clear()
+        self._unverified.clear()
+        self._discovering.clear()
+
+    def close(self):
+        if self._db is not None:
+            self.write()
+            self._db.close()
+            self._db = None
+
+def _db_key(hash_name, ver):
+    # vers are base64, so they have no spaces
+    return _utf8('%s %s' % (hash_name, ver))
+
+def test_caps_ver():
+    from xmlparse import xml2msg
+    # the examples from XEP-0115 section 5
+    simple = xml2msg('''<query xmlns="http://jabber.org/protocol/disco#info">
+        <identity category="client" name="Exodus 0.9.1" type="pc"/>
+        <feature var="http://jabber.org/protocol/caps"/>
+        <feature var="http://jabber.org/protocol/disco#info"/>
+        <feature var="http://jabber.org/protocol/disco#items"/>
+        <feature var="http://jabber.org/protocol/muc"/></query>''')
+    assert caps_ver(simple) == 'QgayPKawpkPSDYmwT/WM94uAlu0='
+    complex = xml2msg(u'''<query xmlns="http://jabber.org/protocol/disco#info">
+        <identity xml:lang="en" category="client" name="Psi 0.11" type="pc"/>
+        <identity xml:lang="el" category="client" name="Ψ 0.11" type="pc"/>
+        <feature var="http://jabber.org/protocol/caps"/>
+        <feature var="http://jabber.org/protocol/disco#info"/>
+        <feature var="http://jabber.org/protocol/disco#items"/>
+        <feature var="http://jabber.org/protocol/muc"/>
+        <x xmlns="jabber:x:data" type="result">
+          <field var="FORM_TYPE" type="hidden"><value>urn:xmpp:dataforms:softwareinfo</value></field>
+          <field var="ip_version"><value>ipv4</value><value>ipv6</value></field>
+          <field var="os"><value>Mac</value></field>
+          <field var="os_version"><value>10.5.1</value></field>
+          <field var="software"><value>Psi</value></field>
+          <field var="software_version"><value>0.11</value></field>
+        </x></query>''')
+    assert caps_ver(complex) == 'q07IKJEyjvHSyhy//CH0CxmKi8w='
+    repeated = xml2msg('<query xmlns="http://jabber.org/protocol/disco#info"><feature var="a"/><feature var="a"/></query>')
+    assert caps_ver(repeated) is None and caps_ver(simple, 'sha-999') is None
+
+def test_caps_cache():
+    import os
+    import shutil
+    import tempfile
+    import time
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    info = ('<query xmlns="%s"><identity category="client" name="Exodus 0.9.1" type="pc"/>'
+        '<feature var="http://jabber.org/protocol/caps"/><feature var="http://jabber.org/protocol/disco#info"/>'
+        '<feature var="http://jabber.org/protocol/disco#items"/><feature var="http://jabber.org/protocol/muc"/>'
+        '</query>' % NS_DISCO_INFO)
+    presence = '<presence from="%s"><c xmlns="%s" hash="sha-1" node="http://exodus.jabberstudio.org/" ver="%s"/></presence>'
+    # c0 answers with something that doesn't match its ver, so c1 is asked
+    disco = dict(('c%d@test/r' % i, info) for i in range(1, 5))
+    disco['c0@test/r'] = info.replace('muc', 'xhtml')
+    disco['c6@test/r'] = info.replace('muc', 'xhtml')
+    stanzas = [presence % ('c%d@test/r' % i, NS_CAPS, 'QgayPKawpkPSDYmwT/WM94uAlu0=') for i in range(5)]
+    stanzas.append(presence % ('c5@test/r', NS_CAPS, 'bogus='))
+    # the same ver with another hash isn't the same entry
+    stanzas.append((presence % ('c6@test/r', NS_CAPS, 'QgayPKawpkPSDYmwT/WM94uAlu0=')).replace('sha-1', 'sha-256'))
+    def bound_cb(connection):
+        connection.replay(stanzas)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'caps')
+        io_loop = tornado.ioloop.IOLoop()
+        server, port = start_fake_server(io_loop, bound_cb=bound_cb, disco=disco)
+        for run in range(2):
+            client = client_for(port, io_loop, lazy_stanzas=bool(run))
+            client.autoreconnect = False
+            client.caps = CapsCache(client, path=path)
+            client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=lambda stanza: None)
+            io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
+            io_loop.start()
+            client.stream.close()
+            caps = client.caps
+            assert caps.supports('c3@test/r', 'http://jabber.org/protocol/muc')
+            assert not caps.supports('c3@test/r', 'http://jabber.org/protocol/xhtml')
+            assert caps.supports('c5@test/r', 'http://jabber.org/protocol/muc') is None
+            assert caps.get('sha-256', 'QgayPKawpkPSDYmwT/WM94uAlu0=') is None
+            assert caps.supports('c6@test/r', 'http://jabber.org/protocol/xhtml')
+            if run == 0:
+                # the new entry waits for write_delay, or close()
+                assert len(caps._unwritten) == 1 and not caps._db.keys()
+            caps.close()
+            if run == 0:
+                # c0, c1 (for the ver), c5 (which has no disco#info) and c6
+                assert caps.queries == 4 and server.disco_queries == 4
+                # c0 keeps what it said about itself
+                assert caps.supports('c0@test/r', 'http://jabber.org/protocol/xhtml')
+            else:
+                # after a restart the ver is known; only c5 and c6 are asked again
+                assert caps.queries == 2 and server.disco_queries == 6
+                assert caps.supports('c0@test/r', 'http://jabber.org/protocol/muc')
+        server.stop()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,171 @@
+"""
+Raw traffic capture for XMPPIOLoopClient, and offline replay of captures.
+
+    >> client.capture = TrafficCapture('/var/log/xmpp/traffic.capture')
+
+Replay the inbound side of a capture through the parser and report stanzas/sec:
+
+    python xmpp_capture.py [--lazy] [--repeat=1] traffic.capture
+"""
+import logging
+import os
+import Queue
+import threading
+import time
+
+import tornado.options
+
+from xmlparse import StreamParser
+
+CAPTURE_IN = "<"
+CAPTURE_OUT = ">"
+
+class TrafficCapture(object):
+    """Writes raw inbound and outbound bytes with timestamps to `path`, rotating it
+    (to path.1 ... path.`backup_count`) when it grows past `max_bytes`.
+
+    record() only queues the data; a background thread does the file writes so the
+    IOLoop never waits on disk. When more than `max_queue` records are waiting new
+    ones are dropped (and counted in `dropped`) rather than slowing down the loop.
+
+    Each record is a header line "<timestamp> <direction> <length>\\n" followed by
+    the raw bytes and a newline. read_capture() reads them back.
+    """
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=5, max_queue=100000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = Queue.Queue(max_queue)
+        self._file = open(path, 'ab')
+        self._thread = threading.Thread(target=self._run, name='xmpp-capture')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, direction, data):
+        try:
+            self._queue.put_nowait((time.time(), direction, data))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write out anything queued and close the file"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            records = [item]
+            # write everything that's waiting in one go
+            try:
+                while len(records) < 1000:
+                    item = self._queue.get_nowait()
+                    if item is None:
+                        break
+                    records.append(item)
+            except Queue.Empty:
+                pass
+            try:
+                self._write(records)
+            except (IOError, OSError):
+                logging.exception('failed writing traffic capture to %s', self.path)
+            if item is None:
+                break
+        self._file.close()
+
+    def _write(self, records):
+        self._file.write(''.join('%.6f %s %d\n%s\n' % (timestamp, direction, len(data), data)
+            for timestamp, direction, data in records))
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, i + 1))
+        if self.backup_count:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
+
+def read_capture(path):
+    """Yields (timestamp, direction, data) for each record in a capture file"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.readline()
+            if not header:
+                break
+            timestamp, direction, length = header.split()
+            data = f.read(int(length))
+            f.read(1) # the trailing newline
+            yield float(timestamp), direction, data
+
+def replay(path, stanza_cb, lazy=False):
+    """Feed the inbound side of a capture to a StreamParser, calling stanza_cb for each
+    stanza. The parser is reset whenever the client opened a new stream (ie: after
+    STARTTLS or SASL), as the client does. Returns the number of bytes fed."""
+    parser = StreamParser(stanza_cb=stanza_cb, lazy=lazy)
+    num_bytes = 0
+    for timestamp, direction, data in read_capture(path):
+        if direction == CAPTURE_OUT:
+            if '<stream:stream' in data:
+                parser.reset()
+        else:
+            parser.feed(data)
+            num_bytes += len(data)
+    return num_bytes
+
+def main():
+    tornado.options.define("lazy", type=bool, default=False, help="use lazy stanzas")
+    tornado.options.define("repeat", type=int, default=1, help="times to replay the capture")
+    paths = tornado.options.parse_command_line()
+    for path in paths:
+        stanzas = [0]
+        def stanza_cb(stanza):
+            stanzas[0] += 1
+        start = time.time()
+        num_bytes = 0
+        for i in range(tornado.options.options.repeat):
+            num_bytes += replay(path, stanza_cb, lazy=tornado.options.options.lazy)
+        elapsed = time.time() - start
+        print '%s: %d stanzas, %d bytes in %0.3f sec; %0.0f stanzas/sec' % (
+            path, stanzas[0], num_bytes, elapsed, stanzas[0] / elapsed)
+
+def test_capture_replay():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'traffic.capture')
+        capture = TrafficCapture(path, max_bytes=512, backup_count=1)
+        capture.record(CAPTURE_OUT, '<?xml version="1.0"?><stream:stream to="test">')
+        capture.record(CAPTURE_IN, '<stream:stream xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">')
+        capture.record(CAPTURE_IN, '<message from="a@test"><body>line\nbreak</bo')
+        capture.record(CAPTURE_IN, 'dy></message><presence from="b@test"/>')
+        capture.close()
+        records = list(read_capture(path))
+        assert [direction for timestamp, direction, data in records] == ['>', '<', '<', '<']
+        assert records[2][2] == '<message from="a@test"><body>line\nbreak</bo'
+        stanzas = []
+        replay(path, stanzas.append)
+        assert [stanza.name for stanza in stanzas] == ['message', 'presence']
+        assert stanzas[0].find('body').data == 'line\nbreak'
+
+        capture = TrafficCapture(path, max_bytes=512, backup_count=1)
+        for i in range(20):
+            capture.record(CAPTURE_IN, 'x' * 100)
+        capture.close()
+        assert os.path.exists(path + '.1')
+        assert not os.path.exists(path + '.2')
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Stream compression (XEP-0138). After authenticating, a client with a
+`compression_level` asks for zlib when the server offers it; from the server's
+<compressed/> on, both directions of the stream are compressed.
+
+    >> client.compression_level = 6 # zlib level, 1 (fastest) to 9 (smallest)
+"""
+import zlib
+
+NS_COMPRESS = "http://jabber.org/protocol/compress"
+NS_COMPRESS_FEATURE = "http://jabber.org/features/compress"
+COMPRESS_REQUEST = '<compress xmlns="%s"><method>zlib</method></compress>' % NS_COMPRESS
+
+def offers_zlib(features):
+    """Whether <stream:features/> offers zlib compression"""
+    compression = features.find("compression", [("xmlns", NS_COMPRESS_FEATURE)])
+    return bool(compression) and "zlib" in [child.data for child in compression.children]
+
+class ZlibStream(object):
+    """Both directions of a zlib compressed stream. The compression state carries
+    across writes (so repeated markup compresses well), but the output of each
+    compress() is flushed so the peer can parse every stanza as soon as it arrives.
+
+    `raw_in`/`wire_in` and `raw_out`/`wire_out` count bytes before and after zlib.
+    """
+    def __init__(self, level=6):
+        self.level = level
+        self._compressor = zlib.compressobj(level)
+        self._decompressor = zlib.decompressobj()
+        self.raw_in = self.wire_in = 0
+        self.raw_out = self.wire_out = 0
+
+    def compress(self, data):
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.raw_out += len(data)
+        self.wire_out += len(compressed)
+        return compressed
+
+    def decompress(self, data):
+        """Raises zlib.error if data isn't a valid continuation of the stream"""
+        decompressed = self._decompressor.decompress(data)
+        self.wire_in += len(data)
+        self.raw_in += len(decompressed)
+        return decompressed
+
+    def decompress_pieces(self, data, max_length):
+        """Yields data decompressed, at most max_length bytes at a time"""
+        self.wire_in += len(data)
+        while data:
+            decompressed = self._decompressor.decompress(data, max_length)
+            self.raw_in += len(decompressed)
+            data = self._decompressor.unconsumed_tail
+            if decompressed:
+                yield decompressed
+
+    def ratio(self):
+        """Bytes on the wire per uncompressed byte, both directions together"""
+        raw = self.raw_in + self.raw_out
+        return raw and float(self.wire_in + self.wire_out) / raw or 1.0
+
+def test_zlib_stream():
+    client, server = ZlibStream(), ZlibStream(level=1)
+    stanzas = ['<presence from="a%d@test/r"><c xmlns="http://jabber.org/protocol/caps" ver="x"/></presence>' % i
+        for i in range(50)]
+    # every write can be decompressed on its own, as soon as it's received
+    assert [server.decompress(client.compress(stanza)) for stanza in stanzas] == stanzas
+    assert client.wire_out < client.raw_out / 2 and server.raw_in == client.raw_out
+    assert server.decompress(client.compress('')) == ''
+    data = client.compress('x' * 100000)
+    assert [len(piece) for piece in server.decompress_pieces(data, 40000)] == [40000, 40000, 20000]
+
+def test_client_compression():
+    import time
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    def bound_cb(connection):
+        connection.replay(['<message from="a@test/x"><body>%d</body></message>' % i for i in range(20)])
+    server, port = start_fake_server(io_loop, compression=True, bound_cb=bound_cb,
+        stanza_cb=lambda connection, stanza: received.append(stanza.find("body").data))
+    client = client_for(port, io_loop)
+    client.compression_level = 9
+    messages = []
+    def message_cb(stanza):
+        messages.append(stanza.find("body").data)
+        client.message(to="a@test", body=messages[-1])
+        if len(messages) == 20:
+            io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+    client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=message_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert client.jid == "bot@test/r" and client.compression
+    assert messages == received == [str(i) for i in range(20)]
+    assert client.compression.wire_in < client.compression.raw_in
@@ -0,0 +1,331 @@
+import base64
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import time
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+try:
+    from tornado.tcpserver import TCPServer
+except ImportError:
+    from tornado.netutil import TCPServer # tornado < 3.0
+
+from xmlparse import StreamParser
+from xmpp_compress import NS_COMPRESS, NS_COMPRESS_FEATURE, ZlibStream
+from xmpp_stanza import attr
+
+NS_TLS = "urn:ietf:params:xml:ns:xmpp-tls"
+NS_SASL = "urn:ietf:params:xml:ns:xmpp-sasl"
+NS_BIND = "urn:ietf:params:xml:ns:xmpp-bind"
+NS_ROSTER = "jabber:iq:roster"
+NS_ROSTER_VER = "urn:xmpp:features:rosterver"
+NS_SM = "urn:xmpp:sm:3"
+NS_DISCO_INFO = "http://jabber.org/protocol/disco#info"
+
+STREAM_HEADER = ('<?xml version="1.0"?><stream:stream from="%s" id="%s" version="1.0" '
+    'xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">')
+
+def make_self_signed_cert(directory, common_name="localhost"):
+    """Write a throwaway self-signed certificate and key (with the openssl command) and
+    return (certfile, keyfile)"""
+    certfile = os.path.join(directory, 'fakeserver.crt')
+    keyfile = os.path.join(directory, 'fakeserver.key')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=%s' % common_name, '-keyout', keyfile, '-out', certfile],
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return certfile, keyfile
+
+class FakeXMPPServer(TCPServer):
+    """A minimal in-process XMPP server for tests and benchmarks.
+
+    It runs the session XMPPIOLoopClient expects: stream features, STARTTLS (only when
+    `certfile`/`keyfile` are given; with `direct_tls` connections start with the TLS
+    handshake instead), SASL PLAIN (against `accounts`, a dict of
+    username -> password; anything is accepted when it's None), resource binding and
+    the roster (`roster` is a list of jids; with a `roster_version` the server supports
+    roster versioning, and a request with that version gets an empty result). Other
+    iq get/set requests get an empty
+    result, and message/presence stanzas are passed to `stanza_cb(connection, stanza)`.
+    With `compression` it offers zlib stream compression (XEP-0138) after
+    authentication. With `stream_management` it offers stream management (XEP-0198): it answers acks
+    and lets a client resume its session on a new connection.
+
+    `bound_cb(connection)` is called when a client has bound a resource; use
+    connection.replay() to push scripted stanzas at it.
+
+    >> server = FakeXMPPServer(domain="test", bound_cb=bound_cb)
+    >> server.listen(5222, "127.0.0.1")
+    """
+    def __init__(self, domain="localhost", accounts=None, roster=None, roster_version=None,
+            certfile=None, keyfile=None, direct_tls=False, bound_cb=None, stanza_cb=None, compression=False,
+            stream_management=False, disco=None, io_loop=None):
+        TCPServer.__init__(self, io_loop=io_loop)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.domain = domain
+        self.accounts = accounts
+        self.roster = roster or []
+        self.roster_version = roster_version
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.direct_tls = direct_tls
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+            if getattr(ssl, 'HAS_ALPN', False):
+                self.ssl_context.set_alpn_protocols(["xmpp-client"])
+        self.bound_cb = bound_cb
+        self.stanza_cb = stanza_cb
+        self.compression = compression
+        self.stream_management = stream_management
+        # resumable sessions by id
+        self.sm_sessions = {}
+        self.binds = 0
+        self.connections = []
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # full jid -> the disco#info <query/> it answers with
+        self.disco = disco or {}
+        self.disco_queries = 0
+        self.stanzas_received = 0
+        self._next_id = 0
+
+    def handle_stream(self, stream, address):
+        self._next_id += 1
+        self.connections.append(FakeXMPPConnection(self, stream, address, self._next_id))
+
+    def replay(self, stanzas, **kwargs):
+        """replay() the same stanzas to every bound connection"""
+        stanzas = list(stanzas)
+        for connection in self.connections:
+            if connection.jid:
+                connection.replay(stanzas, **kwargs)
+
+class FakeXMPPConnection(object):
+    """The server side of one client session on a FakeXMPPServer"""
+    def __init__(self, server, stream, address, stream_id):
+        self.server = server
+        self.stream = stream
+        self.address = address
+        self.stream_id = stream_id
+        self.io_loop = server.io_loop
+        self.tls = False
+        self.zlib = None
+        self.username = None
+        self.jid = None
+        # the stream management session id, and the number of stanzas received in it
+        self.sm_id = None
+        self.sm_inbound = 0
+        self.parser = StreamParser(stanza_cb=self._stanza, stream_start_cb=self._stream_start,
+            stream_end_cb=self.close)
+        if server.direct_tls:
+            self._start_tls()
+        else:
+            self._read()
+
+    def _read(self):
+        self.stream.set_close_callback(self._closed)
+        self.stream.read_until_close(lambda data: None, streaming_callback=self._on_data)
+
+    def _on_data(self, data):
+        self.server.bytes_received += len(data)
+        if self.zlib:
+            data = self.zlib.decompress(data)
+        self.parser.feed(data)
+
+    def _closed(self):
+        if self in self.server.connections:
+            self.server.connections.remove(self)
+
+    def close(self):
+        if not self.stream.closed():
+            self.stream.write('</stream:stream>')
+            self.stream.close()
+
+    def write(self, data, callback=None):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.zlib:
+            data = self.zlib.compress(data)
+        self.server.bytes_sent += len(data)
+        if not self.stream.closed():
+            self.stream.write(data, callback)
+
+    def _stream_start(self, name, options):
+        features = []
+        if not self.username:
+            if self.server.certfile and not self.tls:
+                features.append('<starttls xmlns="%s"><required/></starttls>' % NS_TLS)
+            else:
+                features.append('<mechanisms xmlns="%s"><mechanism>PLAIN</mechanism></mechanisms>' % NS_SASL)
+        else:
+            if self.server.compression and not self.zlib:
+                features.append('<compression xmlns="%s"><method>zlib</method></compression>' % NS_COMPRESS_FEATURE)
+            features.append('<bind xmlns="%s"/>' % NS_BIND)
+            if self.server.roster_version:
+                features.append('<ver xmlns="%s"/>' % NS_ROSTER_VER)
+            if self.server.stream_management:
+                features.append('<sm xmlns="%s"/>' % NS_SM)
+        self.write(STREAM_HEADER % (self.server.domain, self.stream_id) +
+            '<stream:features>%s</stream:features>' % ''.join(features))
+
+    def _stanza(self, stanza):
+        self.server.stanzas_received += 1
+        if self.sm_id and stanza.name in ("message", "presence", "iq"):
+            self.sm_inbound += 1
+        if stanza.name == "starttls":
+            # the client waits for <proceed/> before sending anything else
+            self.parser.reset()
+            self.write('<proceed xmlns="%s"/>' % NS_TLS, self._start_tls)
+        elif stanza.name == "auth":
+            self._auth(stanza)
+        elif stanza.name == "compress":
+            # the client opens a new (compressed) stream once it sees <compressed/>
+            self.parser.reset()
+            self.write('<compressed xmlns="%s"/>' % NS_COMPRESS)
+            self.zlib = ZlibStream()
+        elif stanza.name == "iq":
+            self._iq(stanza)
+        elif stanza.name in ("enable", "resume", "r", "a"):
+            self._stream_management(stanza)
+        elif self.server.stanza_cb:
+            self.server.stanza_cb(self, stanza)
+
+    def _start_tls(self):
+        self.io_loop.remove_handler(self.stream.socket.fileno())
+        ssl_socket = self.server.ssl_context.wrap_socket(self.stream.socket, server_side=True,
+            do_handshake_on_connect=False)
+        self.stream = tornado.iostream.SSLIOStream(ssl_socket, io_loop=self.io_loop)
+        self.tls = True
+        self._read()
+
+    def _auth(self, stanza):
+        try:
+            authzid, authcid, password = base64.b64decode(stanza.data).split('\x00')
+        except (TypeError, ValueError):
+            authcid, password = None, None
+        username = authcid and authcid.split('@', 1)[0]
+        accounts = self.server.accounts
+        if not username or (accounts is not None and accounts.get(username) != password):
+            logging.info('fake server: authentication failed for %r', authcid)
+            self.write('<failure xmlns="%s"><not-authorized/></failure>' % NS_SASL)
+            return
+        self.username = username
+        # the client opens a new stream once it sees <success/>
+        self.parser.reset()
+        self.write('<success xmlns="%s"/>' % NS_SASL)
+
+    def _iq(self, stanza):
+        iq_type = stanza.options.get('type')
+        if iq_type not in ("get", "set"):
+            return
+        id_str = stanza.options.get('id')
+        bind = stanza.find("bind")
+        query = stanza.find("query", {"xmlns": NS_ROSTER})
+        body = ''
+        if stanza.find("query", {"xmlns": NS_DISCO_INFO}):
+            self.server.disco_queries += 1
+            body = self.server.disco.get(stanza.options.get('to'), '')
+        if bind and self.username:
+            resource = bind.find("resource")
+            self.jid = '%s@%s/%s' % (self.username, self.server.domain,
+                resource and resource.data or 'fake%d' % self.stream_id)
+            body = '<bind xmlns="%s"><jid>%s</jid></bind>' % (NS_BIND, self.jid)
+            self.server.binds += 1
+        elif query and iq_type == "get":
+            version = self.server.roster_version
+            if not version or query.options.get('ver') != version:
+                items = ''.join('<item jid="%s" subscription="both"/>' % jid for jid in self.server.roster)
+                body = '<query xmlns="%s"%s>%s</query>' % (NS_ROSTER, version and ' ver="%s"' % version or '', items)
+        # requests to a contact are answered as that contact
+        self.write('<iq type="result" id="%s"%s>%s</iq>' % (id_str, attr("from", stanza.options.get('to')), body))
+        if bind and self.jid and self.server.bound_cb:
+            self.server.bound_cb(self)
+
+    def _stream_management(self, stanza):
+        if stanza.name == "r":
+            self.write('<a xmlns="%s" h="%d"/>' % (NS_SM, self.sm_inbound))
+        elif stanza.name == "enable":
+            self.sm_id = 'sm%d' % self.stream_id
+            self.server.sm_sessions[self.sm_id] = self
+            self.write('<enabled xmlns="%s" id="%s" resume="true"/>' % (NS_SM, self.sm_id))
+        elif stanza.name == "resume":
+            previous = self.server.sm_sessions.pop(stanza.options.get('previd'), None)
+            if previous is None or previous.connected():
+                self.write('<failed xmlns="%s"><item-not-found xmlns="urn:ietf:params:xml:ns:xmpp-stanzas"/></failed>' % NS_SM)
+                return
+            self.jid = previous.jid
+            self.sm_id = previous.sm_id
+            self.sm_inbound = previous.sm_inbound
+            self.server.sm_sessions[self.sm_id] = self
+            self.write('<resumed xmlns="%s" previd="%s" h="%d"/>' % (NS_SM, self.sm_id, self.sm_inbound))
+
+    def connected(self):
+        return not self.stream.closed()
+
+    def roster_push(self, jid, subscription="both"):
+        self._next_push = getattr(self, '_next_push', 0) + 1
+        version = self.server.roster_version
+        self.write('<iq type="set" id="push%d"><query xmlns="%s"%s><item jid="%s" subscription="%s"/></query></iq>' % (
+            self._next_push, NS_ROSTER, version and ' ver="%s"' % version or '', jid, subscription))
+
+    def replay(self, stanzas, chunk_size=64 * 1024, callback=None):
+        """Write stanzas (any iterable of strings; a generator is read as it's sent) to
+        the client about `chunk_size` bytes at a time, waiting for each chunk to reach
+        the socket before building the next. callback is called once all are written."""
+        stanzas = iter(stanzas)
+        def write_chunk():
+            chunk = []
+            size = 0
+            for stanza in stanzas:
+                chunk.append(stanza)
+                size += len(stanza)
+                if size >= chunk_size:
+                    break
+            if not chunk:
+                if callback:
+                    callback()
+                return
+            self.write(''.join(chunk), write_chunk)
+        write_chunk()
+
+def start_fake_server(io_loop, domain="test", **kwargs):
+    """Start a FakeXMPPServer (kwargs are FakeXMPPServer's) on a free port on 127.0.0.1.
+    Returns (server, port)"""
+    server = FakeXMPPServer(domain=domain, io_loop=io_loop, **kwargs)
+    sock, = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    server.add_sockets([sock])
+    return server, sock.getsockname()[1]
+
+def client_for(port, io_loop, domain="test", username="bot", password="x", resource="r", **kwargs):
+    """An XMPPIOLoopClient for the fake server on `port`; kwargs are passed on to it"""
+    from xmpp_ioloop import XMPPIOLoopClient
+    return XMPPIOLoopClient("127.0.0.1", port, domain=domain, io_loop=io_loop, username=username,
+        password=password, resource=resource, **kwargs)
+
+def test_fake_server_session():
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    def bound_cb(connection):
+        connection.replay(['<message from="a@test/x"><body>%d</body></message>' % i for i in range(100)])
+    server, port = start_fake_server(io_loop, accounts={"bot": "secret"}, roster=["a@test"],
+        bound_cb=bound_cb, stanza_cb=lambda connection, stanza: received.append(stanza.name))
+
+    client = client_for(port, io_loop, password="secret", resource="bench")
+    messages = []
+    def message_cb(stanza):
+        messages.append(stanza.find("body").data)
+        if len(messages) == 100:
+            client.message(to="a@test", body="done")
+            io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+    client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=message_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert client.jid == "bot@test/bench"
+    assert messages == [str(i) for i in range(100)]
+    assert received == ["message"]
@@ -1,9 +1,31 @@
 import logging
 import base64
-import re
+import time
+from collections import deque
+
+try:
+    from tornado.concurrent import Future
+except ImportError:
+    # tornado < 3.0: a future that can't be yielded in a coroutine; use iq_request's
+    # callback with tornado.gen.Task there
+    from xmpp_offload import SimpleFuture as Future
+
+from xmpp_compress import COMPRESS_REQUEST, offers_zlib
+from xmpp_jid import JID
+from xmpp_roster import NS_ROSTER_VER
+from xmpp_stanza import attr, escape
 
-from xmlparse import xml2list
 ALL_TAGS = "_ALL_TAGS_"
+NS_STANZAS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+class IQError(Exception):
+    """An iq request failed. stanza is the type="error" response, if there was one"""
+    def __init__(self, message, stanza=None):
+        Exception.__init__(self, message)
+        self.stanza = stanza
+
+class IQTimeout(IQError):
+    pass
 
 
 
@@ -11,42 +33,52 @@ class Handler(object):
     def initialize(self, client):
         self.client = client
     
-    def handle(self, data, content=None):
+    def handle(self, stanza):
         raise NotImplemented
 
 class SingleTagHandler(Handler):
-    def handle(self, data, content=None):
-        # logging.debug('%r %r', data, content)
+    def handle(self, stanza):
+        # logging.debug('%r', stanza)
         self.client.remove_handler(self)
-        return True
 
 class MessageHandler(Handler):
-    """Reads an incoming message, calling the client message_cb"""
-    def handle(self, data, content=None):
-        self.data = [data]
-        if content:
-            self.data.append(content)
-        self.client.read_until("</message>", self._finish_message)
-    
-    def _finish_message(self, data):
-        self.data.append(data)
-        message = ''.join(self.data)
-        logging.debug('Message: %r', message)
-        xml = xml2list(message)[0]
-        # logging.debug(xml)
-        self.client.message_cb(xml)
-        self.client.read_next() # give control back to the client
+    """Handles an incoming message, calling the client message_cb"""
+    def handle(self, stanza):
+        if self.client.debug_logging:
+            logging.debug('Message: %r', stanza)
+        if self.client.offload:
+            self.client.offload.dispatch(self.client.message_cb, stanza)
+        else:
+            self.client.message_cb(stanza)
+
+class PendingIQ(object):
+    __slots__ = 'id', 'send', 'timeout', 'future', 'callback', 'timeout_handle', 'sent', 'to'
+    def __init__(self, id, send, timeout, future, callback, to=None):
+        self.id = id
+        self.to = to
+        self.send = send
+        self.timeout = timeout
+        self.future = future
+        self.callback = callback
+        self.timeout_handle = None
+        self.sent = None
 
 class IQHandler(Handler):
-    """Reads an iq message, and calls any registered callbacks"""
-    def __init__(self):
-        self._handlers = {}
+    """Handles an iq message, and calls any registered callbacks.
     
-    def handle(self, data, content=None):
-        self.data = [data]
-        if content:
-            self.data.append(content)
-        self.client.read_until("</iq>", self._finish_message)
+    `request` tracks outstanding requests by id in a pending table. Each expires
+    after its timeout, and at most `max_in_flight` are sent at once; the rest wait
+    in order for a slot (or for the connection). A response only matches a request
+    if it comes from the jid the request was sent to, so a contact can't answer
+    (ie: forge a roster result for) a request it didn't get.
+    """
+    def __init__(self, max_in_flight=256, timeout=30):
+        self._handlers = {}
+        self._request_handlers = {}
+        self._pending = {}
+        self._waiting = deque()
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
     
     def add_handler(self, for_id, callback):
         if isinstance(for_id, (int, long)):
@@ -54,44 +86,177 @@ class IQHandler(Handler):
         assert for_id not in self._handlers
         self._handlers[for_id] = callback
     
-    def _finish_message(self, data):
-        for_id = re.findall(r'id="(.*?)"', self.data[0])[0]
-        self.data.append(data)
-        message = ''.join(self.data)
-        logging.debug('IQ: %r', message)
+    def add_request_handler(self, xmlns, callback):
+        """Call callback(stanza) for iq get/set requests with a child in namespace
+        `xmlns`; it's responsible for sending the response"""
+        self._request_handlers[xmlns] = callback
+    
+    def remove_request_handler(self, xmlns):
+        self._request_handlers.pop(xmlns, None)
+    
+    def request(self, for_id, send, timeout=None, callback=None, to=None):
+        """Call send() to write an iq request with id `for_id`. Returns a Future for the
+        response, or with a callback, calls callback with the response stanza (or None if
+        the request timed out or the connection closed) and returns None. `to` is the jid
+        the request is sent to (None for our own account, ie: the roster)."""
+        for_id = str(for_id)
+        assert for_id not in self._pending
+        # no future when there's a callback: nothing would retrieve its exception
+        future = None if callback else Future()
+        pending = PendingIQ(for_id, send, timeout or self.timeout, future, callback, to)
+        self._waiting.append(pending)
+        self.send_waiting()
+        return future
+    
+    def in_flight(self):
+        return len(self._pending)
+    
+    def queued(self):
+        return len(self._waiting)
+    
+    def send_waiting(self):
+        """Send waiting requests while there is room in the pending table"""
+        if not self.client.connected:
+            return
+        io_loop = self.client.io_loop
+        while self._waiting and len(self._pending) < self.max_in_flight:
+            pending = self._waiting.popleft()
+            self._pending[pending.id] = pending
+            pending.timeout_handle = io_loop.add_timeout(time.time() + pending.timeout,
+                lambda pending=pending: self._expire(pending))
+            pending.sent = time.time()
+            pending.send()
+    
+    def _expire(self, pending):
+        if self._pending.get(pending.id) is not pending:
+            return
+        del self._pending[pending.id]
+        logging.warning('iq %s timed out after %0.2f seconds', pending.id, pending.timeout)
+        if self.client.metrics:
+            self.client.metrics.incr('iq_timeouts')
+        self._finish(pending, None, IQTimeout("iq %s timed out" % pending.id))
+        self.send_waiting()
+    
+    def _finish(self, pending, stanza, error=None):
+        if pending.timeout_handle:
+            self.client.io_loop.remove_timeout(pending.timeout_handle)
+            pending.timeout_handle = None
+        if pending.future:
+            if error:
+                pending.future.set_exception(error)
+            else:
+                pending.future.set_result(stanza)
+        if pending.callback:
+            pending.callback(stanza)
+    
+    def fail(self, for_id, reason, sender=None):
+        """Fail the request in flight with id `for_id` (if there is one, and if given, its
+        response is from `sender`)"""
+        pending = self._pending.get(str(for_id))
+        if pending is None or (sender is not None and not self._responds(pending, sender)):
+            return
+        del self._pending[pending.id]
+        self._finish(pending, None, IQError("iq %s failed: %s" % (pending.id, reason)))
+        self.send_waiting()
+    
+    def _responds(self, pending, sender):
+        # RFC 6120 8.1.2.1: a request without a `to` is handled by the server for our
+        # account, which responds without a from, or from our bare jid or domain
+        if pending.to:
+            return bool(sender) and JID(sender) == JID(pending.to)
+        if not sender:
+            return True
+        sender = JID(sender)
+        own = JID(self.client.jid)
+        return sender is own.bare_jid or sender.full == own.domain
+
+    def fail_pending(self, reason):
+        """Fail everything in flight (ie: when the stream closes); waiting requests are
+        sent once connected again"""
+        pending_iqs, self._pending = self._pending.values(), {}
+        for pending in pending_iqs:
+            self._finish(pending, None, IQError("iq %s failed: %s" % (pending.id, reason)))
+    
+    def handle(self, stanza):
+        if self.client.debug_logging:
+            logging.debug('IQ: %r', stanza)
+        for_id = stanza.options.get('id')
         
         # if we have a match
         if for_id in self._handlers:
             callback = self._handlers.pop(for_id)
-            xml = xml2list(message)[0]
-            # logging.debug(xml)
-            callback(xml)
+            callback(stanza)
+            return
         
-        self.client.read_next() # give control back to the client
+        iq_type = stanza.options.get('type')
+        if iq_type in ('result', 'error'):
+            pending = self._pending.get(for_id)
+            if pending is None or not self._responds(pending, stanza.options.get('from')):
+                logging.warning('unmatched iq %s %r', iq_type, stanza)
+                return
+            del self._pending[for_id]
+            if self.client.metrics:
+                self.client.metrics.iq_round_trip(time.time() - pending.sent)
+            error = None
+            if iq_type == 'error':
+                error = IQError("iq %s returned an error" % for_id, stanza)
+            self._finish(pending, stanza, error)
+            self.send_waiting()
+        elif iq_type in ('get', 'set'):
+            for child in stanza.children:
+                callback = self._request_handlers.get(child.options.get('xmlns'))
+                if callback:
+                    callback(stanza)
+                    return
+            # requests we don't handle get an error response (RFC 6120 8.2.3)
+            logging.debug('unhandled iq %s %r', iq_type, stanza)
+            attrs = attr("to", stanza.options.get('from'))
+            body = '<error type="cancel"><service-unavailable xmlns="%s"/></error>' % NS_STANZAS
+            self.client.iq(type="error", id_str=for_id, attrs=attrs, body=body)
 
 class PresenceHandler(Handler):
-    def handle(self, data, content=None):
-        if data.endswith("/>"):
-            logging.debug('Presence: %r', data)
-            xml = xml2list(data)[0]
-            # logging.debug(xml)
-            self.client.presence_cb(xml)
-            return True
+    def handle(self, stanza):
+        if self.client.debug_logging:
+            logging.debug('Presence: %r', stanza)
+        if self.client.presence_coalescer:
+            self.client.presence_coalescer.received(stanza, self)
+        else:
+            self.deliver(stanza)
+    
+    def update(self, stanza):
+        """Update the roster (and caps) from a presence stanza"""
+        if self.client.roster is not None:
+            self.client.roster.update_presence(stanza)
+        if self.client.caps:
+            self.client.caps.update_presence(stanza)
+    
+    def deliver(self, stanza):
+        self.update(stanza)
+        if self.client.offload:
+            self.client.offload.dispatch(self.client.presence_cb, stanza)
+        else:
+            self.client.presence_cb(stanza)
+
+class StartTLSHandler(Handler):
+    """Waits for the <proceed/> response to a <starttls/> request"""
+    def handle(self, stanza):
+        self.client.remove_handler(self)
+        self.client.finish_tls_upgrade(stanza)
+
+class CompressHandler(Handler):
+    """Waits for the response to a <compress/> request; without compression the
+    session starts on the current stream"""
+    def __init__(self, features_handler, features):
+        self.features_handler = features_handler
+        self.features = features
+    
+    def handle(self, stanza):
+        self.client.remove_handler(self)
+        if stanza.name == "compressed":
+            self.client.start_compression()
         else:
-            self.data = [data]
-        if content:
-            self.data.append(content)
-            
-        self.client.read_until("</presence>", self._finish_message)
-    
-    def _finish_message(self, data):
-        self.data.append(data)
-        message = ''.join(self.data)
-        logging.debug('Presence: %r', message)
-        xml = xml2list(message)[0]
-        # logging.debug(xml)
-        self.client.presence_cb(xml)
-        self.client.read_next() # give control back to the client
+            logging.warning('server refused stream compression: %r', stanza)
+            self.features_handler.start_session(self.features)
 
 class AuthHandler(Handler):
     def initialize(self, client):
@@ -102,33 +267,26 @@ class AuthHandler(Handler):
         jid_domain_change = ''' xmlns:ga="http://www.google.com/talk/protocol/auth" ga:client-uses-full-bind-result="true"'''
         self.client.write("""<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" mechanism="PLAIN"%s>%s</auth>""" % (jid_domain_change, auth_str))
 
-    def handle(self, data, content=None):
-        # logging.debug('data: %r content: %r', data, content)
-        if not data.startswith("<success "):
-            logging.error(data)
-            return self.client.stream.read_until_close(logging.error)
+    def handle(self, stanza):
+        # logging.debug('stanza: %r', stanza)
+        if stanza.name != "success":
+            logging.error('authentication failed %r', stanza)
+            self.client.stream.close()
+            return
         self.client.remove_handler(self)
         
         # http://code.google.com/apis/talk/jep_extensions/jid_domain_change.html
-        self.client.write("""<stream:stream to="%s" version="1.0" xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">""" % self.client.domain)
-        self.client.push_handler("stream:features", FeaturesHandler())
-        self.client.push_handler("stream:stream", SingleTagHandler())
-        return True
+        self.client.initialize_stream()
         
 
 class ReadLoopHandler(Handler):
-    def handle(self, data, content=None):
-        logging.debug('ReadLoopHandler: data: %r content: %r', data, content)
-        return True
+    def handle(self, stanza):
+        logging.debug('ReadLoopHandler: %r', stanza)
 
 class FeaturesHandler(Handler):
-    def handle(self, data, content=None):
-        # logging.debug('data: %r', data)
-        self.client.read_until("</stream:features>", self._finish_features)
-    
     def _finish_bind(self, data):
         # logging.debug('_finish_bind:.... %r', data)
-        self.client.pop_handlers() # remove the iq handler
+        self.client.remove_handler(self.iq_handler)
         
         # <iq id="2" type="result"><bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><jid>user@domain/jid1802227C</jid></bind></iq>
         jid = data.find("jid").data
@@ -145,35 +303,199 @@ class FeaturesHandler(Handler):
             # #self.client. write("""<iq from="%s" type="get" id="google-roster-1">%s</iq>""" % (self.client.jid, query))
             # self.client.iq(type="get", id_str="google-roster-1", from_str=True, body=query)
             # # [request]    <iq type="get" id="3" from="-[removed]@chat.facebook.com/[removed]"><query xmlns="jabber:iq:roster"/></iq>
-        self.client.iq(type="get", id_str=self.client.get_sequence(), from_str=True, body='<query xmlns="jabber:iq:roster"/>')
+        self.client.request_roster()
         self.client.set_connected()
     
-    def _finish_features(self, data):
-        logging.debug('features: %r' % data)
-        data = re.sub('[\n\r]', '', data)
-        if '<starttls' in data:
+    def handle(self, stanza):
+        logging.debug('features: %r', stanza)
+        mechanisms = stanza.find("mechanisms")
+        if stanza.find("starttls"):
             self.client.remove_handler(self)
             self.client.upgrade_to_tls()
         
-        elif '<mechanism>PLAIN</mechanism>' in data:
+        elif mechanisms and "PLAIN" in [child.data for child in mechanisms.children]:
             # logging.debug('start auth')
             self.client.remove_handler(self)
             self.client.add_handler(ALL_TAGS, AuthHandler())
-            self.client.read_next() # give control back to the client
-        elif '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/>' in data:
+        elif stanza.find("bind", [("xmlns", "urn:ietf:params:xml:ns:xmpp-bind")]):
             # initiate a bind
             # bind_id = uuid.uuid4().hex
-            resource = self.client.resource
-            logging.info('binding to resource %r' % resource)
-            body = """<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><resource>%s</resource></bind>""" % resource
-            id_str = self.client.get_sequence()
-            self.client.iq(type="set", id_str=id_str, body=body)
-            
-            iq_handler = IQHandler()
-            self.client.push_handler("iq", iq_handler)
-            iq_handler.add_handler(id_str, self._finish_bind)
-            self.client.read_next() # give control back to the client
-
-            return True
+            self.client.remove_handler(self)
+            if self.client.compression_level is not None and not self.client.compression and offers_zlib(stanza):
+                logging.info('starting stream compression')
+                self.client.add_handler(ALL_TAGS, CompressHandler(self, stanza))
+                self.client.write(COMPRESS_REQUEST)
+                return
+            self.start_session(stanza)
         else:
             raise NotImplemented
+    
+    def start_session(self, stanza):
+        """Resume the previous session (with stream management) or bind a new one"""
+        self.client.roster_versioning = bool(stanza.find("ver", [("xmlns", NS_ROSTER_VER)]))
+        sm = self.client.sm
+        if sm:
+            sm.features(stanza)
+            # resuming the previous session skips binding (and the roster fetch)
+            if sm.try_resume(fallback=self.bind):
+                return
+        self.bind()
+    
+    def bind(self):
+        resource = self.client.resource
+        logging.info('binding to resource %r' % resource)
+        body = """<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"><resource>%s</resource></bind>""" % escape(resource)
+        id_str = self.client.get_sequence()
+        
+        self.iq_handler = IQHandler()
+        self.client.add_handler("iq", self.iq_handler)
+        self.iq_handler.add_handler(id_str, self._finish_bind)
+        self.client.iq(type="set", id_str=id_str, body=body)
+
+def test_iq_handler():
+    import tornado.ioloop
+    from xmlparse import XmlBLock
+    io_loop = tornado.ioloop.IOLoop()
+    class Client(object):
+        connected = False
+        metrics = None
+        debug_logging = False
+        jid = 'bot@test/r'
+    client = Client()
+    client.io_loop = io_loop
+    handler = IQHandler(max_in_flight=2, timeout=0.1)
+    handler.initialize(client)
+    sent = []
+    responses = []
+    def request(for_id, timeout=None):
+        def done(future):
+            try:
+                stanza = future.result()
+            except IQError, e:
+                stanza = e.stanza
+            responses.append((for_id, stanza and stanza.options['type']))
+        future = handler.request(for_id, lambda: sent.append(for_id), timeout=timeout)
+        future.add_done_callback(done)
+        return future
+    def response(for_id, type="result"):
+        handler.handle(XmlBLock("iq", options={'id': for_id, 'type': type}))
+    futures = dict((for_id, request(for_id, timeout=for_id == '3' and 0.05 or 5)) for for_id in '12345')
+    # nothing is sent until connected, then max_in_flight at a time
+    assert sent == [] and handler.queued() == 5
+    client.connected = True
+    handler.send_waiting()
+    assert sent == ['1', '2'] and handler.in_flight() == 2 and handler.queued() == 3
+    # responses are matched by id, in any order
+    response('2')
+    assert sent == ['1', '2', '3'] and responses == [('2', 'result')]
+    assert futures['2'].result().options['id'] == '2'
+    response('1', type="error")
+    assert sent == ['1', '2', '3', '4'] and responses[-1] == ('1', 'error')
+    try:
+        futures['1'].result()
+        assert False, "an error response should raise"
+    except IQError, e:
+        assert not isinstance(e, IQTimeout) and e.stanza.options['id'] == '1'
+    # unknown ids are ignored
+    response('9')
+    assert handler.in_flight() == 2
+    # 3 times out, which frees its slot for 5
+    io_loop.add_timeout(time.time() + 0.2, io_loop.stop)
+    io_loop.start()
+    assert responses[-1] == ('3', None) and sent[-1] == '5'
+    try:
+        futures['3'].result()
+        assert False, "a timed out request should raise"
+    except IQTimeout:
+        pass
+    # a late response to it is ignored
+    response('3')
+    assert responses[-1] == ('3', None)
+    # the stream closes: everything in flight fails, the rest waits for the next session
+    request('6')
+    client.connected = False
+    handler.fail_pending("stream closed")
+    assert sorted(responses[-2:]) == [('4', None), ('5', None)] and handler.in_flight() == 0
+    for for_id in '45':
+        try:
+            futures[for_id].result()
+            assert False, "a failed request should raise"
+        except IQError, e:
+            assert 'stream closed' in str(e)
+    assert handler.queued() == 1
+    client.connected = True
+    handler.send_waiting()
+    assert sent[-1] == '6' and handler.in_flight() == 1
+
+def test_iq_handler_callbacks():
+    import gc
+    import tornado.ioloop
+    from xmlparse import XmlBLock
+    io_loop = tornado.ioloop.IOLoop()
+    class Client(object):
+        connected = True
+        metrics = None
+        debug_logging = False
+        jid = 'bot@test/r'
+    client = Client()
+    client.io_loop = io_loop
+    handler = IQHandler(timeout=0.05)
+    handler.initialize(client)
+    class Errors(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self, logging.ERROR)
+            self.records = []
+        def emit(self, record):
+            self.records.append(record)
+    errors = Errors()
+    logging.getLogger().addHandler(errors)
+    try:
+        responses = []
+        for for_id in '123':
+            assert handler.request(for_id, lambda: None, callback=responses.append) is None
+        # an error response, a timeout and a closed stream
+        handler.handle(XmlBLock("iq", options={'id': '1', 'type': 'error'}))
+        io_loop.add_timeout(time.time() + 0.03, lambda: handler.fail('2', 'stream closed'))
+        io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+        io_loop.start()
+        assert responses[0].options['type'] == 'error' and responses[1:] == [None, None]
+        # tornado logs the exceptions of futures that are never retrieved when they're collected
+        gc.collect()
+        assert errors.records == []
+    finally:
+        logging.getLogger().removeHandler(errors)
+
+def test_iq_spoofing():
+    import tornado.ioloop
+    from xmlparse import XmlBLock
+    class Client(object):
+        connected = True
+        metrics = None
+        debug_logging = False
+        jid = 'bot@test/r'
+        io_loop = tornado.ioloop.IOLoop()
+    handler = IQHandler()
+    handler.initialize(Client())
+    responses = []
+    def response(for_id, sender):
+        options = {'id': for_id, 'type': 'result'}
+        if sender:
+            options['from'] = sender
+        handler.handle(XmlBLock("iq", options=options))
+    for for_id, to in ('roster', None), ('roster2', None), ('roster3', None), ('disco', 'c@test/x'):
+        handler.request(for_id, lambda: None, to=to, callback=lambda stanza: responses.append(
+            (stanza.options['id'], stanza.options.get('from'))))
+    # anyone else answering is ignored
+    for sender in 'mallory@test/x', 'bot@test/other', 'c@test', 'test.evil':
+        response('roster', sender)
+        response('disco', sender)
+    handler.fail('disco', 'response too big', sender='mallory@test/x')
+    assert responses == [] and handler.in_flight() == 4
+    # the server answers for our account with no from, our bare jid or our domain
+    response('roster', None)
+    response('roster2', 'Bot@test')
+    response('roster3', 'test')
+    # the contact a request went to answers it
+    response('disco', 'C@test/x')
+    assert responses == [('roster', None), ('roster2', 'Bot@test'), ('roster3', 'test'), ('disco', 'C@test/x')]
+    assert handler.in_flight() == 0
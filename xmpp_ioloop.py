@@ -1,7 +1,9 @@
+import functools
 import logging
-import socket
-import ssl
 import time
+import zlib
+from collections import deque
+from xml.parsers import expat
 
 import tornado.iostream
 import tornado.ioloop
@@ -10,12 +12,23 @@ import tornado.ioloop
 # the version from tornado 1.2 does not support ssl.PROTOCOL_TLSv1 properly
 assert tornado.version_info >= (2, 1), "XMPPIOLoopClient is incompatible with this version tornado ioloop"
 
-from xmpp_handlers import Handler, MessageHandler, IQHandler, PresenceHandler, FeaturesHandler, ALL_TAGS
+from xmlparse import StreamParser
+from xmpp_capture import CAPTURE_IN, CAPTURE_OUT
+from xmpp_compress import ZlibStream
+from xmpp_jid import JID
+from xmpp_offload import ThreadSafeClient
+from xmpp_resolver import Connector, Resolver, SRV_SERVICE
+from xmpp_roster import NS_ROSTER, Roster
+from xmpp_stanza import attr, iq_stanza, message_stanza, presence_stanza
+from xmpp_tls import DIRECT_TLS_SRV_SERVICE, NS_TLS, TLSIOStream, default_context, wrap_socket
+from xmpp_scheduler import PRIORITY_IQ, PRIORITY_PRESENCE, PRIORITY_MESSAGE
+from xmpp_handlers import Handler, MessageHandler, IQHandler, PresenceHandler, FeaturesHandler, StartTLSHandler, ALL_TAGS, NS_STANZAS
 NS_CLIENT = 'jabber:client'
 NS_STREAM = 'http://etherx.jabber.org/streams'
 
 class XMPPIOLoopClient(object):
-    def __init__(self, host, port=5222, domain=None, io_loop=None, username=None, password=None, resource=None):
+    def __init__(self, host, port=5222, domain=None, io_loop=None, username=None, password=None, resource=None,
+            lazy_stanzas=False, compact_attributes=False):
         self.host = host
         self.port = port
         self.domain = domain or host
@@ -24,27 +37,143 @@ class XMPPIOLoopClient(object):
         self.resource = resource
         self._jid = username + '@' + domain + '/' + resource
         self._full_jid = None
+        # prebuilt from="jid" for outbound stanzas
+        self._from_attr = attr("from", self._jid)
         self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.read_chunk_size = 4096
+        # with lazy_stanzas callbacks get a LazyXmlBLock; children are only parsed when accessed.
+        # with compact_attributes stanza options are read only Attributes (see xmlparse)
+        self.parser = StreamParser(stanza_cb=self._start_tag,
+            stream_start_cb=self._finish_connection, stream_end_cb=self.stream_end_cb, lazy=lazy_stanzas,
+            oversize_cb=self._oversize_stanza, compact_attributes=compact_attributes)
         
-        self._current_processors = []
-        self._process_stack = []
+        # inbound limits. stanzas over max_stanza_size bytes are dropped (oversize_policy
+        # "drop"; an iq request gets a policy-violation error) or close the stream
+        # ("close"). Once connected, parsed stanzas wait in a queue and are dispatched
+        # dispatch_batch per IOLoop iteration; reading from the socket pauses while
+        # max_dispatch_queue are waiting, so a slow consumer backs the server up instead
+        # of growing memory. max_buffer_size bounds the IOStream's read buffer (tornado
+        # reads everything the socket has buffered at once, so it has to be bigger than
+        # the socket's receive buffer).
+        self.max_stanza_size = None
+        self.oversize_policy = "drop"
+        self.max_dispatch_queue = 1000
+        self.dispatch_batch = 100
+        self.max_buffer_size = 100 * 1024 * 1024
+        self._dispatch_queue = deque()
+        self._drain_scheduled = False
+        self._reading_paused = False
+        # set to a xmpp_offload.CallbackOffload() to run message_cb and presence_cb in an
+        # executor; those callbacks then use client.threadsafe to call the client
+        self.offload = None
+        self._threadsafe = None
+        # a queued stanza being parsed by the offload; the rest of the queue waits for it
+        self._dispatch_waiting = None
+        
+        # a stack of handler layers; each maps tag name (or ALL_TAGS) to a handler
+        self._handler_layers = [{}]
+        self._namespace_handlers = {}
         self._connected = False
         self._sequence = 1
         self.autoreconnect = True
         self.autoreconnect_tries = 0
         self.autoreconnect_last_connect = None
+        # hostnames (and SRV records, with use_srv) are looked up without blocking the
+        # IOLoop; clients on the same IOLoop can share a resolver
+        self.resolver = Resolver(self.io_loop)
+        self.use_srv = False
+        self.connect_attempt_delay = 0.25
+        self.connect_timeout = 30
+        # TLS: None uses xmpp_tls.default_context(); with direct_tls the connection
+        # starts with the TLS handshake instead of STARTTLS (ie: port 5223)
+        self.ssl_context = None
+        self.direct_tls = False
+        # set to a zlib level to use stream compression (XEP-0138) when the server offers
+        # it; while it's on, compression is the connection's xmpp_compress.ZlibStream
+        self.compression_level = None
+        self.compression = None
+        
+        # write coalescing: stanzas written in the same IOLoop iteration (or within
+        # write_latency seconds) are sent to the stream as a single write
+        self.coalesce_writes = False
+        self.write_buffer_max = 64 * 1024
+        self.write_latency = 0
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._flush_timeout = None
+        self._flush_scheduled = False
+        # an optional xmpp_scheduler.OutboundScheduler that rate limits presence(), iq() and message()
+        self.scheduler = None
+        # set to a xmpp_metrics.ClientMetrics() to collect counters and timings
+        self.metrics = None
+        # contacts and their presence; set to None to not keep track
+        self.roster = Roster()
+        self.roster_versioning = False
+        # set to a xmpp_presence.PresenceCoalescer() to drop repeated presence (and batch the rest)
+        self.presence_coalescer = None
+        # set to a xmpp_caps.CapsCache() to discover (and remember) contacts' capabilities
+        self.caps = None
+        # set to a xmpp_capture.TrafficCapture() to record raw traffic to disk
+        self.capture = None
+        # set to a xmpp_sm.StreamManagement() for stanza acks and session resumption
+        self.sm = None
+        self.update_log_level()
+        # outstanding iq_request()s live across reconnects
+        self.iq_handler = IQHandler()
+        self.iq_handler.initialize(self)
+        self.iq_handler.add_request_handler(NS_ROSTER, self._roster_push)
     
     @property
     def jid(self):
-        return self._full_jid or self.jid
+        return self._full_jid or self._jid
+    
+    @property
+    def connected(self):
+        return self._connected
+    
+    @property
+    def threadsafe(self):
+        """Calls client methods from other threads (ie: offloaded callbacks), running them on the IOLoop"""
+        if self._threadsafe is None:
+            self._threadsafe = ThreadSafeClient(self)
+        return self._threadsafe
+    
+    def queued(self):
+        """The number of stanzas waiting to be written (rate limited, coalesced or in the stream buffer)"""
+        queued = len(self._write_buffer)
+        if self.scheduler:
+            queued += self.scheduler.queue_depth()
+        if self._connected and self.stream.writing():
+            queued += 1
+        return queued
     
     def set_jid(self, jid):
         assert jid.startswith(self._jid[:10]) # it seems to always have the same 10 char's anyway
         self._full_jid = jid
+        self._from_attr = attr("from", jid)
     
     def stream_close_cb(self):
+        # stanzas that arrived before the close are still handled
+        if self._dispatch_waiting:
+            stanza, self._dispatch_waiting = self._dispatch_waiting, None
+            self._handle_stanza(stanza)
+        if self._dispatch_queue:
+            self._drain_dispatch_queue(len(self._dispatch_queue))
         self._connected = False
+        if self.metrics:
+            self.metrics.disconnected()
         logging.warning('xmpp stream closed')
+        if self.sm:
+            self.sm.closed()
+        # a session that can be resumed keeps its pending requests and presence
+        if not (self.sm and self.sm.resumable()):
+            self.iq_handler.fail_pending("stream closed")
+            if self.presence_coalescer:
+                self.presence_coalescer.clear()
+            if self.caps:
+                self.caps.clear_presence()
+            if self.roster is not None:
+                self.roster.clear_presence()
         if self.close_cb:
             self.close_cb()
         
@@ -65,28 +194,46 @@ class XMPPIOLoopClient(object):
                 logging.warning('reconnecting in %0.2f seconds', min_connect_time - now)
                 self.io_loop.add_timeout(min_connect_time, self._connect)
     
+    def stream_end_cb(self):
+        logging.warning('xmpp stream ended by server')
+        self.stream.close()
+    
     
     ##########
     def push_handler(self, tag, handler):
-        if self._current_processors:
-            self._process_stack.insert(0, self._current_processors)
-            self._current_processors = []
+        """Add handler in a new layer, on top of the current handlers"""
+        if self._handler_layers[-1]:
+            self._handler_layers.append({})
         self.add_handler(tag, handler)
     
     def pop_handlers(self):
-        if not self._process_stack:
+        if len(self._handler_layers) < 2:
             raise Exception("No handlers defined")
-        self._current_processors = self._process_stack.pop()
+        self._handler_layers.pop()
     
     def add_handler(self, tag, handler):
+        """Handle stanzas named `tag` (or any stanza for ALL_TAGS) with handler"""
         handler.initialize(self)
-        self._current_processors.append((tag, handler))
+        self._handler_layers[-1][tag] = handler
     
     def remove_handler(self, tag, klass=None):
+        """Remove a handler (by handler instance, or by tag) from the current layer"""
+        layer = self._handler_layers[-1]
         if isinstance(tag, Handler):
-            self._current_processors = [(t, k) for t, k in self._current_processors if k is not tag]
-        else:
-            self._current_processors = [(t, k) for t, k in self._current_processors if t != tag and k is not klass]
+            for key, handler in layer.items():
+                if handler is tag:
+                    del layer[key]
+        elif tag in layer and (klass is None or isinstance(layer[tag], klass)):
+            del layer[tag]
+    
+    def add_namespace_handler(self, xmlns, callback):
+        """Call callback(stanza) for message, presence and iq get/set stanzas with a child
+        element in namespace `xmlns` (ie: pubsub events or MUC) instead of the regular
+        handler. iq results and errors always go to iq_request()."""
+        self._namespace_handlers[xmlns] = callback
+    
+    def remove_namespace_handler(self, xmlns):
+        self._namespace_handlers.pop(xmlns, None)
         
     ########
     def connect(self, connect_cb, presence_cb, message_cb, close_cb=None):
@@ -102,52 +249,206 @@ class XMPPIOLoopClient(object):
         self.close_cb = close_cb
         self._connect()
     
+    def update_log_level(self):
+        """Whether to debug log each stanza is cached for the hot paths; call this after
+        changing the log level (it's also checked on each connect)"""
+        self.debug_logging = logging.getLogger().isEnabledFor(logging.DEBUG)
+    
     def _connect(self):
+        self.update_log_level()
         self._connected = False
         self._full_jid = None
-        self._current_processors = []
-        self._process_stack = []
+        self._handler_layers = [{}]
+        self._clear_write_buffer()
+        self.compression = None
+        self.parser.max_stanza_size = self.max_stanza_size
+        self._reading_paused = False
+        self._dispatch_waiting = None
         self.autoreconnect_last_connect = time.time()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        self.stream = tornado.iostream.IOStream(self.socket)
+        if self.use_srv:
+            # connect to the domain's _xmpp-client._tcp SRV targets (host:port if it has none)
+            self.resolver.resolve_srv(self.domain, self._resolve_targets,
+                service=self.direct_tls and DIRECT_TLS_SRV_SERVICE or SRV_SERVICE)
+        else:
+            self._resolve_targets([])
+    
+    def _resolve_targets(self, targets):
+        targets = targets or [(self.host, self.port)]
+        logging.info('connecting to %r' % targets)
+        self.resolver.resolve_many(targets, self._start_connect)
+    
+    def _start_connect(self, addresses):
+        if not addresses:
+            logging.error('could not resolve %r', self.use_srv and self.domain or self.host)
+            self.stream_close_cb()
+            return
+        Connector(addresses, self._finish_connect, io_loop=self.io_loop, attempt_delay=self.connect_attempt_delay,
+            timeout=self.connect_timeout, max_buffer_size=self.max_buffer_size).start()
+    
+    def _finish_connect(self, stream):
+        if stream is None:
+            # reconnects like a stream that closed
+            self.stream_close_cb()
+            return
+        self.stream = stream
+        self.socket = stream.socket
         self.stream.set_close_callback(self.stream_close_cb)
-        logging.info('connecting to %r %r' % (self.host, self.port))
-        self.stream.connect((self.host, self.port), self.initialize_stream)
+        if self.direct_tls:
+            self._start_tls()
+        self.initialize_stream()
+        self.read_next()
     
     def read_next(self):
-        # logging.debug('read_next tag')
+        """Reads the next chunk from the socket. Data is passed to the stream parser as it
+        arrives, so a single read can dispatch any number of stanzas"""
+        # logging.debug('read_next chunk')
         try:
-            self.stream.read_until(">", self._start_tag)
+            self.stream.read_bytes(self.read_chunk_size, self._finish_read, streaming_callback=self._on_data)
         except IOError:
             logging.exception('socket error')
     
-    def read_until(self, tag, callback):
-        # logging.debug('reading till %r', tag)
+    def _finish_read(self, data):
+        # data was already consumed by the streaming callback
+        if len(self._dispatch_queue) >= self.max_dispatch_queue or (self.offload and self.offload.full()):
+            # _resume_reading() reads again once the queue (and the offload) has caught up
+            self._reading_paused = True
+            return
+        self.read_next()
+    
+    def _on_data(self, data):
+        if self.compression:
+            try:
+                # inflated a piece at a time, so a small read can't become a huge string
+                for piece in self.compression.decompress_pieces(data, self.read_chunk_size * 16):
+                    self._feed(piece)
+            except zlib.error:
+                logging.exception('invalid compressed data from server')
+                self.stream.close()
+            return
+        self._feed(data)
+    
+    def _feed(self, data):
+        if self.capture:
+            self.capture.record(CAPTURE_IN, data)
+        metrics = self.metrics
+        if metrics:
+            start = time.time()
+            callback_time = metrics.callback_time
         try:
-            self.stream.read_until(tag, callback)
-        except IOError:
-            logging.exception('socket error')
+            self.parser.feed(data)
+        except expat.ExpatError:
+            logging.exception('invalid xml from server')
+            self.stream.close()
+        if metrics:
+            # feed() also runs the callbacks for the stanzas it completes
+            metrics.parsed(len(data), time.time() - start - (metrics.callback_time - callback_time))
+        if self._dispatch_queue and not self._drain_scheduled:
+            self._drain_dispatch_queue()
     
-    def _start_tag(self, data):
-        # this is the main tag read loop
-        # logging.debug('_start_tag: %r', data)
-        if not data.lstrip().startswith("<"):
-            node_content, tag = data.split("<", 1)
+    def _start_tag(self, stanza):
+        # called by the parser for each complete stanza. Session setup is handled right
+        # away (it restarts the stream); after that stanzas go through the dispatch queue
+        if self._connected and self.max_dispatch_queue:
+            self._dispatch_queue.append(stanza)
         else:
-            node_content = None
-            tag = data.lstrip()
-        tag_name = tag.strip(">").strip("<").split(" ", 1)[0]
-        
-        handler = None
-        if not self._current_processors:
+            self._handle_stanza(stanza)
+    
+    def _drain_dispatch_queue(self, limit=None):
+        """Dispatch up to `limit` (dispatch_batch) queued stanzas, and come back for
+        the rest on the next IOLoop iteration"""
+        self._drain_scheduled = False
+        if self._dispatch_waiting:
+            return
+        queue = self._dispatch_queue
+        offload = self.offload
+        for i in xrange(min(len(queue), limit or self.dispatch_batch)):
+            stanza = queue.popleft()
+            if offload and offload.should_parse(stanza) and not self.stream.closed():
+                # _offload_parsed() picks up from here
+                self._dispatch_waiting = stanza
+                offload.parse(stanza, self._offload_parsed)
+                return
+            self._handle_stanza(stanza)
+        if queue:
+            if not self._drain_scheduled:
+                self._drain_scheduled = True
+                self.io_loop.add_callback(self._drain_dispatch_queue)
+        self._resume_reading()
+    
+    def _offload_parsed(self, stanza):
+        if stanza is not self._dispatch_waiting:
+            # already handled when the stream closed
+            return
+        self._dispatch_waiting = None
+        self._handle_stanza(stanza)
+        self._drain_dispatch_queue()
+    
+    def _resume_reading(self):
+        if not self._reading_paused or len(self._dispatch_queue) > self.max_dispatch_queue // 2:
+            return
+        if self.offload and self.offload.pending > self.offload.max_pending // 2:
+            return
+        if not self.stream.closed():
+            self._reading_paused = False
+            self.read_next()
+    
+    def _handle_stanza(self, stanza):
+        # this is the main stanza dispatch
+        metrics = self.metrics
+        if metrics:
+            start = time.time()
+            self._dispatch(stanza)
+            metrics.stanza_in(stanza, time.time() - start)
+        else:
+            self._dispatch(stanza)
+    
+    def _dispatch(self, stanza):
+        # logging.debug('_dispatch: %r', stanza)
+        if self.sm:
+            self.sm.received(stanza.name)
+        if self._namespace_handlers and self._connected and self._dispatch_namespace(stanza):
+            return
+        layer = self._handler_layers[-1]
+        if not layer:
             self.pop_handlers()
-        for needle, possible_handler in self._current_processors:
-            if needle == tag_name or needle is ALL_TAGS:
-                handler = possible_handler
-                break
+            layer = self._handler_layers[-1]
+        handler = layer.get(stanza.name) or layer.get(ALL_TAGS)
         assert handler
-        if handler.handle(tag, content=node_content):
-            self.read_next()
+        handler.handle(stanza)
+    
+    def _dispatch_namespace(self, stanza):
+        if stanza.name == "iq" and stanza.options.get('type') not in ("get", "set"):
+            return False
+        for child in stanza.children:
+            callback = self._namespace_handlers.get(child.options.get('xmlns'))
+            if callback:
+                callback(stanza)
+                return True
+        return False
+    
+    def _oversize_stanza(self, name, options, size):
+        if self.metrics:
+            self.metrics.incr('oversize_stanzas')
+        if self.sm:
+            # dropped, but received all the same
+            self.sm.received(name)
+        if self.oversize_policy == "close":
+            logging.error('closing the stream: %s stanza from %s is over %d bytes', name, options.get('from'),
+                self.max_stanza_size)
+            # nothing more is read from this stream
+            self.parser.reset()
+            self.stream.close()
+            return
+        logging.warning('dropped %s stanza from %s over %d bytes', name, options.get('from'), self.max_stanza_size)
+        if name != "iq":
+            return
+        iq_type = options.get('type')
+        if iq_type in ("get", "set"):
+            body = '<error type="modify"><policy-violation xmlns="%s"/></error>' % NS_STANZAS
+            self.iq(type="error", id_str=options.get('id'), attrs=attr("to", options.get('from')), body=body)
+        elif iq_type in ("result", "error"):
+            self.iq_handler.fail(options.get('id'), "response over %d bytes" % self.max_stanza_size,
+                sender=options.get('from') or '')
     
     #################
     
@@ -156,11 +457,82 @@ class XMPPIOLoopClient(object):
         return self._sequence
     
     def write(self, data):
+        data = _utf8(data)
+        if self.sm and self.sm.track(data):
+            # held until the session is resumed
+            return
+        if self.metrics:
+            self.metrics.stanza_out(data)
+        if not self.coalesce_writes:
+            self._write(data)
+            return
+        self._write_buffer.append(data)
+        self._write_buffer_size += len(data)
+        if self._write_buffer_size >= self.write_buffer_max:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            if self.write_latency:
+                self._flush_timeout = self.io_loop.add_timeout(time.time() + self.write_latency, self.flush)
+            else:
+                self.io_loop.add_callback(self._scheduled_flush)
+    
+    def _scheduled_flush(self):
+        # a callback can't be cancelled; if the buffer was flushed since, and is now
+        # waiting on a write_latency timeout, leave it to that
+        if self._flush_scheduled and self._flush_timeout is None:
+            self.flush()
+    
+    def flush(self):
+        """Write any buffered stanzas to the stream"""
+        if not self._write_buffer:
+            self._clear_write_buffer()
+            return
+        data = ''.join(self._write_buffer)
+        self._clear_write_buffer()
+        self._write(data)
+    
+    def _clear_write_buffer(self):
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._flush_scheduled = False
+        if self._flush_timeout:
+            self.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+    
+    def _write(self, data):
         try:
-            logging.debug("W:%r" % data)
-            self.stream.write(_utf8(data))
+            if self.debug_logging:
+                logging.debug("W:%r", data)
+            if self.capture:
+                self.capture.record(CAPTURE_OUT, data)
+            if self.compression:
+                data = self.compression.compress(data)
+            self.stream.write(data)
+            if self.metrics:
+                self.metrics.written(len(data), self.stream)
         except IOError:
-            logging.exception('failed write for %r' % data)
+            logging.exception('failed write for %r', data)
+    
+    def _send(self, data, priority, to=None):
+        if self.scheduler:
+            self.scheduler.send(data, priority, to)
+        else:
+            self.write(data)
+    
+    def _write_batch(self, stanzas):
+        # write a list of stanzas (and anything buffered) to the stream in a single
+        # write. This skips the scheduler: callers rate limit themselves
+        # (message_many goes through the scheduler when there is one)
+        for data in stanzas:
+            data = _utf8(data)
+            if self.sm and self.sm.track(data):
+                continue
+            if self.metrics:
+                self.metrics.stanza_out(data)
+            self._write_buffer.append(data)
+            self._write_buffer_size += len(data)
+        self.flush()
     
     def presence(self, show=None, status=None, priority=None, to=None, type=None):
         assert self._connected
@@ -175,30 +547,60 @@ class XMPPIOLoopClient(object):
             assert not priority
             assert not status
         
-        body = ""
-        attrs = ""
-        
-        if show:
-            body += "<show>%s</show>" % show
-        if status:
-            body += "<status>%s</status>" % status
-        if priority:
-            body += "<priority>%d</priority>" % priority
-        
-        if to:
-            attrs += ' to="%s"' % to
-        if type:
-            attrs += ' type="%s"' % type
-        
-        self.write("<presence%s>%s</presence>" % (attrs, body))
+        self._send(presence_stanza(show, status, priority, to, type), PRIORITY_PRESENCE, to)
     
     def iq(self, type, body, attrs=None, id_str=None, from_str=None):
+        """Send an iq. body is an xml string or an XmlBLock tree; attrs is an attribute
+        fragment (see xmpp_stanza.attr)"""
         attrs = attrs or ''
         if id_str:
-            attrs = (' id="%s"' % id_str) + attrs
+            attrs = attr("id", id_str) + attrs
         if from_str:
-            attrs += ' from="%s"' % self.jid
-        self.write("""<iq type="%s"%s>%s</iq>""" % (type, attrs, body))
+            attrs += self._from_attr
+        data = iq_stanza(type, body, attrs)
+        if self._connected:
+            self._send(data, PRIORITY_IQ)
+        else:
+            # session setup (ie: bind) isn't rate limited
+            self.write(data)
+    
+    def iq_request(self, type, body, to=None, timeout=None, callback=None):
+        """Send an iq get/set, and return a Future that resolves to the response stanza.
+        
+        A type="error" response or no response within `timeout` seconds raises IQError /
+        IQTimeout. With a callback there is no Future: callback is called with the
+        response stanza (or None). With tornado < 3.0 the Future can't be yielded in a
+        coroutine; use callback there, ie:
+        `yield tornado.gen.Task(client.iq_request, "get", body)`.
+        Requests can be made at any time; they are held until connected and pipelined up
+        to iq_handler.max_in_flight at a time.
+        """
+        assert type in ("get", "set")
+        id_str = str(self.get_sequence())
+        attrs = attr("to", to)
+        send = functools.partial(self.iq, type, body, attrs=attrs, id_str=id_str)
+        return self.iq_handler.request(id_str, send, timeout=timeout, callback=callback, to=to)
+    
+    def request_roster(self):
+        """Fetch the roster into client.roster (only the changes, when the server supports
+        roster versioning and we have a version)"""
+        if self.roster is None:
+            return
+        self.iq_request("get", self.roster.query(self.roster_versioning), callback=self._finish_roster)
+    
+    def _finish_roster(self, stanza):
+        if stanza is not None and stanza.options.get('type') == 'result':
+            self.roster.load_result(stanza)
+    
+    def _roster_push(self, stanza):
+        # only the server (no from, or our own bare jid) can push roster changes
+        sender = stanza.options.get('from')
+        if sender and JID(sender).bare != JID(self.jid).bare:
+            logging.warning('ignoring roster push from %r', sender)
+            return
+        if self.roster is not None:
+            self.roster.push(stanza)
+        self.iq(type="result", body='', id_str=stanza.options.get('id'))
     
     def message(self, to, body):
         # <message to="you@domain.com" type="chat" id="purpleada23077" from="jehiah@domain.com/AdiumCD37AB23">
@@ -208,8 +610,15 @@ class XMPPIOLoopClient(object):
         #   <arc:record xmlns:arc="http://jabber.org/protocol/archive" otr="false"/>
         # </message>
         # id_str = uuid.uuid4().hex
-        self.write(_utf8("""<message to="%(to)s" type="chat" id="%(id_str)s" from="%(jid)s"><body>%(body)s</body></message>"""
-        % dict(to=to, body=body, id_str=self.get_sequence(), jid=self.jid)))
+        self._send(message_stanza(to, body, self.get_sequence(), self._from_attr), PRIORITY_MESSAGE, to)
+    
+    def message_many(self, recipients, body):
+        """Send the same message body to each of recipients in a single write"""
+        if self.scheduler:
+            for to in recipients:
+                self._send(message_stanza(to, body, self.get_sequence(), self._from_attr), PRIORITY_MESSAGE, to)
+            return
+        self._write_batch([message_stanza(to, body, self.get_sequence(), self._from_attr) for to in recipients])
 
     
     #############
@@ -220,41 +629,62 @@ class XMPPIOLoopClient(object):
         if not host:
             host = self.domain
         logging.debug('initialize stream')
+        # each new stream (initial, after tls, after auth) is a new xml document
+        self.parser.reset()
+        self.add_handler("stream:features", FeaturesHandler())
         self.write('''<?xml version="1.0" encoding="UTF-8"?>
             <stream:stream xmlns:stream="%s" to="%s" version="1.0"
             xmlns="%s">''' % (xmlns_stream, host, xmlns))
-        self.stream.read_until(">", self._finish_connection)
     
-    def _finish_connection(self, data):
+    def _finish_connection(self, name, options):
         # this is the <stream:stream ...> block
         # <stream:stream from="domain.com" id="E44F73FE0D9C659F" version="1.0" xmlns:stream="http://etherx.jabber.org/streams" xmlns="jabber:client">
-        logging.debug('_finish_connection: %r', data)
-        self.add_handler("stream:features", FeaturesHandler())
-        self.read_next()
+        logging.debug('_finish_connection: %r %r', name, options)
     
     def upgrade_to_tls(self):
         logging.info('upgrading to tls')
-        self.write('<starttls xmlns="urn:ietf:params:xml:ns:xmpp-tls"/>')
-        self.stream.read_until("/>", self.finish_tls_upgrade)
+        self.add_handler(ALL_TAGS, StartTLSHandler())
+        self.write('<starttls xmlns="%s"/>' % NS_TLS)
     
-    def finish_tls_upgrade(self, data):
+    def finish_tls_upgrade(self, stanza):
         # http://xmpp.org/registrar/stream-features.html
         # <proceed xmlns="urn:ietf:params:xml:ns:xmpp-tls"/>
-        logging.debug(data)
-        assert data.startswith("<proceed")
-        logging.info('converting connection to ssl.PROTOCOL_TLSv1')
-        ssl_socket = ssl.wrap_socket(self.socket, ssl_version=ssl.PROTOCOL_TLSv1, do_handshake_on_connect=False)
+        logging.debug('%r', stanza)
+        assert stanza.name == "proceed"
+        # anything the server sent after <proceed/> was sent in the clear; the parser
+        # drops it when initialize_stream() resets it
+        self._start_tls()
+        self.initialize_stream()
+        self.read_next()
+    
+    def start_compression(self):
+        """The server agreed to compress the stream: everything from here on (starting
+        with a new stream) is zlib compressed"""
+        self.compression = ZlibStream(self.compression_level)
+        self.initialize_stream()
+    
+    def _start_tls(self):
+        """Continue the connection over TLS; the plain stream is left behind (its
+        writes are done: the server has answered them)"""
+        logging.info('starting tls')
+        self.stream.set_close_callback(None)
         self.io_loop.remove_handler(self.socket.fileno())
-        self.stream = tornado.iostream.SSLIOStream(ssl_socket)
+        self.socket = wrap_socket(self.socket, self.ssl_context or default_context(self.direct_tls), self.domain)
+        self.stream = TLSIOStream(self.socket, io_loop=self.io_loop, max_buffer_size=self.max_buffer_size)
         self.stream.set_close_callback(self.stream_close_cb)
-        self.initialize_stream()
     
-    def set_connected(self):
-        self.iq_handler = IQHandler()
+    def set_connected(self, resumed=False):
         self.push_handler("message", MessageHandler())
         self.add_handler("iq", self.iq_handler)
         self.add_handler("presence", PresenceHandler())
         self._connected = True
+        if self.metrics:
+            self.metrics.connected()
+        if self.sm:
+            self.sm.session_started(resumed)
+        self.iq_handler.send_waiting()
+        if self.scheduler:
+            self.scheduler.schedule_drain()
         self.connect_cb()
 
 def _utf8(s):
@@ -262,3 +692,102 @@ def _utf8(s):
         s = s.encode('utf-8')
     assert isinstance(s, str)
     return s
+
+def test_dispatch():
+    from xmlparse import xml2list
+    client = XMPPIOLoopClient("localhost", domain="test", username="bot", password="x", resource="r")
+    received = []
+    client.connect_cb = lambda: None
+    client.message_cb = lambda stanza: received.append(('message', stanza.name))
+    client.presence_cb = lambda stanza: received.append(('presence', stanza.name))
+    client.add_handler(ALL_TAGS, FeaturesHandler())
+    client.remove_handler(ALL_TAGS)
+    client.set_connected()
+    client.add_namespace_handler("http://jabber.org/protocol/pubsub#event", lambda stanza: received.append(('event', stanza.name)))
+    for raw_xml in ['<message from="a@test"><body>hi</body></message>',
+            '<presence from="a@test"/>',
+            '<message from="pubsub.test"><event xmlns="http://jabber.org/protocol/pubsub#event"/></message>']:
+        client._handle_stanza(xml2list(raw_xml)[0])
+    assert received == [('message', 'message'), ('presence', 'presence'), ('event', 'message')]
+
+def test_inbound_limits():
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    def bound_cb(connection):
+        stanzas = ['<message from="a@test/x"><body>%d</body></message>' % i for i in range(600)]
+        stanzas.insert(300, '<message from="a@test/x"><body>%s</body></message>' % ('x' * 10000))
+        connection.replay(stanzas)
+    server, port = start_fake_server(io_loop, bound_cb=bound_cb)
+    client = client_for(port, io_loop)
+    client.max_stanza_size = 2000
+    client.max_dispatch_queue = 20
+    client.dispatch_batch = 5
+    messages = []
+    queued = []
+    def message_cb(stanza):
+        messages.append(stanza.find("body").data)
+        queued.append((len(client._dispatch_queue), client._reading_paused))
+        if len(messages) == 600:
+            io_loop.stop()
+    client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=message_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert messages == [str(i) for i in range(600)]
+    # reading paused while the queue was full; it never held more than one read past the limit
+    assert any(paused for size, paused in queued)
+    assert max(size for size, paused in queued) < 20 + client.read_chunk_size / 40
+
+def test_write_coalescing():
+    from xmpp_fakeserver import client_for, start_fake_server
+    from xmpp_scheduler import OutboundScheduler
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    server, port = start_fake_server(io_loop,
+        stanza_cb=lambda connection, stanza: received.append(stanza.find("body").data))
+    client = client_for(port, io_loop)
+    client.coalesce_writes = True
+    writes = []
+    def record_writes():
+        write = client.stream.write
+        def recorded(data, *args, **kwargs):
+            writes.append((time.time(), data.count('<message')))
+            return write(data, *args, **kwargs)
+        client.stream.write = recorded
+    def connect_cb():
+        record_writes()
+        # buffered until the next IOLoop iteration, then one write
+        for i in range(5):
+            client.message(to="a@test", body=str(i))
+        assert not writes and len([data for data in client._write_buffer if data.startswith('<message')]) == 5
+        io_loop.add_callback(buffer_cap)
+    def buffer_cap():
+        assert [count for when, count in writes] == [5]
+        # a full buffer is written right away
+        client.write_buffer_max = 250
+        for i in range(6):
+            client.message(to="a@test", body='x' * 60)
+        assert [count for when, count in writes[1:]] == [2, 2, 2]
+        client.write_buffer_max = 64 * 1024
+        # message_many is a single write, and flushes what's buffered with it
+        client.message(to="a@test", body="before")
+        client.message_many(["b@test", "c@test"], "many")
+        assert [count for when, count in writes[4:]] == [3]
+        client.write_latency = 0.05
+        client.message(to="a@test", body="late")
+        io_loop.add_timeout(time.time() + 0.2, rate_limited)
+        latency_start.append(time.time())
+    latency_start = []
+    def rate_limited():
+        assert len(writes) == 6 and writes[5][0] - latency_start[0] >= 0.04
+        # with a scheduler, message_many is rate limited like any other send
+        client.coalesce_writes = False
+        client.scheduler = OutboundScheduler(client, rate=1, burst=1)
+        client.message_many(["d@test", "e@test", "f@test"], "limited")
+        assert len(writes) == 7 and client.scheduler.queue_depth() == 2
+        io_loop.add_timeout(time.time() + 0.2, io_loop.stop)
+    client.connect(connect_cb=connect_cb, presence_cb=lambda stanza: None, message_cb=lambda stanza: None)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert received == [str(i) for i in range(5)] + ['x' * 60] * 6 + ['before', 'many', 'many', 'late', 'limited']
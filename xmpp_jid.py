@@ -0,0 +1,99 @@
+import weakref
+
+class JID(object):
+    """A parsed jid (node@domain/resource).
+
+    JIDs are interned: JID(text) returns the existing JID for that address while one is
+    alive, so the many copies a bot holds (roster entries, recent messages, affinity
+    tables) share one object, and every resource of a contact shares its bare JID.
+    The node and domain are lowercased (as nodeprep and nameprep would for ascii).
+
+    A JID compares equal to another JID of the same address (in any case), and to a
+    string that's exactly its normalized full address (so it hashes like that string,
+    and JIDs and strings can be mixed as dict keys).
+
+    >> jid = JID("User@Example.com/phone")
+    >> jid.bare, jid.resource
+    ('user@example.com', 'phone')
+    """
+    __slots__ = 'node', 'domain', 'resource', 'full', '_bare', '__weakref__'
+    _cache = weakref.WeakValueDictionary()
+
+    def __new__(cls, jid):
+        if isinstance(jid, JID):
+            return jid
+        obj = cls._cache.get(jid)
+        if obj is not None:
+            return obj
+        address, slash, resource = jid.partition('/')
+        node, at, domain = address.rpartition('@')
+        node = node.lower() or None
+        domain = domain.lower()
+        resource = resource or None
+        full = node and '%s@%s' % (node, domain) or domain
+        bare = None
+        if resource:
+            bare = JID(full)
+            full = '%s/%s' % (bare.full, resource)
+        obj = cls._cache.get(full)
+        if obj is None:
+            obj = object.__new__(cls)
+            obj.node = node
+            obj.domain = domain
+            obj.resource = resource
+            obj.full = full
+            obj._bare = bare
+            cls._cache[full] = obj
+        cls._cache[jid] = obj
+        return obj
+
+    @property
+    def bare(self):
+        """The bare jid (node@domain) as a string"""
+        return self._bare.full if self._bare else self.full
+
+    @property
+    def bare_jid(self):
+        """The bare jid as a JID"""
+        return self._bare or self
+
+    def __eq__(self, other):
+        if isinstance(other, JID):
+            return self is other
+        if isinstance(other, basestring):
+            return self.full == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.full)
+
+    def __str__(self):
+        return self.full.encode('utf-8') if isinstance(self.full, unicode) else self.full
+
+    def __unicode__(self):
+        return unicode(self.full)
+
+    def __repr__(self):
+        return 'JID(%r)' % self.full
+
+def test_jid():
+    jid = JID(u'User@Test.com/Phone')
+    assert (jid.node, jid.domain, jid.resource) == (u'user', u'test.com', u'Phone')
+    assert jid.full == u'user@test.com/Phone' and jid.bare == u'user@test.com'
+    assert JID('user@test.com/Phone') is jid
+    assert JID(jid) is jid
+    assert JID('user@test.com/laptop').bare_jid is jid.bare_jid is JID('USER@test.com')
+    assert jid == JID('user@TEST.com/Phone') and jid != JID('user@test.com/phone') and jid != JID('user@test.com')
+    # strings compare as they hash: only the normalized full address is equal
+    assert jid == 'user@test.com/Phone' and jid != 'user@TEST.com/Phone' and jid != 'user@test.com/phone'
+    contacts = {jid: 1, 'other@test.com': 2}
+    assert contacts['user@test.com/Phone'] == 1 and contacts[JID('Other@Test.com')] == 2
+    assert len(set([jid, JID('user@test.com/Phone')])) == 1
+    assert str(JID('test.com')) == 'test.com' and JID('test.com').node is None
+    assert JID('test.com/admin').bare == 'test.com'
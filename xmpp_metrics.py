@@ -0,0 +1,210 @@
+import bisect
+import re
+import time
+
+# upper bounds (seconds) for timing histograms
+TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 300]
+# upper bounds (bytes) for size histograms
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+_STANZA_NAME_RE = re.compile(r'(?:<\?[^>]*>\s*)?<([^\s/>]+)')
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets (cumulative, as prometheus expects)"""
+    __slots__ = 'bounds', 'counts', 'count', 'sum', 'max'
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """An upper bound for the `fraction` percentile (the bucket it falls in)"""
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        buckets = []
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            buckets.append((bound, seen))
+        buckets.append(('+Inf', self.count))
+        return dict(count=self.count, sum=self.sum, max=self.max,
+            p50=self.percentile(0.5), p99=self.percentile(0.99), buckets=buckets)
+
+class ClientMetrics(object):
+    """Counters, gauges and histograms for an XMPPIOLoopClient.
+
+    Collection is off unless a ClientMetrics is set as client.metrics. snapshot()
+    returns plain dicts for the application to export (ie: to statsd or prometheus).
+
+    Counters: stanzas_in.<name>, stanzas_out.<name>, bytes_read, bytes_written,
+        reconnects, iq_timeouts
+    Gauges: write_buffer_bytes (bytes waiting in the IOStream, sampled every
+        `write_buffer_sample` writes)
+    Histograms (seconds): parse_time (per read, excluding callbacks), callback_time (per
+        stanza), iq_round_trip, downtime; and write_buffer_bytes (bytes)
+
+    The hooks on_stanza_in(stanza), on_stanza_out(data) and on_parse(num_bytes, seconds)
+    are called, if set, as stanzas are dispatched, written and parsed.
+
+    >> client.metrics = ClientMetrics()
+    >> client.metrics.snapshot()['counters']['stanzas_in.message']
+    """
+    def __init__(self):
+        self.on_stanza_in = None
+        self.on_stanza_out = None
+        self.on_parse = None
+        # summing the IOStream buffer is O(chunks); don't do it on every write
+        self.write_buffer_sample = 64
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # total seconds spent in callbacks; lets parse time exclude them
+        self.callback_time = 0
+        self._down_since = None
+        self._writes = 0
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, bounds=TIME_BUCKETS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+    def snapshot(self):
+        return dict(counters=dict(self.counters), gauges=dict(self.gauges),
+            histograms=dict((name, histogram.snapshot()) for name, histogram in self.histograms.items()))
+
+    # called by the client
+    def stanza_in(self, stanza, seconds):
+        self.incr('stanzas_in.' + stanza.name)
+        self.callback_time += seconds
+        self.observe('callback_time', seconds)
+        if self.on_stanza_in:
+            self.on_stanza_in(stanza)
+
+    def stanza_out(self, data):
+        match = _STANZA_NAME_RE.match(data)
+        self.incr('stanzas_out.' + (match and match.group(1) or 'unknown'))
+        if self.on_stanza_out:
+            self.on_stanza_out(data)
+
+    def parsed(self, num_bytes, seconds):
+        self.incr('bytes_read', num_bytes)
+        self.observe('parse_time', seconds)
+        if self.on_parse:
+            self.on_parse(num_bytes, seconds)
+
+    def written(self, num_bytes, stream):
+        self.incr('bytes_written', num_bytes)
+        self._writes += 1
+        if self._writes % self.write_buffer_sample == 1:
+            buffered = _buffered_bytes(stream)
+            if buffered is None:
+                return
+            self.gauge('write_buffer_bytes', buffered)
+            self.observe('write_buffer_bytes', buffered, SIZE_BUCKETS)
+
+    def iq_round_trip(self, seconds):
+        self.observe('iq_round_trip', seconds)
+
+    def disconnected(self):
+        if self._down_since is None:
+            self._down_since = time.time()
+
+    def connected(self):
+        if self._down_since is not None:
+            self.incr('reconnects')
+            self.observe('downtime', time.time() - self._down_since)
+            self._down_since = None
+
+def _buffered_bytes(stream):
+    """Bytes waiting in an IOStream's write buffer, or None if this tornado's IOStream
+    doesn't say (the buffer is private: a deque of chunks before tornado 4, with a
+    _write_buffer_size after)"""
+    size = getattr(stream, '_write_buffer_size', None)
+    if size is not None:
+        return size
+    write_buffer = getattr(stream, '_write_buffer', None)
+    if write_buffer is None:
+        return None
+    try:
+        return sum(len(chunk) for chunk in write_buffer)
+    except TypeError:
+        return None
+
+def test_histogram():
+    histogram = Histogram([1, 2, 5])
+    for value in [0.5, 1, 1.5, 3, 3, 10]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 2, 1]
+    assert histogram.percentile(0.5) == 2
+    assert histogram.percentile(1) == 10
+    assert histogram.snapshot()['buckets'] == [(1, 2), (2, 3), (5, 5), ('+Inf', 6)]
+
+def test_buffered_bytes():
+    from collections import deque
+    class Stream(object):
+        pass
+    stream = Stream()
+    assert _buffered_bytes(stream) is None
+    stream._write_buffer = deque(['abc', 'de'])
+    assert _buffered_bytes(stream) == 5
+    stream._write_buffer = bytearray('abcde')
+    assert _buffered_bytes(stream) is None
+    stream._write_buffer_size = 5
+    assert _buffered_bytes(stream) == 5
+
+def test_client_metrics():
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    server, port = start_fake_server(io_loop,
+        bound_cb=lambda connection: connection.replay(['<message from="a@test"><body>hi</body></message>'] * 10))
+    client = client_for(port, io_loop)
+    client.metrics = metrics = ClientMetrics()
+    sent = []
+    metrics.on_stanza_out = sent.append
+    def message_cb(stanza):
+        if metrics.counters.get('stanzas_in.message') == 9: # counted after the callback
+            client.message(to="a@test", body="done")
+            io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+    client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=message_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['stanzas_in.message'] == 10
+    assert snapshot['counters']['stanzas_out.message'] == 1
+    assert snapshot['counters']['bytes_written'] == sum(map(len, sent))
+    assert snapshot['counters']['bytes_read'] > 0
+    assert snapshot['counters']['stanzas_out.stream:stream'] == 2
+    assert snapshot['histograms']['iq_round_trip']['count'] == 1 # the roster request
+    assert snapshot['histograms']['callback_time']['count'] == sum(
+        count for name, count in snapshot['counters'].items() if name.startswith('stanzas_in.'))
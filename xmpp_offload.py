@@ -0,0 +1,277 @@
+"""
+Runs message_cb and presence_cb in an executor instead of on the IOLoop, so slow
+callbacks (database writes, blocking APIs) don't hold up the connection.
+
+    >> client.offload = CallbackOffload(client, concurrent.futures.ThreadPoolExecutor(8))
+    >> def message_cb(stanza): # now runs in a worker thread
+    ..     client.threadsafe.message(to=stanza.options['from'], body=lookup(stanza))
+
+Callbacks run in a worker, so they must not call the client directly: client.threadsafe
+runs a client method on the IOLoop instead.
+"""
+import functools
+import logging
+import Queue
+import threading
+from collections import deque
+
+from xmlparse import LazyXmlBLock, xml2msg
+from xmpp_jid import JID
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None # python 2 needs the futures backport; ThreadPool works without it
+
+class CallbackOffload(object):
+    """Dispatches stanza callbacks to `executor` (anything with concurrent.futures'
+    submit(), ie: a ThreadPoolExecutor, a ProcessPoolExecutor or a ThreadPool).
+
+    Stanzas from the same sender (bare jid) are handled one at a time, in the order they
+    arrived; different senders are handled in parallel. While more than `max_pending`
+    stanzas wait for a worker the client stops reading from the socket.
+
+    With lazy_stanzas, iqs of `parse_size` bytes or more are parsed in the executor
+    before they're dispatched (the stanzas after them wait, so ordering is kept).
+
+    A ProcessPoolExecutor pickles the callback and the stanza: callbacks have to be
+    module level functions, and can't use the client (not even client.threadsafe).
+    """
+    def __init__(self, client, executor, max_pending=1000, parse_size=None):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.executor = executor
+        self.max_pending = max_pending
+        self.parse_size = parse_size
+        self.pending = 0
+        # bare jid -> (callback, stanza)s waiting for the one running
+        self._senders = {}
+
+    def dispatch(self, callback, stanza):
+        sender = stanza.options.get('from')
+        sender = JID(sender).bare if sender else ''
+        self.pending += 1
+        waiting = self._senders.get(sender)
+        if waiting is not None:
+            waiting.append((callback, stanza))
+            return
+        self._senders[sender] = deque()
+        self._submit(sender, callback, stanza)
+
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def _submit(self, sender, callback, stanza):
+        try:
+            future = self.executor.submit(_run_callback, callback, stanza)
+        except Exception:
+            # ie: the executor was shut down
+            logging.exception('could not submit the callback for %r', stanza)
+            self.io_loop.add_callback(functools.partial(self._finish, sender, None))
+            return
+        future.add_done_callback(lambda future: self.io_loop.add_callback(
+            functools.partial(self._finish, sender, future)))
+
+    def _finish(self, sender, future):
+        # on the IOLoop
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                logging.exception('offloaded callback failed')
+        self.pending -= 1
+        waiting = self._senders[sender]
+        if waiting:
+            self._submit(sender, *waiting.popleft())
+        else:
+            del self._senders[sender]
+        if self.pending <= self.max_pending // 2:
+            self.client._resume_reading()
+
+    def should_parse(self, stanza):
+        return (self.parse_size is not None and stanza.name == "iq" and isinstance(stanza, LazyXmlBLock)
+            and stanza._children is None and len(stanza.raw) >= self.parse_size)
+
+    def parse(self, stanza, callback):
+        """Parse a LazyXmlBLock's children in the executor, then run callback(stanza)
+        on the IOLoop"""
+        def parsed(future):
+            try:
+                xml_blk = future.result()
+            except Exception:
+                logging.exception('offloaded parse failed')
+            else:
+                stanza._children = xml_blk.children
+                stanza._data = xml_blk.data
+            # a failed parse is parsed again (and fails) on the IOLoop when accessed
+            callback(stanza)
+        future = self.executor.submit(parse_raw, stanza.raw)
+        future.add_done_callback(lambda future: self.io_loop.add_callback(functools.partial(parsed, future)))
+
+def default_executor(num_threads=4):
+    """A concurrent.futures ThreadPoolExecutor, or a ThreadPool without it"""
+    if ThreadPoolExecutor is not None:
+        return ThreadPoolExecutor(num_threads)
+    return ThreadPool(num_threads)
+
+def _run_callback(callback, stanza):
+    # in the worker; errors are logged here, where the traceback is
+    try:
+        callback(stanza)
+    except Exception:
+        logging.exception('error in callback for %r', stanza)
+
+def parse_raw(raw):
+    if not isinstance(raw, unicode):
+        raw = raw.decode('utf-8')
+    return xml2msg(raw)
+
+class ThreadSafeClient(object):
+    """Calls to client methods from other threads: each call runs on the client's
+    IOLoop (return values are dropped)"""
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        def call(*args, **kwargs):
+            self._client.io_loop.add_callback(functools.partial(method, *args, **kwargs))
+        return call
+
+class ThreadPool(object):
+    """A minimal executor (submit() returning a future with result() and
+    add_done_callback()) for when concurrent.futures isn't installed"""
+    def __init__(self, num_threads=4):
+        self.num_threads = num_threads
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def submit(self, function, *args, **kwargs):
+        future = SimpleFuture()
+        if len(self._threads) < self.num_threads:
+            thread = threading.Thread(target=self._run, name='xmpp-offload')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._queue.put((future, functools.partial(function, *args, **kwargs)))
+        return future
+
+    def _run(self):
+        while True:
+            future, function = self._queue.get()
+            try:
+                future.set_result(function())
+            except Exception, e:
+                future.set_exception(e)
+
+class SimpleFuture(object):
+    """The parts of a concurrent.futures Future that ThreadPool and IQHandler use
+    (result(), add_done_callback(), set_result() and set_exception())"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = False
+        self._result = self._exception = None
+        self._callbacks = []
+
+    def result(self):
+        assert self._done
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        with self._lock:
+            self._result, self._exception = result, exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+def test_ordering():
+    import random
+    import time
+    import tornado.ioloop
+    from xmlparse import XmlBLock
+    io_loop = tornado.ioloop.IOLoop()
+    class Client(object):
+        resumed = 0
+        def _resume_reading(self):
+            self.resumed += 1
+    client = Client()
+    client.io_loop = io_loop
+    offload = CallbackOffload(client, ThreadPool(4), max_pending=10)
+    handled = []
+    lock = threading.Lock()
+    def callback(stanza):
+        time.sleep(random.random() * 0.002)
+        with lock:
+            handled.append((stanza.options['from'].split('/')[0], stanza.data))
+        if stanza.data == 'fail':
+            raise ValueError(stanza.data)
+    for i in range(40):
+        # every sender has two resources, which share the bare jid's ordering
+        offload.dispatch(callback, XmlBLock("message", data=i, options={'from': 'u%d@test/%d' % (i % 4, i % 3)}))
+    offload.dispatch(callback, XmlBLock("message", data='fail', options={'from': 'u0@test/x'}))
+    assert offload.full()
+    def check():
+        if not offload.pending:
+            io_loop.stop()
+    tornado.ioloop.PeriodicCallback(check, 5, io_loop=io_loop).start()
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    assert offload.pending == 0 and not offload._senders and client.resumed
+    assert len(handled) == 41
+    for sender in range(4):
+        assert [data for jid, data in handled if jid == 'u%d@test' % sender] == \
+            range(sender, 40, 4) + (['fail'] if sender == 0 else [])
+
+def test_client_offload():
+    import time
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    big_iq = '<iq type="set" id="big" from="a@test/x"><q xmlns="urn:test">%s</q></iq>' % ('<item/>' * 5000)
+    def bound_cb(connection):
+        stanzas = ['<message from="a@test/x"><body>%d</body></message>' % i for i in range(10)]
+        connection.replay(stanzas[:5] + [big_iq] + stanzas[5:])
+    received = []
+    server, port = start_fake_server(io_loop, bound_cb=bound_cb,
+        stanza_cb=lambda connection, stanza: received.append(stanza.find("body").data))
+    client = client_for(port, io_loop, lazy_stanzas=True)
+    client.offload = CallbackOffload(client, ThreadPool(2), parse_size=10000)
+    events = []
+    def message_cb(stanza):
+        # in a worker thread
+        assert threading.current_thread().name == 'xmpp-offload'
+        events.append(stanza.find("body").data)
+        client.threadsafe.message(to="a@test", body=events[-1])
+    def iq_cb(stanza):
+        # parsed in the offload, but handled on the IOLoop after the messages before it
+        assert stanza._children is not None and len(stanza.find("q").children) == 5000
+        events.append(stanza.options['id'])
+        client.iq(type="result", id_str=stanza.options['id'], body='')
+    client.iq_handler.add_request_handler("urn:test", iq_cb)
+    def check():
+        if len(received) == 10:
+            io_loop.stop()
+    tornado.ioloop.PeriodicCallback(check, 10, io_loop=io_loop).start()
+    client.connect(connect_cb=lambda: None, presence_cb=lambda stanza: None, message_cb=message_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert received == [str(i) for i in range(10)]
+    assert events.index("big") >= 0 and sorted(events[:events.index("big")]) == [str(i) for i in range(5)]
+    assert client.offload.pending == 0
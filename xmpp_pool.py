@@ -0,0 +1,208 @@
+import functools
+import logging
+from collections import OrderedDict, deque
+
+from xmpp_ioloop import XMPPIOLoopClient
+from xmpp_jid import JID
+from xmpp_scheduler import QueueFull
+from xmpp_stanza import attr
+
+ROUND_ROBIN = "round_robin"
+LEAST_QUEUED = "least_queued"
+
+class XMPPClientPool(object):
+    """A pool of `size` XMPPIOLoopClient sessions for the same account, each bound to
+    its own resource (`resource`-0, `resource`-1, ...).
+
+    message() and iq() are spread over the connected sessions (`strategy` is round
+    robin or least queued). Each recipient sticks to one session while it stays
+    connected, so messages to a contact arrive in order. Stanzas received by any
+    session go to the same presence_cb / message_cb, and sessions reconnect on their
+    own with the client's autoreconnect.
+
+    Sends made while no session is connected are held (up to `max_held`; past that
+    they raise QueueFull) and sent once one connects. The `max_affinity` most recently
+    used recipients are remembered.
+
+    >> pool = XMPPClientPool(host="talk.google.com", size=4, domain=..., username=..., password=..., resource="bot")
+    >> pool.connect(connect_cb, presence_cb, message_cb)
+    """
+    def __init__(self, host, size=2, port=5222, domain=None, io_loop=None, username=None, password=None,
+            resource=None, strategy=LEAST_QUEUED, max_held=1000, max_affinity=10000, **kwargs):
+        assert size >= 1
+        assert strategy in [ROUND_ROBIN, LEAST_QUEUED]
+        self.strategy = strategy
+        self.clients = [XMPPIOLoopClient(host, port=port, domain=domain, io_loop=io_loop, username=username,
+                password=password, resource='%s-%d' % (resource, i), **kwargs)
+            for i in range(size)]
+        for client in self.clients[1:]:
+            client.resolver = self.clients[0].resolver
+        self.max_held = max_held
+        self.max_affinity = max_affinity
+        # bare jid -> client, least recently used first
+        self._affinity = OrderedDict()
+        self._held = deque()
+        self._next = 0
+        self._presence = None
+        self._available = False
+
+    def connect(self, connect_cb, presence_cb, message_cb, close_cb=None):
+        """connect_cb is called when the first session is ready, and close_cb once none are"""
+        self.connect_cb = connect_cb
+        self.close_cb = close_cb
+        for client in self.clients:
+            client.connect(connect_cb=functools.partial(self._member_connected, client),
+                presence_cb=presence_cb,
+                message_cb=message_cb,
+                close_cb=functools.partial(self._member_closed, client))
+
+    def connected_clients(self):
+        # a closed stream's close callback runs on the next IOLoop iteration
+        return [client for client in self.clients if client.connected and not client.stream.closed()]
+
+    def _member_connected(self, client):
+        logging.info('pool member %s connected', client.jid)
+        if self._presence:
+            client.presence(**self._presence)
+        if not self._available:
+            self._available = True
+            self.connect_cb()
+        held, self._held = self._held, deque()
+        for send in held:
+            send()
+
+    def _member_closed(self, client):
+        logging.warning('pool member %s closed', client.jid)
+        if self._available and not self.connected_clients():
+            self._available = False
+            if self.close_cb:
+                self.close_cb()
+
+    def _pick(self, candidates):
+        self._next = (self._next + 1) % len(candidates)
+        if self.strategy == LEAST_QUEUED:
+            # ties go round robin
+            candidates = candidates[self._next:] + candidates[:self._next]
+            return min(candidates, key=lambda client: client.queued())
+        return candidates[self._next]
+
+    def client_for(self, to=None):
+        """The connected session to send to `to` with (sticky per bare jid while it's
+        connected), or None if no session is connected"""
+        candidates = self.connected_clients()
+        if not candidates:
+            return None
+        if not to:
+            return self._pick(candidates)
+        jid = JID(to).bare
+        client = self._affinity.pop(jid, None)
+        if client not in candidates:
+            client = self._pick(candidates)
+        self._affinity[jid] = client
+        if len(self._affinity) > self.max_affinity:
+            self._affinity.popitem(last=False)
+        return client
+
+    def _hold(self, send):
+        # nothing is connected; send once something is
+        if len(self._held) >= self.max_held:
+            raise QueueFull("no connected sessions, and %d sends already held" % len(self._held))
+        self._held.append(send)
+
+    def message(self, to, body):
+        client = self.client_for(to)
+        if client is None:
+            self._hold(functools.partial(self.message, to, body))
+            return
+        client.message(to, body)
+
+    def message_many(self, recipients, body):
+        if not self.connected_clients():
+            self._hold(functools.partial(self.message_many, recipients, body))
+            return
+        by_client = {}
+        for to in recipients:
+            by_client.setdefault(self.client_for(to), []).append(to)
+        for client, client_recipients in by_client.items():
+            client.message_many(client_recipients, body)
+
+    def iq(self, type, body, attrs=None, id_str=None, from_str=None, to=None):
+        client = self.client_for(to)
+        if client is None:
+            self._hold(functools.partial(self.iq, type, body, attrs=attrs, id_str=id_str, from_str=from_str, to=to))
+            return
+        if to:
+            attrs = (attrs or '') + attr("to", to)
+        client.iq(type, body, attrs=attrs, id_str=id_str, from_str=from_str)
+
+    def presence(self, show=None, status=None, priority=None, to=None, type=None):
+        """Presence to a contact goes out on one session; our own availability is set
+        on every session (and re-sent as they reconnect)"""
+        if to:
+            client = self.client_for(to)
+            if client is None:
+                self._hold(functools.partial(self.presence, to=to, type=type))
+                return
+            client.presence(to=to, type=type)
+            return
+        self._presence = dict(show=show, status=status, priority=priority)
+        for client in self.connected_clients():
+            client.presence(show=show, status=status, priority=priority)
+
+def test_pool():
+    import time
+    import tornado.ioloop
+    from xmpp_fakeserver import start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    presence = []
+    def stanza_cb(connection, stanza):
+        if stanza.name == "message":
+            received.append((connection.jid, stanza.options['to'], stanza.find("body").data))
+        elif stanza.options.get('to'):
+            presence.append(stanza.options['to'])
+    server, port = start_fake_server(io_loop, stanza_cb=stanza_cb)
+    pool = XMPPClientPool("127.0.0.1", size=2, port=port, domain="test", io_loop=io_loop,
+        username="bot", password="x", resource="r", strategy=ROUND_ROBIN, max_held=3, max_affinity=3)
+    # nothing is connected yet: held, and sent once a session connects
+    pool.message("a@test", "held")
+    pool.message_many(["b@test", "c@test"], "held")
+    pool.presence(to="d@test", type="subscribe")
+    try:
+        pool.message("e@test", "too many")
+        assert False, "expected QueueFull"
+    except QueueFull:
+        pass
+    def connect_cb():
+        io_loop.add_timeout(time.time() + 0.2, send)
+    def send():
+        assert len(pool.connected_clients()) == 2
+        for i in range(3):
+            for to in ["a@test/x", "b@test", "c@test", "d@test"]:
+                pool.message(to, str(i))
+        assert len(pool._affinity) == 3
+        # a@test was least recently used, so it lost its session
+        assert "a@test" not in pool._affinity
+        io_loop.add_timeout(time.time() + 0.1, failover)
+    def failover():
+        pool.clients[0].stream.close()
+        assert pool.connected_clients() == [pool.clients[1]]
+        pool.message("b@test", "failover")
+        pool.message("c@test", "failover")
+        io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+    pool.connect(connect_cb, lambda stanza: None, lambda stanza: None)
+    for client in pool.clients:
+        client.autoreconnect = False
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert [(to, body) for jid, to, body in received[:3]] == [("a@test", "held"), ("b@test", "held"), ("c@test", "held")]
+    sessions = {}
+    for jid, to, body in received:
+        if body in ("0", "1", "2"):
+            sessions.setdefault(to, set()).add(jid)
+    # each recipient stuck to one session, and they were spread over both
+    assert all(len(jids) == 1 for jids in sessions.values()) and len(set().union(*sessions.values())) == 2
+    assert presence == ["d@test"]
+    assert len(sessions) == 4 and len([body for jid, to, body in received if body in ("0", "1", "2")]) == 12
+    assert [jid for jid, to, body in received if body == "failover"] == ["bot@test/r-1"] * 2
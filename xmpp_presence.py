@@ -0,0 +1,187 @@
+"""
+Presence coalescing: presence that only repeats a full jid's last known state (show,
+status, priority, caps, ...) is dropped before it's parsed or delivered, and presence
+arriving within `window` seconds can be delivered together.
+
+    >> client.presence_coalescer = PresenceCoalescer(client, window=0.5, batch_cb=presence_batch_cb)
+
+Duplicates are recognized from a digest of the stanza; with lazy_stanzas that's a
+digest of the raw stanza text, so dropped presence is never parsed at all.
+"""
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+# the attributes that don't make up the state (id changes with every stanza)
+_IGNORED_OPTIONS = frozenset(['id', 'to', 'from'])
+_START_TAG_RE = re.compile(r'''<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*/?>''')
+
+class PresenceCoalescer(object):
+    """Filters the presence PresenceHandler delivers. Only available and unavailable
+    presence is coalesced; subscription presence is always delivered right away.
+
+    With a `window`, the presence received during it is delivered when it ends, and
+    only the last state for each full jid (the roster and caps are updated then too).
+    batch_cb, if given, is called (on the IOLoop) with that list of stanzas instead of
+    calling presence_cb once for each.
+
+    The state of a jid that went unavailable is forgotten, and at most `max_states`
+    states are kept (the least recently changed go first), so a repeated unavailable
+    presence, or one from a jid long quiet, may be delivered again.
+    """
+    def __init__(self, client, window=0, batch_cb=None, max_states=10000):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.window = window
+        self.batch_cb = batch_cb
+        self.max_states = max_states
+        self.dropped = 0
+        # full jid -> digest of the last state delivered, least recently changed first
+        self._states = OrderedDict()
+        # full jid -> (stanza, handler) waiting for the window to end
+        self._pending = OrderedDict()
+        self._flush_timeout = None
+
+    def received(self, stanza, handler):
+        """Handle a presence stanza; handler is the PresenceHandler that delivers it"""
+        jid = stanza.options.get('from')
+        if not jid or stanza.options.get('type') not in (None, 'unavailable'):
+            handler.deliver(stanza)
+            return
+        digest = presence_digest(stanza)
+        if self._states.get(jid) == digest:
+            self.dropped += 1
+            if self.client.metrics:
+                self.client.metrics.incr('presence_dropped')
+            return
+        self._states.pop(jid, None)
+        if stanza.options.get('type') != 'unavailable':
+            self._states[jid] = digest
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+        if not self.window:
+            handler.deliver(stanza)
+            return
+        # a newer state replaces the one waiting (keeping its place)
+        self._pending[jid] = (stanza, handler)
+        if self._flush_timeout is None:
+            self._flush_timeout = self.io_loop.add_timeout(time.time() + self.window, self.flush)
+
+    def flush(self):
+        """Deliver the presence waiting for the window to end"""
+        if self._flush_timeout is not None:
+            self.io_loop.remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+        if not self._pending:
+            return
+        pending = self._pending.values()
+        self._pending = OrderedDict()
+        if self.batch_cb is None:
+            for stanza, handler in pending:
+                handler.deliver(stanza)
+            return
+        for stanza, handler in pending:
+            handler.update(stanza)
+        stanzas = [stanza for stanza, handler in pending]
+        try:
+            self.batch_cb(stanzas)
+        except Exception:
+            logging.exception('error in presence batch_cb')
+
+    def clear(self):
+        """Forget the last known states (ie: when the stream closes; the next session's
+        presence all gets delivered)"""
+        self.flush()
+        self._states.clear()
+
+def presence_digest(stanza):
+    """A digest of a presence stanza's state: its attributes (other than id, to and
+    from) and its content"""
+    options = sorted((key, value) for key, value in stanza.options.items() if key not in _IGNORED_OPTIONS)
+    raw = getattr(stanza, 'raw', None)
+    if raw is not None:
+        match = _START_TAG_RE.match(raw)
+        content = raw[match.end():] if match else raw
+    else:
+        content = repr([_block_state(child) for child in stanza.children]) + repr(stanza.data)
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(repr(options) + '\0' + content).digest()
+
+def _block_state(xml_blk):
+    return (xml_blk.name, sorted(xml_blk.options.items()), xml_blk.data,
+        [_block_state(child) for child in xml_blk.children])
+
+def test_presence_digest():
+    from xmlparse import LazyXmlBLock, xml2msg
+    stanzas = [
+        '<presence from="a@test/r" id="1"><show>away</show><status>out</status></presence>',
+        '<presence id="2" from="a@test/r"><show>away</show><status>out</status></presence>',
+        '<presence from="a@test/r" id="3"><show>away</show><status>back soon</status></presence>',
+        '<presence from="a@test/r" id="4" type="unavailable"/>',
+        '<presence from="a@test/r" id="5"/>',
+    ]
+    eager = [presence_digest(xml2msg(stanza)) for stanza in stanzas]
+    lazy = [presence_digest(LazyXmlBLock("presence", stanza, xml2msg(stanza).options)) for stanza in stanzas]
+    for digests in eager, lazy:
+        assert digests[0] == digests[1] and len(set(digests)) == 4
+
+def test_client_presence_coalescing():
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    flood = []
+    for i in range(3):
+        for contact in range(10):
+            # the same state three times over, except c0's status, which changes
+            status = contact == 0 and 'status %d' % i or 'here'
+            flood.append('<presence from="c%d@test/r" id="%d-%d"><status>%s</status></presence>' % (contact, i, contact, status))
+    flood.append('<presence from="c1@test/r" type="subscribe"/>')
+    def bound_cb(connection):
+        connection.replay(flood, chunk_size=200)
+    server, port = start_fake_server(io_loop, bound_cb=bound_cb)
+    for lazy in False, True:
+        client = client_for(port, io_loop, lazy_stanzas=lazy)
+        client.autoreconnect = False
+        batches = []
+        client.presence_coalescer = PresenceCoalescer(client, window=0.2, batch_cb=batches.append)
+        delivered = []
+        client.connect(connect_cb=lambda: None, message_cb=lambda stanza: None,
+            presence_cb=lambda stanza: delivered.append(stanza.options['type']))
+        io_loop.add_timeout(time.time() + 0.5, io_loop.stop)
+        io_loop.start()
+        client.stream.close()
+        assert delivered == ['subscribe'] and client.presence_coalescer.dropped == 18
+        assert len(batches) == 1 and len(batches[0]) == 10
+        assert [stanza.options['id'] for stanza in batches[0]][:2] == ['2-0', '0-1']
+        assert batches[0][0].find("status").data == 'status 2'
+        assert len(client.roster.online()) == 10
+    server.stop()
+
+def test_states_bound():
+    from xmlparse import xml2msg
+    class Handler(object):
+        def __init__(self):
+            self.delivered = []
+        def deliver(self, stanza):
+            self.delivered.append(stanza.options['id'])
+    class Client(object):
+        io_loop = None
+        metrics = None
+    coalescer = PresenceCoalescer(Client(), max_states=3)
+    handler = Handler()
+    def receive(jid, id, type=None):
+        stanza = '<presence from="%s" id="%s"%s/>' % (jid, id, type and ' type="%s"' % type or '')
+        coalescer.received(xml2msg(stanza), handler)
+    for i in range(5):
+        receive('c%d@test/r' % i, i)
+    assert list(coalescer._states) == ['c2@test/r', 'c3@test/r', 'c4@test/r']
+    # a known state is still dropped; an unavailable one is forgotten
+    receive('c4@test/r', 5)
+    receive('c3@test/r', 6, 'unavailable')
+    assert list(coalescer._states) == ['c2@test/r', 'c4@test/r']
+    receive('c3@test/r', 7)
+    assert handler.delivered == ['0', '1', '2', '3', '4', '6', '7']
+    assert coalescer.dropped == 1
@@ -0,0 +1,351 @@
+"""
+Non-blocking name resolution and connection setup for XMPPIOLoopClient: SRV and
+A/AAAA lookups run in worker threads (with their results cached), and connections
+are attempted happy eyeballs style across every address found.
+"""
+import functools
+import logging
+import Queue
+import random
+import socket
+import threading
+import time
+
+import tornado.ioloop
+import tornado.iostream
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None # SRV lookups need dnspython; without it the client connects to its host
+
+SRV_SERVICE = "_xmpp-client._tcp"
+
+class Resolver(object):
+    """Resolves hostnames and SRV records in `num_threads` worker threads, so a
+    reconnect never blocks the IOLoop on DNS. Callbacks run on the IOLoop.
+
+    getaddrinfo() doesn't say how long an answer is good for, so addresses are cached
+    for `ttl` seconds; SRV records for their own TTL (but at least `min_ttl`). Names
+    that don't resolve are cached for `negative_ttl`. Lookups of a name that's already
+    being looked up wait for that answer instead of querying again.
+
+    A Resolver can be shared by any number of clients on the same IOLoop.
+    """
+    def __init__(self, io_loop=None, num_threads=2, ttl=300, min_ttl=30, negative_ttl=30, max_entries=1000):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.num_threads = num_threads
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # key -> (expires, result)
+        self._cache = {}
+        # key -> callbacks waiting for the lookup in progress
+        self._waiting = {}
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def resolve(self, host, port, callback):
+        """callback([(family, sockaddr), ...]) with the addresses of host, or [] if it
+        doesn't resolve"""
+        address = _literal_address(host, port)
+        if address:
+            self.io_loop.add_callback(functools.partial(callback, [address]))
+            return
+        self._lookup(('addr', host, port), functools.partial(self._getaddrinfo, host, port), callback)
+
+    def resolve_srv(self, domain, callback, service=SRV_SERVICE):
+        """callback([(host, port), ...]) with the SRV targets of domain, in the order to
+        try them (RFC 2782), or [] if there are none"""
+        name = '%s.%s' % (service, domain)
+        self._lookup(('srv', name), functools.partial(self._query_srv, name),
+            lambda records: callback(order_srv(records)))
+
+    def resolve_many(self, targets, callback):
+        """Resolve each (host, port) in targets; callback gets the addresses of all of
+        them, in order of the targets, with each target's interleaved by family"""
+        if not targets:
+            self.io_loop.add_callback(functools.partial(callback, []))
+            return
+        results = [None] * len(targets)
+        remaining = [len(targets)]
+        def resolved(i, addresses):
+            results[i] = interleave(addresses)
+            remaining[0] -= 1
+            if not remaining[0]:
+                callback([address for addresses in results for address in addresses])
+        for i, (host, port) in enumerate(targets):
+            self.resolve(host, port, functools.partial(resolved, i))
+
+    def _lookup(self, key, function, callback):
+        entry = self._cache.get(key)
+        if entry and entry[0] > time.time():
+            self.io_loop.add_callback(functools.partial(callback, entry[1]))
+            return
+        if key in self._waiting:
+            self._waiting[key].append(callback)
+            return
+        self._waiting[key] = [callback]
+        if len(self._threads) < self.num_threads:
+            thread = threading.Thread(target=self._run, name='xmpp-resolver')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._queue.put((key, function))
+
+    def _run(self):
+        while True:
+            key, function = self._queue.get()
+            try:
+                result, ttl = function()
+            except Exception:
+                logging.exception('failed looking up %r', key)
+                result, ttl = [], self.negative_ttl
+            self.io_loop.add_callback(functools.partial(self._finish, key, result, ttl))
+
+    def _finish(self, key, result, ttl):
+        now = time.time()
+        self._cache.pop(key, None)
+        if len(self._cache) >= self.max_entries:
+            for cached_key, (expires, cached) in self._cache.items():
+                if expires <= now:
+                    del self._cache[cached_key]
+            # all still good: make room by dropping the ones that expire soonest
+            while len(self._cache) >= self.max_entries:
+                del self._cache[min(self._cache, key=lambda cached_key: self._cache[cached_key][0])]
+        self._cache[key] = (now + ttl, result)
+        for callback in self._waiting.pop(key, []):
+            callback(result)
+
+    # these run in the worker threads, and return (result, ttl)
+    def _getaddrinfo(self, host, port):
+        try:
+            info = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except socket.gaierror, e:
+            logging.warning('could not resolve %s: %s', host, e)
+            return [], self.negative_ttl
+        addresses = []
+        for family, socktype, proto, canonname, sockaddr in info:
+            if (family, sockaddr) not in addresses:
+                addresses.append((family, sockaddr))
+        return addresses, self.ttl
+
+    def _query_srv(self, name):
+        if dns is None:
+            return [], self.ttl
+        try:
+            answer = dns.resolver.query(name, 'SRV')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], self.negative_ttl
+        except dns.exception.DNSException, e:
+            logging.warning('SRV lookup for %s failed: %s', name, e)
+            return [], self.negative_ttl
+        records = [(record.priority, record.weight, record.port, record.target.to_text(omit_final_dot=True))
+            for record in answer]
+        return records, max(answer.rrset.ttl, self.min_ttl)
+
+class StubResolver(Resolver):
+    """A Resolver that answers from `hosts` ({hostname: [ip, ...]}) and `srv`
+    ({"_xmpp-client._tcp.domain": [(priority, weight, port, target), ...]}) instead of
+    DNS, for tests. Lookups still go through the worker threads and the cache;
+    `queries` counts the ones that got this far."""
+    def __init__(self, hosts=None, srv=None, **kwargs):
+        Resolver.__init__(self, **kwargs)
+        self.hosts = hosts or {}
+        self.srv = srv or {}
+        self.queries = 0
+
+    def _getaddrinfo(self, host, port):
+        self.queries += 1
+        addresses = [_literal_address(ip, port) for ip in self.hosts.get(host, [])]
+        return addresses, addresses and self.ttl or self.negative_ttl
+
+    def _query_srv(self, name):
+        self.queries += 1
+        return list(self.srv.get(name, [])), self.ttl
+
+def _literal_address(host, port):
+    """(family, sockaddr) if host is an IPv4 or IPv6 address, else None"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET6:
+            return family, (host, port, 0, 0)
+        return family, (host, port)
+    return None
+
+def order_srv(records):
+    """SRV records [(priority, weight, port, target), ...] as [(target, port), ...]: by
+    priority, and in weighted random order within a priority (RFC 2782)"""
+    if len(records) == 1 and records[0][3] in ('', '.'):
+        # the service is decidedly not available at this domain
+        return []
+    ordered = []
+    for priority in sorted(set(record[0] for record in records)):
+        group = [record for record in records if record[0] == priority]
+        while group:
+            total = sum(record[1] for record in group)
+            choice = random.uniform(0, total)
+            for record in group:
+                choice -= record[1]
+                if choice <= 0:
+                    break
+            group.remove(record)
+            ordered.append((record[3], record[2]))
+    return ordered
+
+def interleave(addresses):
+    """Alternate address families (RFC 8305), starting with the family of the first
+    address, so a broken IPv6 (or IPv4) path costs one attempt delay, not one per
+    address"""
+    if not addresses:
+        return []
+    first = addresses[0][0]
+    preferred = [address for address in addresses if address[0] == first]
+    other = [address for address in addresses if address[0] != first]
+    ordered = []
+    for i in range(max(len(preferred), len(other))):
+        ordered.extend(preferred[i:i + 1])
+        ordered.extend(other[i:i + 1])
+    return ordered
+
+class Connector(object):
+    """Connects to the first of `addresses` ([(family, sockaddr), ...]) that accepts,
+    happy eyeballs style: attempts start `attempt_delay` seconds apart (or as soon as
+    the last one fails) and run in parallel, and the first to connect wins; the others
+    are closed.
+
+    callback(stream) gets the connected IOStream, or None if every attempt failed or
+    nothing connected within `timeout` seconds.
+    """
+    def __init__(self, addresses, callback, io_loop=None, attempt_delay=0.25, timeout=30,
+            max_buffer_size=100 * 1024 * 1024):
+        self.addresses = list(addresses)
+        self.callback = callback
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.attempt_delay = attempt_delay
+        self.timeout = timeout
+        self.max_buffer_size = max_buffer_size
+        self._next = 0
+        self._attempts = {}
+        self._attempt_timeout = None
+        self._timeout = None
+        self._done = False
+
+    def start(self):
+        self._timeout = self.io_loop.add_timeout(time.time() + self.timeout, self._timed_out)
+        self._attempt()
+
+    def _attempt(self):
+        if self._attempt_timeout:
+            self.io_loop.remove_timeout(self._attempt_timeout)
+            self._attempt_timeout = None
+        if self._done:
+            return
+        if self._next >= len(self.addresses):
+            if not self._attempts:
+                self._finish(None)
+            return
+        family, sockaddr = self.addresses[self._next]
+        self._next += 1
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM, 0)
+        except socket.error, e:
+            logging.info('could not connect to %s: %s', sockaddr[0], e)
+            self._attempt()
+            return
+        logging.debug('connecting to %r', sockaddr)
+        stream = tornado.iostream.IOStream(sock, io_loop=self.io_loop, max_buffer_size=self.max_buffer_size)
+        self._attempts[stream] = sockaddr
+        stream.set_close_callback(functools.partial(self._failed, stream))
+        stream.connect(sockaddr, functools.partial(self._connected, stream))
+        if not stream.closed():
+            self._attempt_timeout = self.io_loop.add_timeout(time.time() + self.attempt_delay, self._attempt)
+
+    def _failed(self, stream):
+        sockaddr = self._attempts.pop(stream, None)
+        if self._done or sockaddr is None:
+            return
+        logging.info('could not connect to %r', sockaddr)
+        self._attempt()
+
+    def _connected(self, stream):
+        if self._done:
+            return
+        sockaddr = self._attempts.pop(stream)
+        logging.info('connected to %r', sockaddr)
+        stream.set_close_callback(None)
+        self._finish(stream)
+
+    def _timed_out(self):
+        self._timeout = None
+        logging.warning('timed out connecting to %r', [sockaddr for family, sockaddr in self.addresses])
+        self._finish(None)
+
+    def _finish(self, stream):
+        self._done = True
+        for timeout in (self._attempt_timeout, self._timeout):
+            if timeout:
+                self.io_loop.remove_timeout(timeout)
+        attempts, self._attempts = self._attempts, {}
+        for attempt in attempts:
+            attempt.close()
+        self.callback(stream)
+
+def test_order():
+    assert order_srv([(0, 0, 5222, '.')]) == []
+    ordered = order_srv([(20, 0, 5222, 'backup'), (10, 1, 5222, 'a'), (10, 3, 5223, 'b')])
+    assert sorted(ordered[:2]) == [('a', 5222), ('b', 5223)] and ordered[2] == ('backup', 5222)
+    v4 = [(socket.AF_INET, ('10.0.0.%d' % i, 1)) for i in range(3)]
+    v6 = [(socket.AF_INET6, ('::%d' % i, 1, 0, 0)) for i in range(2)]
+    assert interleave(v6 + v4) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+    assert _literal_address('::1', 5) == (socket.AF_INET6, ('::1', 5, 0, 0))
+    assert _literal_address('localhost', 5) is None
+
+def test_cache_bound():
+    resolver = Resolver(tornado.ioloop.IOLoop(), max_entries=3)
+    for i in range(10):
+        resolver._finish(('addr', 'host%d' % i, 5222), [], 300 + i)
+    assert sorted(resolver._cache) == [('addr', 'host%d' % i, 5222) for i in (7, 8, 9)]
+    # expired entries go first, then the ones that expire soonest
+    resolver._finish(('addr', 'expired', 5222), [], -1)
+    resolver._finish(('addr', 'short', 5222), [], 10)
+    assert sorted(key[1] for key in resolver._cache) == ['host8', 'host9', 'short']
+    resolver._finish(('addr', 'host9', 5222), [], 300)
+    assert len(resolver._cache) == 3
+
+def test_connect_srv():
+    import tornado.netutil
+    from xmpp_fakeserver import start_fake_server
+    from xmpp_ioloop import XMPPIOLoopClient
+    io_loop = tornado.ioloop.IOLoop()
+    server, port = start_fake_server(io_loop)
+    # nothing listens on the first target, or on the IPv6 address
+    closed, = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    resolver = StubResolver(io_loop=io_loop,
+        hosts={"xmpp1.test": ["127.0.0.1"], "xmpp2.test": ["::1", "127.0.0.1"]},
+        srv={"_xmpp-client._tcp.test": [(10, 0, closed_port, "xmpp1.test"), (20, 0, port, "xmpp2.test")]})
+    client = XMPPIOLoopClient("xmpp.test", domain="test", io_loop=io_loop,
+        username="bot", password="x", resource="r")
+    client.resolver = resolver
+    client.use_srv = True
+    connects = []
+    def connect_cb():
+        connects.append(client.jid)
+        if len(connects) == 1:
+            client.stream.close()
+        else:
+            io_loop.add_timeout(time.time() + 0.05, io_loop.stop)
+    client.connect(connect_cb=connect_cb, presence_cb=lambda stanza: None, message_cb=lambda stanza: None)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert connects == ["bot@test/r", "bot@test/r"]
+    # the reconnect was answered from the cache
+    assert resolver.queries == 3
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import time
+
+from xmpp_jid import JID
+
+NS_ROSTER = "jabber:iq:roster"
+NS_ROSTER_VER = "urn:xmpp:features:rosterver"
+
+# how available each <show/> is, to pick between resources with the same priority
+SHOW_RANK = {"chat": 5, None: 4, "away": 3, "xa": 2, "dnd": 1}
+
+class Presence(object):
+    """The current presence of one resource"""
+    __slots__ = 'resource', 'show', 'status', 'priority', 'updated'
+    def __init__(self, resource, show=None, status=None, priority=0):
+        self.resource = resource
+        self.show = show
+        self.status = status
+        self.priority = priority
+        self.updated = time.time()
+
+    def __repr__(self):
+        return '<Presence %s show:%s priority:%d>' % (self.resource, self.show, self.priority)
+
+class Contact(object):
+    """A bare jid, with its roster item (subscription is None if it isn't in the
+    roster) and the presence of each of its available resources"""
+    __slots__ = 'jid', 'name', 'subscription', 'ask', 'groups', 'resources', 'best'
+    def __init__(self, jid):
+        self.jid = jid
+        self.name = None
+        self.subscription = None
+        self.ask = None
+        self.groups = ()
+        self.resources = {}
+        # the full jid messages should go to, kept up to date as presence changes
+        self.best = None
+
+    def update_best(self):
+        best = None
+        for presence in self.resources.values():
+            # resources with a negative priority don't get messages sent to the bare jid
+            if presence.priority < 0:
+                continue
+            key = (presence.priority, SHOW_RANK.get(presence.show, 0), presence.updated)
+            if best is None or key > best[0]:
+                best = (key, presence.resource)
+        if best:
+            self.best = best[1] and '%s/%s' % (self.jid, best[1]) or self.jid
+        else:
+            self.best = None
+
+    def __repr__(self):
+        return '<Contact %s subscription:%s resources:%s>' % (self.jid, self.subscription, self.resources.values())
+
+class Roster(object):
+    """The roster and the presence of contacts, indexed by bare jid.
+
+    The client fills this in from the roster it requests after binding, roster pushes
+    and incoming presence; client.roster.best_resource(jid) and online() answer from
+    memory. Presence is cleared when the stream closes.
+
+    Roster versioning (XEP-0237) is used when the server supports it: after a
+    reconnect only the changes are sent. Give a `path` to keep the roster (and its
+    version) on disk so a restart doesn't download it again either.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.version = None
+        self.contacts = {}
+        self._online = set()
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def __contains__(self, jid):
+        return JID(jid).bare in self.contacts
+
+    def get(self, jid):
+        return self.contacts.get(JID(jid).bare)
+
+    def items(self):
+        """The contacts in the roster (not just seen in presence)"""
+        return [contact for contact in self.contacts.values() if contact.subscription]
+
+    def online(self):
+        """The set of bare jids with at least one available resource (don't modify it)"""
+        return self._online
+
+    def is_online(self, jid):
+        return JID(jid).bare in self._online
+
+    def best_resource(self, jid):
+        """The full jid of the available resource to send to (by priority, then show,
+        then the most recently updated), or None"""
+        contact = self.contacts.get(JID(jid).bare)
+        return contact and contact.best
+
+    def _contact(self, bare):
+        contact = self.contacts.get(bare)
+        if contact is None:
+            contact = self.contacts[bare] = Contact(bare)
+        return contact
+
+    def _drop_if_unused(self, contact):
+        if not contact.subscription and not contact.resources:
+            self.contacts.pop(contact.jid, None)
+
+    # roster
+    def query(self, versioning=False):
+        """The <query/> to request the roster with"""
+        if versioning:
+            return '<query xmlns="%s" ver="%s"/>' % (NS_ROSTER, self.version or '')
+        return '<query xmlns="%s"/>' % NS_ROSTER
+
+    def load_result(self, stanza):
+        """Apply the result of a roster request. An empty result means the version we
+        sent is current (the changes come as pushes)"""
+        query = stanza.find("query", {"xmlns": NS_ROSTER})
+        if query is None:
+            return
+        for contact in self.contacts.values():
+            contact.subscription = None
+        for item in query.children:
+            self._apply_item(item)
+        for contact in self.contacts.values():
+            self._drop_if_unused(contact)
+        self.version = query.options.get('ver')
+        self.save()
+
+    def push(self, stanza):
+        """Apply a roster push (an iq set from the server)"""
+        query = stanza.find("query", {"xmlns": NS_ROSTER})
+        for item in query.children:
+            self._apply_item(item)
+        if 'ver' in query.options:
+            self.version = query.options['ver']
+        self.save()
+
+    def _apply_item(self, item):
+        if item.name != "item" or 'jid' not in item.options:
+            return
+        contact = self._contact(JID(item.options['jid']).bare)
+        subscription = item.options.get('subscription', 'none')
+        if subscription == 'remove':
+            contact.subscription = None
+            self._drop_if_unused(contact)
+            return
+        contact.subscription = subscription
+        contact.name = item.options.get('name')
+        contact.ask = item.options.get('ask')
+        contact.groups = tuple(child.data for child in item.children if child.name == "group")
+
+    # presence
+    def update_presence(self, stanza):
+        """Apply an incoming presence stanza (subscription requests are left to the
+        application)"""
+        if 'from' not in stanza.options:
+            return
+        presence_type = stanza.options.get('type')
+        if presence_type not in (None, 'unavailable'):
+            return
+        jid = JID(stanza.options['from'])
+        contact = self.contacts.get(jid.bare)
+        if presence_type == 'unavailable':
+            if contact is None:
+                return
+            if jid.resource:
+                contact.resources.pop(jid.resource, None)
+            else:
+                contact.resources.clear()
+        else:
+            if contact is None:
+                contact = self._contact(jid.bare)
+            show = stanza.find("show")
+            status = stanza.find("status")
+            priority = stanza.find("priority")
+            try:
+                priority = priority and int(priority.data) or 0
+            except (TypeError, ValueError):
+                priority = 0
+            resource = jid.resource or ''
+            contact.resources[resource] = Presence(resource, show and show.data or None,
+                status and status.data or None, priority)
+        contact.update_best()
+        if contact.resources:
+            self._online.add(contact.jid)
+        else:
+            self._online.discard(contact.jid)
+            self._drop_if_unused(contact)
+
+    def clear_presence(self):
+        """Forget all presence (ie: when the stream closes)"""
+        for bare in self._online:
+            contact = self.contacts[bare]
+            contact.resources = {}
+            contact.best = None
+            self._drop_if_unused(contact)
+        self._online = set()
+
+    # persistence
+    def save(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        items = [dict(jid=contact.jid, name=contact.name, subscription=contact.subscription,
+                ask=contact.ask, groups=list(contact.groups))
+            for contact in self.items()]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(version=self.version, items=items), f)
+        os.rename(tmp_path, path)
+
+    def load(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            logging.exception('failed loading roster from %s', path)
+            return
+        self.version = data['version']
+        for item in data['items']:
+            contact = self._contact(item['jid'])
+            contact.name = item['name']
+            contact.subscription = item['subscription']
+            contact.ask = item['ask']
+            contact.groups = tuple(item['groups'])
+
+def test_roster():
+    from xmlparse import xml2msg
+    roster = Roster()
+    roster.load_result(xml2msg('<iq type="result" id="1"><query xmlns="jabber:iq:roster" ver="v1">'
+        '<item jid="a@test" subscription="both" name="A"><group>friends</group></item>'
+        '<item jid="b@test" subscription="to"/></query></iq>'))
+    assert roster.version == "v1" and len(roster) == 2
+    assert roster.get("a@test/x").groups == ("friends",)
+
+    roster.update_presence(xml2msg('<presence from="a@test/phone"><priority>1</priority><show>away</show></presence>'))
+    roster.update_presence(xml2msg('<presence from="a@test/laptop"><priority>1</priority></presence>'))
+    roster.update_presence(xml2msg('<presence from="a@test/bot"><priority>-1</priority></presence>'))
+    roster.update_presence(xml2msg('<presence from="c@test/r"/>'))
+    assert roster.online() == set(["a@test", "c@test"])
+    assert roster.best_resource("a@test") == "a@test/laptop"
+    roster.update_presence(xml2msg('<presence from="a@test/laptop" type="unavailable"/>'))
+    assert roster.best_resource("a@test") == "a@test/phone"
+    roster.update_presence(xml2msg('<presence from="a@test/phone" type="subscribe"/>'))
+    assert roster.best_resource("a@test") == "a@test/phone"
+
+    roster.push(xml2msg('<iq type="set" id="p1"><query xmlns="jabber:iq:roster" ver="v2">'
+        '<item jid="b@test" subscription="remove"/></query></iq>'))
+    assert "b@test" not in roster and roster.version == "v2"
+    assert roster.query(versioning=True) == '<query xmlns="jabber:iq:roster" ver="v2"/>'
+
+    roster.clear_presence()
+    assert not roster.online() and roster.best_resource("a@test") is None
+    assert "c@test" not in roster # only seen in presence
+    # an empty result means the cached roster is current
+    roster.load_result(xml2msg('<iq type="result" id="2"/>'))
+    assert [contact.jid for contact in roster.items()] == ["a@test"]
+
+def test_client_roster():
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    def bound_cb(connection):
+        connection.replay(['<presence from="a@test/phone"><priority>2</priority></presence>',
+            '<presence from="b@test/r"/>'])
+        io_loop.add_timeout(time.time() + 0.05, lambda: push(connection))
+    def push(connection):
+        server.roster_version = "v2"
+        connection.roster_push("c@test")
+        connection.roster_push("a@test", "remove")
+    server, port = start_fake_server(io_loop, roster=["a@test", "b@test"], roster_version="v1",
+        bound_cb=bound_cb)
+    client = client_for(port, io_loop)
+    client.connect(connect_cb=lambda: io_loop.add_timeout(time.time() + 0.2, io_loop.stop),
+        presence_cb=lambda stanza: None, message_cb=lambda stanza: None)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    roster = client.roster
+    assert client.roster_versioning and roster.version == "v2"
+    assert sorted(contact.jid for contact in roster.items()) == ["b@test", "c@test"]
+    assert roster.online() == set(["a@test", "b@test"])
+    assert roster.best_resource("a@test") == "a@test/phone"
+    assert roster.query(client.roster_versioning) == '<query xmlns="jabber:iq:roster" ver="v2"/>'
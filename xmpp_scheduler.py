@@ -0,0 +1,234 @@
+import logging
+import time
+from collections import deque
+
+# priority classes; lower numbers are sent first
+PRIORITY_IQ = 0
+PRIORITY_PRESENCE = 1
+PRIORITY_MESSAGE = 2
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DROP_ERROR = "error"
+
+class QueueFull(Exception):
+    pass
+
+class TokenBucket(object):
+    """Allows `rate` sends per second on average, with bursts of up to `burst`"""
+    __slots__ = 'rate', 'burst', 'tokens', 'last'
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = now or time.time()
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def ready(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def consume(self, now):
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self, now):
+        """seconds until a token is available"""
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class OutboundScheduler(object):
+    """Rate limited, prioritized sending of stanzas for an XMPPIOLoopClient.
+
+    Sends are limited by a token bucket for the connection (`rate`/`burst`) and one per
+    destination bare jid (`jid_rate`/`jid_burst`). Anything that can't be sent right
+    away is queued by priority class (iq, then presence, then messages) and written as
+    tokens become available; stanzas for the same destination stay in order.
+
+    At most `max_queue` stanzas are held; past that `drop_policy` decides between
+    dropping the oldest lowest priority stanza, dropping the new one, or raising
+    QueueFull.
+
+    >> client.scheduler = OutboundScheduler(client, rate=10, burst=20, jid_rate=1, jid_burst=5)
+    """
+    def __init__(self, client, rate=None, burst=None, jid_rate=None, jid_burst=None,
+            max_queue=10000, drop_policy=DROP_OLDEST, max_tracked_jids=10000):
+        assert drop_policy in [DROP_OLDEST, DROP_NEWEST, DROP_ERROR]
+        self.client = client
+        self.io_loop = client.io_loop
+        self.bucket = rate and TokenBucket(rate, burst)
+        self.jid_rate = jid_rate
+        self.jid_burst = jid_burst
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.max_tracked_jids = max_tracked_jids
+        self.dropped = 0
+        self._jid_buckets = {}
+        self._queues = [deque(), deque(), deque()]
+        self._queued = 0
+        self._drain_timeout = None
+        self._drain_scheduled = False
+
+    def queue_depth(self):
+        return self._queued
+
+    def depths(self):
+        """queue depth for each priority class"""
+        return dict(iq=len(self._queues[PRIORITY_IQ]),
+            presence=len(self._queues[PRIORITY_PRESENCE]),
+            message=len(self._queues[PRIORITY_MESSAGE]))
+
+    def send(self, data, priority=PRIORITY_MESSAGE, to=None):
+        jid = to and to.split('/', 1)[0]
+        if not self._queued and self.client._connected and self._take(jid, time.time()):
+            self.client.write(data)
+            return
+        if self._queued >= self.max_queue:
+            if self.drop_policy == DROP_ERROR:
+                raise QueueFull("%d stanzas queued" % self._queued)
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST or not self._drop_oldest(priority):
+                logging.warning('outbound queue full. dropping %r', data)
+                return
+        self._queues[priority].append((jid, data))
+        self._queued += 1
+        self.schedule_drain()
+
+    def _drop_oldest(self, priority):
+        # drop the oldest stanza of the lowest priority class at or below `priority`
+        for queue in reversed(self._queues[priority:]):
+            if queue:
+                jid, data = queue.popleft()
+                self._queued -= 1
+                logging.warning('outbound queue full. dropping %r', data)
+                return True
+        return False
+
+    def _take(self, jid, now):
+        # consume tokens for one send to jid if both buckets allow it
+        jid_bucket = None
+        if jid and self.jid_rate:
+            jid_bucket = self._jid_buckets.get(jid)
+            if jid_bucket is None:
+                if len(self._jid_buckets) >= self.max_tracked_jids:
+                    self._prune_jid_buckets(now)
+                jid_bucket = self._jid_buckets[jid] = TokenBucket(self.jid_rate, self.jid_burst, now)
+            if not jid_bucket.ready(now):
+                return False
+        if self.bucket and not self.bucket.consume(now):
+            return False
+        if jid_bucket:
+            jid_bucket.consume(now)
+        return True
+
+    def _prune_jid_buckets(self, now):
+        # a full bucket is the same as a new one
+        for jid, bucket in self._jid_buckets.items():
+            if bucket.full(now):
+                del self._jid_buckets[jid]
+
+    def schedule_drain(self, delay=0):
+        if self._drain_scheduled:
+            return
+        self._drain_scheduled = True
+        if delay:
+            self._drain_timeout = self.io_loop.add_timeout(time.time() + delay, self.drain)
+        else:
+            self.io_loop.add_callback(self.drain)
+
+    def drain(self):
+        """Send as many queued stanzas as the rate limits allow"""
+        self._drain_scheduled = False
+        if self._drain_timeout:
+            self.io_loop.remove_timeout(self._drain_timeout)
+            self._drain_timeout = None
+        if not self._queued or not self.client._connected:
+            # set_connected drains anything queued while disconnected
+            return
+
+        now = time.time()
+        wait = None
+        for queue in self._queues:
+            deferred = deque()
+            blocked = set()
+            while queue:
+                if self.bucket and not self.bucket.ready(now):
+                    wait = self.bucket.delay(now)
+                    break
+                jid, data = queue.popleft()
+                if jid in blocked or not self._take(jid, now):
+                    # keep later stanzas for this jid behind this one
+                    blocked.add(jid)
+                    deferred.append((jid, data))
+                    jid_bucket = self._jid_buckets.get(jid)
+                    if jid_bucket:
+                        jid_wait = jid_bucket.delay(now)
+                        if wait is None or jid_wait < wait:
+                            wait = jid_wait
+                    continue
+                self._queued -= 1
+                self.client.write(data)
+            deferred.extend(queue)
+            queue.clear()
+            queue.extend(deferred)
+            if self.bucket and not self.bucket.ready(now):
+                break
+
+        if self._queued:
+            if wait is None:
+                wait = self.bucket and self.bucket.delay(now) or 0
+            self.schedule_drain(max(wait, 0.001))
+
+    def clear(self):
+        for queue in self._queues:
+            queue.clear()
+        self._queued = 0
+
+def test_scheduler():
+    class StubIOLoop(object):
+        def add_callback(self, callback):
+            pass
+        def add_timeout(self, deadline, callback):
+            return callback
+        def remove_timeout(self, timeout):
+            pass
+    class StubClient(object):
+        io_loop = StubIOLoop()
+        _connected = True
+        def __init__(self):
+            self.written = []
+        def write(self, data):
+            self.written.append(data)
+
+    client = StubClient()
+    scheduler = OutboundScheduler(client, rate=1000, burst=1000, jid_rate=0.001, jid_burst=2, max_queue=4)
+    for i in range(4):
+        scheduler.send('m%d' % i, to='a@test/r')
+    scheduler.send('iq', PRIORITY_IQ, to='b@test')
+    scheduler.send('m4', to='c@test')
+    assert client.written == ['m0', 'm1']
+    scheduler.drain()
+    # a@test used up its burst; the iq goes first and c@test isn't held up
+    assert client.written == ['m0', 'm1', 'iq', 'm4']
+    assert scheduler.queue_depth() == 2
+
+    scheduler.send('m5', to='c@test')
+    scheduler.send('iq2', PRIORITY_IQ, to='a@test')
+    # the queue is full, so the oldest message is dropped
+    scheduler.send('m6', to='d@test')
+    assert scheduler.dropped == 1
+    assert scheduler.depths() == dict(iq=1, presence=0, message=3)
+    scheduler._jid_buckets['a@test'].tokens = 2
+    scheduler.drain()
+    assert client.written[4:] == ['iq2', 'm3', 'm5', 'm6']
@@ -0,0 +1,233 @@
+"""
+Many XMPPIOLoopClient sessions (ie: one per account) on one IOLoop, connected and
+reconnected by a SessionManager instead of each client's own autoreconnect, so a
+network blip doesn't have every client reconnecting (and doing its TLS handshake) at once.
+
+    >> manager = SessionManager(max_connecting=10)
+    >> manager.add(client, connect_cb, presence_cb, message_cb, priority=10)
+    >> manager.health()['connected']
+"""
+import functools
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import tornado.ioloop
+
+class SessionManager(object):
+    """Connects the clients add()ed to it, at most `max_connecting` at a time (a
+    connect lasts until the session is bound, or until `connect_timeout`), higher
+    `priority` clients first. Connects start on the next IOLoop iteration, so clients
+    added together are started in priority order.
+
+    A client that fails to connect, or is disconnected, reconnects after a random delay
+    between 0 and base_delay * 2 ** failures (at most max_delay). Failures count up
+    until a session has stayed connected for `stable_after` seconds.
+    
+    Every client uses the first client's resolver, so a reconnect storm looks each
+    name up once.
+    """
+    def __init__(self, io_loop=None, max_connecting=10, base_delay=1, max_delay=300, stable_after=60,
+            connect_timeout=60):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.max_connecting = max_connecting
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.connect_timeout = connect_timeout
+        self.sessions = []
+        self.connects = 0
+        self.disconnects = 0
+        # how long it last took for every session to be connected again
+        self.last_recovery_time = None
+        self._degraded_since = None
+        # (-priority, order, session)s waiting for a connect slot
+        self._ready = []
+        self._order = itertools.count()
+        self._connecting = 0
+        self._start_scheduled = False
+        self.resolver = None
+
+    def add(self, client, connect_cb, presence_cb, message_cb, close_cb=None, priority=0):
+        """Take over connecting `client`; the callbacks are as for client.connect()"""
+        client.autoreconnect = False
+        if self.resolver is None:
+            self.resolver = client.resolver
+        else:
+            client.resolver = self.resolver
+        session = _Session(client, priority, connect_cb, presence_cb, message_cb, close_cb)
+        self.sessions.append(session)
+        if self._degraded_since is None:
+            self._degraded_since = time.time()
+        self._queue(session)
+        return session
+
+    def remove(self, client):
+        """Stop managing `client` (it stays connected, with autoreconnect off)"""
+        for session in self.sessions:
+            if session.client is client:
+                break
+        else:
+            raise ValueError('%r is not managed' % client)
+        self.sessions.remove(session)
+        session.removed = True
+        self._cancel_timeouts(session)
+        if session.state == _CONNECTING:
+            self._release()
+        self._check_recovered()
+
+    def _queue(self, session):
+        session.state = _READY
+        session.timeout = None
+        heapq.heappush(self._ready, (-session.priority, next(self._order), session))
+        if not self._start_scheduled:
+            self._start_scheduled = True
+            self.io_loop.add_callback(self._start_connects)
+
+    def _start_connects(self):
+        self._start_scheduled = False
+        while self._ready and self._connecting < self.max_connecting:
+            session = heapq.heappop(self._ready)[2]
+            if session.removed:
+                continue
+            self._connecting += 1
+            session.state = _CONNECTING
+            session.timeout = self.io_loop.add_timeout(time.time() + self.connect_timeout,
+                functools.partial(self._connect_timed_out, session))
+            client = session.client
+            logging.debug('connecting %s (%d connecting, %d waiting)', client.jid, self._connecting,
+                len(self._ready))
+            client.connect(connect_cb=functools.partial(self._connected, session),
+                presence_cb=session.presence_cb, message_cb=session.message_cb,
+                close_cb=functools.partial(self._closed, session))
+
+    def _release(self):
+        self._connecting -= 1
+        self._start_connects()
+
+    def _cancel_timeouts(self, session):
+        if session.timeout:
+            self.io_loop.remove_timeout(session.timeout)
+            session.timeout = None
+
+    def _connect_timed_out(self, session):
+        session.timeout = None
+        stream = getattr(session.client, 'stream', None)
+        if stream and not stream.closed():
+            logging.warning('%s took over %d seconds to connect', session.client.jid, self.connect_timeout)
+            # its close_cb reschedules it
+            stream.close()
+        else:
+            # still resolving or connecting, which time out on their own
+            session.timeout = self.io_loop.add_timeout(time.time() + self.connect_timeout,
+                functools.partial(self._connect_timed_out, session))
+
+    def _connected(self, session):
+        if session.removed:
+            session.connect_cb()
+            return
+        self._cancel_timeouts(session)
+        if session.state == _CONNECTING:
+            self._release()
+        session.state = _CONNECTED
+        session.connected_at = time.time()
+        self.connects += 1
+        self._check_recovered()
+        session.connect_cb()
+
+    def _closed(self, session):
+        if session.removed:
+            if session.close_cb:
+                session.close_cb()
+            return
+        self._cancel_timeouts(session)
+        now = time.time()
+        if session.state == _CONNECTING:
+            self._release()
+        elif session.state == _CONNECTED:
+            self.disconnects += 1
+            if now - session.connected_at >= self.stable_after:
+                session.failures = 0
+        if self._degraded_since is None:
+            self._degraded_since = now
+        session.failures += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** session.failures))
+        logging.warning('%s reconnecting in %0.2f seconds', session.client.jid, delay)
+        session.state = _BACKING_OFF
+        session.timeout = self.io_loop.add_timeout(now + delay, functools.partial(self._queue, session))
+        if session.close_cb:
+            session.close_cb()
+
+    def _check_recovered(self):
+        if self._degraded_since is not None and all(session.state == _CONNECTED for session in self.sessions):
+            recovery_time = time.time() - self._degraded_since
+            self._degraded_since = None
+            self.last_recovery_time = recovery_time
+            logging.info('all %d sessions connected after %0.2f seconds', len(self.sessions), recovery_time)
+
+    def health(self):
+        """Counts of sessions by state, and how long they've been (or last were) recovering"""
+        states = dict.fromkeys([_READY, _CONNECTING, _CONNECTED, _BACKING_OFF], 0)
+        for session in self.sessions:
+            states[session.state] += 1
+        return dict(states,
+            sessions=len(self.sessions),
+            connects=self.connects,
+            disconnects=self.disconnects,
+            degraded_for=self._degraded_since and time.time() - self._degraded_since or 0,
+            last_recovery_time=self.last_recovery_time,
+            max_failures=max([session.failures for session in self.sessions] or [0]))
+
+_READY = "ready"
+_CONNECTING = "connecting"
+_CONNECTED = "connected"
+_BACKING_OFF = "backing_off"
+
+class _Session(object):
+    def __init__(self, client, priority, connect_cb, presence_cb, message_cb, close_cb):
+        self.client = client
+        self.priority = priority
+        self.connect_cb = connect_cb
+        self.presence_cb = presence_cb
+        self.message_cb = message_cb
+        self.close_cb = close_cb
+        self.state = _READY
+        self.failures = 0
+        self.connected_at = None
+        self.timeout = None
+        self.removed = False
+
+def test_session_manager():
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    server, port = start_fake_server(io_loop)
+    manager = SessionManager(io_loop=io_loop, max_connecting=2, base_delay=0.05, max_delay=0.2)
+    connected = []
+    connecting = []
+    def connect_cb(name):
+        connected.append(name)
+        connecting.append(manager.health()['connecting'])
+        if len(connected) == 6:
+            # every session drops at once
+            for connection in list(server.connections):
+                connection.stream.close()
+        elif len(connected) == 12:
+            io_loop.stop()
+    for i in range(6):
+        client = client_for(port, io_loop, username="bot%d" % i)
+        manager.add(client, functools.partial(connect_cb, i), lambda stanza: None, lambda stanza: None,
+            priority=i % 3)
+    assert manager.health()['ready'] == 6
+    assert len(set(id(session.client.resolver) for session in manager.sessions)) == 1
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    # priority 2 first, then 1, then 0
+    assert [i % 3 for i in connected[:6]] == [2, 2, 1, 1, 0, 0]
+    assert sorted(connected[6:]) == range(6) and max(connecting) <= 2
+    health = manager.health()
+    assert health['connected'] == health['sessions'] == 6 and health['disconnects'] == 6
+    assert health['degraded_for'] == 0 and 0 < health['last_recovery_time'] < 5
+    assert health['max_failures'] == 1
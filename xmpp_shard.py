@@ -0,0 +1,330 @@
+import bisect
+import functools
+import hashlib
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.process
+
+from xmlparse import XmlBLock
+from xmpp_ioloop import XMPPIOLoopClient
+from xmpp_sessions import SessionManager
+
+# commands the coordinator can run on a worker's client
+WORKER_COMMANDS = ["message", "message_many", "presence", "iq"]
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes; adding or removing a node only moves
+    the keys that hash next to it"""
+    def __init__(self, nodes, replicas=100):
+        self.replicas = replicas
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash('%s:%d' % (node, i)), node))
+        self._ring.sort()
+        self._hashes = [h for h, node in self._ring]
+
+    def _hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get(self, key):
+        i = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+def account_id(account):
+    return '%s@%s/%s' % (account['username'], account.get('domain') or account['host'], account['resource'])
+
+def _block_to_wire(xml_blk):
+    return [xml_blk.name, dict(xml_blk.options), xml_blk.data, [_block_to_wire(child) for child in xml_blk.children]]
+
+def _block_from_wire(wire):
+    name, options, data, children = wire
+    return XmlBLock(name=name, data=data, options=options, children=[_block_from_wire(child) for child in children])
+
+class ShardSupervisor(object):
+    """Runs many XMPPIOLoopClient accounts across `num_workers` forked processes (one
+    IOLoop each) so parsing and dispatch can use every core.
+
+    `accounts` is a list of XMPPIOLoopClient keyword arguments (host, domain, username,
+    password, resource, ...). Each account is assigned to a worker by consistent hashing
+    of its jid. Workers talk to this process over a unix socketpair; the application
+    uses the supervisor as if it were one client, addressing each call by account jid,
+    and its callbacks are called with (account_jid, stanza).
+
+    Call start() before starting the IOLoop, and stop() to shut the workers down. A
+    worker that exits is restarted after restart_delay seconds, doubling (up to
+    max_restart_delay) each time it exits again within `stable_after` seconds of
+    starting; after `max_restarts` such exits in a row it isn't restarted again.
+
+    >> supervisor = ShardSupervisor(accounts, num_workers=4)
+    >> supervisor.start(connect_cb, presence_cb, message_cb)
+    >> tornado.ioloop.IOLoop.instance().start()
+    """
+    def __init__(self, accounts, num_workers=None, io_loop=None, restart_delay=1, max_restart_delay=60,
+            max_restarts=10, stable_after=60):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.num_workers = num_workers or tornado.process.cpu_count()
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts
+        self.stable_after = stable_after
+        self.ring = HashRing(range(self.num_workers))
+        self.accounts = dict((account_id(account), account) for account in accounts)
+        self._streams = {}
+        self._pids = {}
+        # index -> when it was started, its exits in a row, its restart timeout
+        self._started = {}
+        self.failures = {}
+        self._restarts = {}
+        self._stopped = False
+
+    def worker_for(self, account_jid):
+        return self.ring.get(account_jid)
+
+    def start(self, connect_cb, presence_cb, message_cb, close_cb=None):
+        self.connect_cb = connect_cb
+        self.presence_cb = presence_cb
+        self.message_cb = message_cb
+        self.close_cb = close_cb
+        self._stopped = False
+        for index in range(self.num_workers):
+            self._start_worker(index)
+
+    def stop(self):
+        """Terminate the workers and wait for them to exit; they aren't restarted"""
+        self._stopped = True
+        for timeout in self._restarts.values():
+            self.io_loop.remove_timeout(timeout)
+        self._restarts.clear()
+        for index, pid in self._pids.items():
+            stream = self._streams.pop(index, None)
+            if stream:
+                stream.set_close_callback(None)
+                stream.close()
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass # already exited and reaped
+        self._pids.clear()
+
+    def _start_worker(self, index):
+        self._restarts.pop(index, None)
+        accounts = [(jid, account) for jid, account in self.accounts.items() if self.worker_for(jid) == index]
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for stream in self._streams.values():
+                stream.socket.close()
+            try:
+                _worker_main(index, child_sock, accounts)
+            except Exception:
+                logging.exception('worker %d failed', index)
+            os._exit(0)
+        child_sock.close()
+        logging.info('started worker %d (pid %d) with %d accounts', index, pid, len(accounts))
+        self._pids[index] = pid
+        self._started[index] = time.time()
+        stream = tornado.iostream.IOStream(parent_sock, io_loop=self.io_loop)
+        stream.set_close_callback(functools.partial(self._worker_closed, index))
+        self._streams[index] = stream
+        self._read_worker(index)
+
+    def _worker_closed(self, index):
+        pid = self._pids.pop(index, None)
+        self._streams.pop(index, None)
+        if pid:
+            self._reap(pid)
+        if self._stopped:
+            return
+        if time.time() - self._started[index] >= self.stable_after:
+            self.failures[index] = 0
+        self.failures[index] = self.failures.get(index, 0) + 1
+        if self.max_restarts is not None and self.failures[index] > self.max_restarts:
+            logging.error('worker %d exited %d times in a row. not restarting it', index, self.failures[index])
+            return
+        delay = min(self.max_restart_delay, self.restart_delay * 2 ** (self.failures[index] - 1))
+        logging.warning('worker %d exited. restarting in %0.2f seconds', index, delay)
+        self._restarts[index] = self.io_loop.add_timeout(time.time() + delay,
+            functools.partial(self._start_worker, index))
+
+    def _reap(self, pid):
+        # the socket can close before the worker has exited; keep trying so it isn't left a zombie
+        try:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            return # already reaped
+        if not reaped:
+            self.io_loop.add_timeout(time.time() + 0.1, functools.partial(self._reap, pid))
+
+    def _read_worker(self, index):
+        stream = self._streams.get(index)
+        if stream and not stream.closed():
+            stream.read_until('\n', functools.partial(self._finish_worker_read, index))
+
+    def _finish_worker_read(self, index, line):
+        try:
+            event, account_jid, wire = json.loads(line)
+            if event == "connect":
+                self.connect_cb(account_jid)
+            elif event == "close":
+                if self.close_cb:
+                    self.close_cb(account_jid)
+            elif event == "message":
+                self.message_cb(account_jid, _block_from_wire(wire))
+            elif event == "presence":
+                self.presence_cb(account_jid, _block_from_wire(wire))
+        except Exception:
+            logging.exception('error handling %r from worker %d', line, index)
+        self._read_worker(index)
+
+    def _command(self, account_jid, command, **kwargs):
+        assert account_jid in self.accounts, "unknown account %r" % account_jid
+        stream = self._streams.get(self.worker_for(account_jid))
+        if not stream or stream.closed():
+            logging.warning('worker for %s is not running. dropping %s', account_jid, command)
+            return
+        stream.write(json.dumps([command, account_jid, kwargs]) + '\n')
+
+    def message(self, account_jid, to, body):
+        self._command(account_jid, "message", to=to, body=body)
+
+    def message_many(self, account_jid, recipients, body):
+        self._command(account_jid, "message_many", recipients=recipients, body=body)
+
+    def presence(self, account_jid, **kwargs):
+        self._command(account_jid, "presence", **kwargs)
+
+    def iq(self, account_jid, type, body, **kwargs):
+        self._command(account_jid, "iq", type=type, body=body, **kwargs)
+
+def _worker_main(index, sock, accounts):
+    # a fresh IOLoop; the parent's IOLoop.instance() must not be used after fork
+    io_loop = tornado.ioloop.IOLoop()
+    stream = tornado.iostream.IOStream(sock, io_loop=io_loop)
+    stream.set_close_callback(io_loop.stop) # the coordinator went away
+
+    def send(event, account_jid, xml_blk=None):
+        wire = xml_blk and _block_to_wire(xml_blk)
+        stream.write(json.dumps([event, account_jid, wire]) + '\n')
+
+    clients = {}
+    # staggers the worker's (re)connects
+    manager = SessionManager(io_loop=io_loop)
+    for account_jid, account in accounts:
+        client = XMPPIOLoopClient(io_loop=io_loop, **account)
+        clients[account_jid] = client
+        manager.add(client, connect_cb=functools.partial(send, "connect", account_jid),
+            presence_cb=functools.partial(send, "presence", account_jid),
+            message_cb=functools.partial(send, "message", account_jid),
+            close_cb=functools.partial(send, "close", account_jid))
+
+    def read_command():
+        if not stream.closed():
+            stream.read_until('\n', finish_command)
+
+    def finish_command(line):
+        command, account_jid, kwargs = json.loads(line)
+        client = clients.get(account_jid)
+        if command in WORKER_COMMANDS and client:
+            try:
+                getattr(client, command)(**dict((str(key), value) for key, value in kwargs.items()))
+            except Exception:
+                logging.exception('worker %d: %s for %s failed', index, command, account_jid)
+        else:
+            logging.error('worker %d: invalid command %r for %r', index, command, account_jid)
+        read_command()
+
+    read_command()
+    io_loop.start()
+
+def test_hash_ring():
+    keys = ['bot%d@test/r' % i for i in range(1000)]
+    ring = HashRing(range(4))
+    before = dict((key, ring.get(key)) for key in keys)
+    assert set(before.values()) == set(range(4))
+    same_ring = HashRing(range(4))
+    assert before == dict((key, same_ring.get(key)) for key in keys)
+    # a fifth node only takes keys from the others
+    ring = HashRing(range(5))
+    moved = [key for key in keys if ring.get(key) != before[key]]
+    assert all(ring.get(key) == 4 for key in moved)
+    assert len(moved) < len(keys) / 3
+
+def test_supervisor():
+    from xmpp_fakeserver import start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    def bound_cb(connection):
+        connection.replay(['<message from="peer@test/x"><body>hello %s</body></message>' % connection.jid])
+    server, port = start_fake_server(io_loop, bound_cb=bound_cb,
+        stanza_cb=lambda connection, stanza: received.append((connection.jid, stanza.find("body").data)))
+    accounts = [dict(host="127.0.0.1", port=port, domain="test", username="bot%d" % i,
+        password="x", resource="r") for i in range(4)]
+    supervisor = ShardSupervisor(accounts, num_workers=2, io_loop=io_loop, restart_delay=0.1)
+    assert set(supervisor.worker_for(jid) for jid in supervisor.accounts) == set([0, 1])
+    connected = []
+    messages = []
+    killed = []
+    def connect_cb(account_jid):
+        connected.append(account_jid)
+        supervisor.message(account_jid, "peer@test", "from %s" % account_jid)
+        if len(connected) == 4:
+            # one worker dies; its accounts come back when it's restarted
+            killed.append(supervisor._pids[0])
+            os.kill(killed[0], signal.SIGKILL)
+        elif len(connected) == 4 + len([jid for jid in supervisor.accounts if supervisor.worker_for(jid) == 0]):
+            io_loop.add_timeout(time.time() + 0.2, io_loop.stop)
+    def message_cb(account_jid, stanza):
+        messages.append((account_jid, stanza.find("body").data))
+        raise ValueError("an error in a callback doesn't stop the worker's events")
+    supervisor.start(connect_cb, lambda account_jid, stanza: None, message_cb)
+    io_loop.add_timeout(time.time() + 10, io_loop.stop)
+    try:
+        io_loop.start()
+    finally:
+        supervisor.stop()
+        server.stop()
+    restarted = sorted(jid for jid in supervisor.accounts if supervisor.worker_for(jid) == 0)
+    assert sorted(connected[:4]) == sorted(supervisor.accounts) and sorted(connected[4:]) == restarted
+    # events and commands for both workers went through
+    assert set(messages) == set((jid, "hello %s" % jid) for jid in supervisor.accounts)
+    assert set(received) == set((jid, "from %s" % jid) for jid in connected)
+    assert killed[0] not in supervisor._pids.values()
+    # the killed worker was reaped
+    try:
+        os.waitpid(killed[0], os.WNOHANG)
+        assert False, "worker %d was not reaped" % killed[0]
+    except OSError:
+        pass
+    assert not supervisor._pids and supervisor.failures == {0: 1}
+
+def test_supervisor_restart_limit():
+    io_loop = tornado.ioloop.IOLoop()
+    # a worker that fails as it starts (XMPPIOLoopClient doesn't take `bogus`)
+    accounts = [dict(host="127.0.0.1", domain="test", username="bot", password="x", resource="r", bogus=True)]
+    supervisor = ShardSupervisor(accounts, num_workers=1, io_loop=io_loop, restart_delay=0.05, max_restarts=3)
+    started = []
+    start_worker = supervisor._start_worker
+    def record_start(index):
+        started.append(time.time())
+        start_worker(index)
+    supervisor._start_worker = record_start
+    supervisor.start(lambda account_jid: None, lambda account_jid, stanza: None, lambda account_jid, stanza: None)
+    io_loop.add_timeout(time.time() + 1, io_loop.stop)
+    io_loop.start()
+    supervisor.stop()
+    # started, then restarted 3 times with doubling delays
+    assert len(started) == 4 and supervisor.failures == {0: 4} and not supervisor._pids
+    delays = [b - a for a, b in zip(started, started[1:])]
+    assert all(delay >= 0.045 * 2 ** i for i, delay in enumerate(delays))
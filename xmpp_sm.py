@@ -0,0 +1,294 @@
+import logging
+import time
+from collections import deque
+
+from xmpp_handlers import Handler
+
+NS_SM = "urn:xmpp:sm:3"
+# the elements counted by stream management (not nonzas like <r/> and <a/>)
+SM_STANZAS = frozenset(["message", "presence", "iq"])
+_STANZA_PREFIXES = ('<message', '<presence', '<iq')
+# h wraps at 2^32
+H_MODULO = 2 ** 32
+
+class StreamManagement(object):
+    """Stream management (XEP-0198) for an XMPPIOLoopClient: stanza acks and resuming
+    the session after a disconnect.
+
+    Once bound the client enables stream management (if the server offers it).
+    Inbound stanzas are counted and acked when the server asks; outbound stanzas are
+    kept until the server acks them, asking for an ack every `ack_every` stanzas or
+    `ack_interval` seconds. At most `max_unacked` are kept.
+
+    When the stream closes, stanzas sent until the client reconnects are held, and
+    iq requests in flight wait for their responses. After authenticating again the
+    client resumes the session instead of binding: the server says what it received,
+    and the rest are resent. There is no new bind, roster fetch or presence burst
+    (`resumed` is True when connect_cb is called). If the session can't be resumed,
+    the client binds a new one and then resends the held messages and presence (which
+    may mean some are received twice).
+
+    >> client.sm = StreamManagement(client)
+    """
+    def __init__(self, client, ack_every=20, ack_interval=5, max_unacked=10000, resume=True):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.ack_every = ack_every
+        self.ack_interval = ack_interval
+        self.max_unacked = max_unacked
+        self.resume = resume
+        self.supported = False
+        self.resumed = False
+        self.dropped = 0
+        self._fallback = None
+        self._resend = None
+        self._reset()
+
+    def _reset(self):
+        # session is True from enabling until the session can't be resumed
+        self.session = False
+        self.acking = False
+        self.resume_id = None
+        self.resume_max = None
+        self.jid = None
+        self.inbound = 0
+        self.outbound = 0
+        self.acked = 0
+        self.unacked = deque()
+        self._closed_at = None
+        self._since_request = 0
+        self._clear_ack_timeout()
+
+    def _clear_ack_timeout(self):
+        timeout = getattr(self, '_ack_timeout', None)
+        if timeout:
+            self.io_loop.remove_timeout(timeout)
+        self._ack_timeout = None
+
+    def resumable(self):
+        if not self.resume_id:
+            return False
+        if self._closed_at and self.resume_max and time.time() - self._closed_at > self.resume_max:
+            return False
+        return True
+
+    def _add_handlers(self):
+        handler = SMHandler(self)
+        for name in ["enabled", "resumed", "failed", "a", "r"]:
+            self.client.add_handler(name, handler)
+
+    # called by the client
+    def features(self, stanza):
+        self.supported = bool(stanza.find("sm", [("xmlns", NS_SM)]))
+
+    def try_resume(self, fallback):
+        """Resume the previous session, if there is one; otherwise returns False.
+        fallback() is called to bind a new session if the server won't resume it"""
+        self.resumed = False
+        if not self.supported or not self.resumable():
+            if self.session:
+                self._resume_failed()
+            return False
+        logging.info('resuming session %s', self.resume_id)
+        self._fallback = fallback
+        self._add_handlers()
+        self.client.write('<resume xmlns="%s" h="%d" previd="%s"/>' % (NS_SM, self.inbound, self.resume_id))
+        return True
+
+    def session_started(self, resumed=False):
+        """The session was resumed (resend what the server didn't get) or a new one was
+        bound (enable stream management, and send anything held from a session that
+        couldn't be resumed)"""
+        self._add_handlers()
+        if resumed:
+            resend, self._resend = self._resend, None
+            for data in resend:
+                self.client.write(data)
+            return
+        if not self.supported:
+            return
+        held, self.unacked = self.unacked, deque()
+        self.session = True
+        self.acking = False
+        self.inbound = self.outbound = self.acked = 0
+        self.jid = self.client.jid
+        self.client.write('<enable xmlns="%s"%s/>' % (NS_SM, self.resume and ' resume="true"' or ''))
+        for data in held:
+            self.client.write(data)
+
+    def received(self, name):
+        """Count an inbound stanza (every one, whether it was handled or dropped)"""
+        if self.acking and name in SM_STANZAS:
+            self.inbound = (self.inbound + 1) % H_MODULO
+
+    def track(self, data):
+        """Keep an outbound stanza until it's acked. Returns True if it shouldn't be
+        written now (it's held until the session is resumed)"""
+        if not self.session or not data.startswith(_STANZA_PREFIXES):
+            return False
+        if len(self.unacked) >= self.max_unacked:
+            self.unacked.popleft()
+            self.acked = (self.acked + 1) % H_MODULO
+            self.dropped += 1
+        self.unacked.append(data)
+        self.outbound = (self.outbound + 1) % H_MODULO
+        if not self.client.connected:
+            return True
+        self._since_request += 1
+        if self._since_request >= self.ack_every:
+            self.io_loop.add_callback(self.request_ack)
+        elif not self._ack_timeout:
+            self._ack_timeout = self.io_loop.add_timeout(time.time() + self.ack_interval, self.request_ack)
+        return False
+
+    def request_ack(self):
+        self._clear_ack_timeout()
+        if self._since_request and self.client.connected:
+            self._since_request = 0
+            self.client.write('<r xmlns="%s"/>' % NS_SM)
+
+    def closed(self):
+        self.acking = False
+        self._clear_ack_timeout()
+        self._since_request = 0
+        if self.session:
+            self._closed_at = time.time()
+
+    # stanzas from the server
+    def handle(self, stanza):
+        name = stanza.name
+        if name == "r":
+            self.client.write('<a xmlns="%s" h="%d"/>' % (NS_SM, self.inbound))
+        elif name == "a":
+            self._acked(stanza)
+        elif name == "enabled":
+            self.acking = True
+            if stanza.options.get('resume') in ('true', '1'):
+                self.resume_id = stanza.options.get('id')
+                self.resume_max = int(stanza.options.get('max') or 0) or None
+            logging.info('stream management enabled (resume id %s)', self.resume_id)
+        elif name == "resumed":
+            self._acked(stanza)
+            self._resumed()
+        elif name == "failed":
+            if self.client.connected:
+                logging.warning('could not enable stream management: %r', stanza)
+                self._reset()
+            else:
+                logging.warning('could not resume session %s: %r', self.resume_id, stanza)
+                self._resume_failed()
+                fallback, self._fallback = self._fallback, None
+                fallback()
+
+    def _acked(self, stanza):
+        try:
+            h = int(stanza.options.get('h'))
+        except (TypeError, ValueError):
+            return
+        count = (h - self.acked) % H_MODULO
+        if count > len(self.unacked):
+            logging.warning('server acked %d stanzas, but only %d were sent', count, len(self.unacked))
+            count = len(self.unacked)
+        for i in range(count):
+            self.unacked.popleft()
+        self.acked = h
+
+    def _resumed(self):
+        logging.info('resumed session %s', self.resume_id)
+        self.acking = True
+        self.resumed = True
+        self._closed_at = None
+        self._fallback = None
+        # what the server didn't get is written (and tracked) again
+        self._resend, self.unacked = self.unacked, deque()
+        self.outbound = self.acked
+        self.client.set_jid(self.jid)
+        self.client.set_connected(resumed=True)
+
+    def _resume_failed(self):
+        # keep held messages and presence for the new session; iqs belong to the old one
+        held = deque(data for data in self.unacked if not data.startswith('<iq'))
+        self._reset()
+        self.unacked = held
+        # requests in flight won't be answered, and the presence we had is stale (the
+        # new session gets a fresh presence burst)
+        self.client.iq_handler.fail_pending("session lost")
+        if self.client.roster is not None:
+            self.client.roster.clear_presence()
+
+class SMHandler(Handler):
+    """Passes stream management elements to client.sm"""
+    def __init__(self, sm):
+        self.sm = sm
+
+    def handle(self, stanza):
+        self.sm.handle(stanza)
+
+def test_resume():
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    received = []
+    server, port = start_fake_server(io_loop, stream_management=True,
+        stanza_cb=lambda connection, stanza: received.append(stanza.find("body").data))
+    client = client_for(port, io_loop)
+    client.sm = StreamManagement(client)
+    def connect_cb():
+        if client.sm.resumed:
+            io_loop.add_timeout(time.time() + 0.1, io_loop.stop)
+            return
+        for i in range(5):
+            client.message(to="a@test", body=str(i))
+        # drop the connection once the server has them (but before it acks them)
+        io_loop.add_timeout(time.time() + 0.1, lambda: server.connections[0].stream.close())
+    def close_cb():
+        for i in range(5, 10):
+            client.message(to="a@test", body=str(i))
+    client.connect(connect_cb=connect_cb, presence_cb=lambda stanza: None,
+        message_cb=lambda stanza: None, close_cb=close_cb)
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert client.sm.resumed and server.binds == 1
+    assert client.jid == "bot@test/r"
+    assert received == [str(i) for i in range(10)]
+
+def test_ack_counts():
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, start_fake_server
+    io_loop = tornado.ioloop.IOLoop()
+    server, port = start_fake_server(io_loop, stream_management=True)
+    client = client_for(port, io_loop)
+    client.sm = StreamManagement(client)
+    client.max_stanza_size = 2000
+    events = []
+    client.add_namespace_handler("http://jabber.org/protocol/pubsub#event", lambda stanza: events.append(stanza))
+    messages = []
+    acks = []
+    write = client.write
+    def write_and_record(data):
+        if data.startswith('<a '):
+            acks.append(data)
+            io_loop.stop()
+        write(data)
+    client.write = write_and_record
+    before = []
+    def replay():
+        # a stanza taken by a namespace handler, one handled normally and one dropped
+        # for its size all count towards h
+        before.append(client.sm.inbound)
+        server.connections[0].replay([
+            '<message from="pubsub.test"><event xmlns="http://jabber.org/protocol/pubsub#event"/></message>',
+            '<message from="a@test/x"><body>hi</body></message>',
+            '<message from="a@test/x"><body>%s</body></message>' % ('x' * 5000),
+            '<r xmlns="%s"/>' % NS_SM])
+    def connect_cb():
+        # once stream management is enabled
+        io_loop.add_timeout(time.time() + 0.1, replay)
+    client.connect(connect_cb=connect_cb, presence_cb=lambda stanza: None,
+        message_cb=lambda stanza: messages.append(stanza.find("body").data))
+    io_loop.add_timeout(time.time() + 5, io_loop.stop)
+    io_loop.start()
+    server.stop()
+    assert client.sm.acking and len(events) == 1 and messages == ['hi']
+    assert acks == ['<a xmlns="%s" h="%d"/>' % (NS_SM, before[0] + 3)]
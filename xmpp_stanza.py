@@ -0,0 +1,103 @@
+"""
+Serialization of outbound stanzas. Everything here returns utf-8 encoded bytes, ready
+to write to the stream, with text and attribute values escaped.
+"""
+import re
+
+_ESCAPE_RE = re.compile(r'[&<>"\']')
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&apos;'}
+
+MESSAGE_TEMPLATE = '<message to="%s" type="chat" id="%s"%s><body>%s</body></message>'
+IQ_TEMPLATE = '<iq type="%s"%s>%s</iq>'
+
+def _replace(match):
+    return _ESCAPES[match.group()]
+
+def escape(text):
+    """utf-8 encode text (if it's unicode) and escape it for use as xml character data
+    or an attribute value, in a single pass"""
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    elif not isinstance(text, str):
+        text = str(text)
+    if _ESCAPE_RE.search(text) is None:
+        return text
+    return _ESCAPE_RE.sub(_replace, text)
+
+def attr(name, value):
+    """An attribute fragment, ' name="value"', or '' when value is None"""
+    if value is None:
+        return ''
+    return ' %s="%s"' % (name, escape(value))
+
+def message_stanza(to, body, id_str, from_attr=''):
+    """A chat message. from_attr is a prebuilt attr("from", jid) fragment (or '')"""
+    return MESSAGE_TEMPLATE % (escape(to), id_str, from_attr, escape(body))
+
+def presence_stanza(show=None, status=None, priority=None, to=None, type=None):
+    body = []
+    if show:
+        body.append('<show>%s</show>' % escape(show))
+    if status:
+        body.append('<status>%s</status>' % escape(status))
+    if priority:
+        body.append('<priority>%d</priority>' % priority)
+    return '<presence%s%s>%s</presence>' % (attr("to", to), attr("type", type), ''.join(body))
+
+def iq_stanza(type, body, attrs=''):
+    """An iq; body is an xml string (used as is) or an XmlBLock tree. attrs are prebuilt
+    attribute fragments"""
+    if not isinstance(body, basestring):
+        body = serialize(body)
+    elif isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if isinstance(attrs, unicode):
+        attrs = attrs.encode('utf-8')
+    return IQ_TEMPLATE % (escape(type), attrs, body)
+
+def serialize(xml_blk):
+    """An XmlBLock tree as xml; data comes before the children"""
+    parts = []
+    _serialize(xml_blk, parts)
+    return ''.join(parts)
+
+def _serialize(xml_blk, parts):
+    name = escape(xml_blk.name)
+    parts.append('<' + name)
+    for key, value in xml_blk.options.items():
+        parts.append(attr(key, value))
+    if not xml_blk.data and not xml_blk.children:
+        parts.append('/>')
+        return
+    parts.append('>')
+    if xml_blk.data:
+        parts.append(escape(xml_blk.data))
+    for child in xml_blk.children:
+        _serialize(child, parts)
+    parts.append('</%s>' % name)
+
+def test_escape():
+    assert escape('plain') == 'plain'
+    assert escape(u'<a href="x">Tom & Jerry\'s</a>') == '&lt;a href=&quot;x&quot;&gt;Tom &amp; Jerry&apos;s&lt;/a&gt;'
+    assert escape(u'caf\xe9 &') == 'caf\xc3\xa9 &amp;'
+    assert escape(5) == '5'
+    assert attr("to", None) == ''
+    assert attr("to", 'a"b') == ' to="a&quot;b"'
+
+def test_stanzas():
+    from xmlparse import xml2msg, XmlBLock
+    data = message_stanza(u'bob@test', u'</body> & <b>caf\xe9</b>', 7, attr("from", "me@test/r"))
+    assert isinstance(data, str)
+    msg = xml2msg(data.decode('utf-8'))
+    assert msg.options == {'to': 'bob@test', 'type': 'chat', 'id': '7', 'from': 'me@test/r'}
+    assert msg.find('body').data == u'</body> & <b>caf\xe9</b>'
+
+    msg = xml2msg(presence_stanza(show="away", status='"out" & about', priority=5).decode('utf-8'))
+    assert msg.find('status').data == '"out" & about'
+    assert msg.find('priority').data == '5'
+
+    query = XmlBLock("query", data="", options={"xmlns": "jabber:iq:private"},
+        children=[XmlBLock("note", data="a < b", options={"id": "1"})])
+    data = iq_stanza("set", query, ' id="3"')
+    assert data == '<iq type="set" id="3"><query xmlns="jabber:iq:private"><note id="1">a &lt; b</note></query></iq>'
+    assert xml2msg(data).find('query') == query
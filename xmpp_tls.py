@@ -0,0 +1,114 @@
+"""
+TLS for XMPPIOLoopClient: one SSLContext for the whole process (TLS 1.2 or newer,
+certificates and hostnames verified) for STARTTLS, and one for direct TLS (XEP-0368),
+which also offers the xmpp-client ALPN protocol.
+
+    >> client.ssl_context = create_context(cafile='/etc/ssl/private-ca.pem', direct_tls=True)
+    >> client.direct_tls = True # ie: port 5223, no STARTTLS round trip
+"""
+import logging
+import ssl
+
+import tornado.iostream
+
+NS_TLS = "urn:ietf:params:xml:ns:xmpp-tls"
+# the ALPN protocol for direct TLS connections (XEP-0368)
+ALPN_XMPP_CLIENT = "xmpp-client"
+DIRECT_TLS_PORT = 5223
+DIRECT_TLS_SRV_SERVICE = "_xmpps-client._tcp"
+
+# direct_tls -> context
+_default_contexts = {}
+
+def create_context(cafile=None, verify=True, direct_tls=False):
+    """A client SSLContext allowing TLS 1.2 and newer. With verify the server's
+    certificate has to chain to cafile (or the system CAs) and match the domain. A
+    context for direct_tls offers ALPN; XEP-0368 only defines it there, not for STARTTLS"""
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1
+    context.options |= getattr(ssl, 'OP_NO_COMPRESSION', 0)
+    if verify:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        if cafile:
+            context.load_verify_locations(cafile)
+        else:
+            context.load_default_certs()
+    if direct_tls and getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols([ALPN_XMPP_CLIENT])
+    return context
+
+def default_context(direct_tls=False):
+    """The context clients use unless given their own; built once per process"""
+    context = _default_contexts.get(direct_tls)
+    if context is None:
+        context = _default_contexts[direct_tls] = create_context(direct_tls=direct_tls)
+    return context
+
+def wrap_socket(sock, context, server_hostname):
+    """Wrap a connected socket for a non-blocking client handshake (the SSLIOStream
+    does the handshake)"""
+    logging.debug('starting tls with %s', server_hostname)
+    return context.wrap_socket(sock, server_side=False, do_handshake_on_connect=False,
+        server_hostname=server_hostname)
+
+class TLSIOStream(tornado.iostream.SSLIOStream):
+    """An SSLIOStream that closes (instead of raising out of the IOLoop) when the
+    server's certificate doesn't match the hostname"""
+    def _do_ssl_handshake(self):
+        try:
+            return super(TLSIOStream, self)._do_ssl_handshake()
+        except ssl.CertificateError, e:
+            logging.error('tls certificate verification failed: %s', e)
+            self.close()
+
+def _run_session(server_kwargs, client_setup, hostname="test"):
+    import shutil
+    import socket
+    import tempfile
+    import time
+    import tornado.ioloop
+    from xmpp_fakeserver import client_for, make_self_signed_cert, start_fake_server
+    directory = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = make_self_signed_cert(directory, common_name=hostname)
+        io_loop = tornado.ioloop.IOLoop()
+        server, port = start_fake_server(io_loop, certfile=certfile, keyfile=keyfile, **server_kwargs)
+        client = client_for(port, io_loop)
+        client.ssl_context = create_context(cafile=certfile, direct_tls=server_kwargs.get('direct_tls', False))
+        client.autoreconnect = False
+        client_setup(client)
+        events = []
+        def connect_cb():
+            socket = client.stream.socket
+            events.append(("connected", socket.version(), socket.selected_alpn_protocol()))
+            io_loop.stop()
+        def close_cb():
+            events.append(("closed", None))
+            io_loop.stop()
+        client.connect(connect_cb=connect_cb, presence_cb=lambda stanza: None,
+            message_cb=lambda stanza: None, close_cb=close_cb)
+        io_loop.add_timeout(time.time() + 5, io_loop.stop)
+        io_loop.start()
+        server.stop()
+        return events
+    finally:
+        shutil.rmtree(directory)
+
+def test_starttls():
+    events = _run_session({}, lambda client: None)
+    assert len(events) == 1 and events[0][0] == "connected"
+    assert events[0][1] in ("TLSv1.2", "TLSv1.3")
+    # no ALPN over STARTTLS
+    assert events[0][2] is None
+    # the certificate has to match the domain
+    events = _run_session({}, lambda client: None, hostname="other")
+    assert events == [("closed", None)]
+
+def test_direct_tls():
+    def setup(client):
+        client.direct_tls = True
+    events = _run_session(dict(direct_tls=True), setup)
+    assert len(events) == 1 and events[0][0] == "connected"
+    if getattr(ssl, 'HAS_ALPN', False):
+        assert events[0][2] == ALPN_XMPP_CLIENT